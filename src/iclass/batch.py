@@ -0,0 +1,171 @@
+"""Helpers for the resumable batch processing of many files: atomic
+outputs and the manifest of the completed inputs.
+"""
+
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+
+def file_hash(file_name: str, chunk_size: int = 2**20) -> str:
+    """
+    Computes the SHA-256 hash of the file content.
+
+    Parameters
+    ----------
+    file_name: str
+        file to hash
+    chunk_size: int
+        number of bytes to read at a time
+
+    Returns
+    -------
+    str:
+        hexadecimal digest
+    """
+    digest = hashlib.sha256()
+
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomic_outputs():
+    """
+    Context manager to write the output files atomically.
+
+    Yields a function mapping the output file name to the temporary one
+    to write to. When the block completes, all the temporary files are
+    renamed to their final names; if it raises, they are removed. An
+    interrupted job thus never leaves half-written outputs under
+    the final names.
+
+    Example
+    -------
+    >>> with atomic_outputs() as temporary:
+    ...     data.to_hdf(temporary('out.h5'), key='events')
+    """
+    outputs = {}
+
+    def temporary(file_name: str) -> str:
+        if file_name not in outputs:
+            directory, name = os.path.split(file_name)
+            outputs[file_name] = os.path.join(directory, f'.{name}.{os.getpid()}.tmp')
+            if os.path.exists(outputs[file_name]):
+                os.remove(outputs[file_name])
+
+        return outputs[file_name]
+
+    try:
+        yield temporary
+    except BaseException:
+        for tmp_name in outputs.values():
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        raise
+
+    for file_name, tmp_name in outputs.items():
+        if os.path.exists(tmp_name):
+            os.replace(tmp_name, file_name)
+
+
+class Manifest:
+    """
+    Record of the processed input files.
+
+    Each completed input is appended as a JSON line with its size and
+    modification time, the processing parameters (e.g. including the
+    model hash) and the written outputs. An input is considered done
+    if it is recorded with the same parameters, is unchanged since and
+    all its outputs exist - so that a restarted campaign only
+    processes the remaining inputs.
+
+    Parameters
+    ----------
+    file_name: str
+        manifest file name; created if missing
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.entries = {}
+
+        if os.path.exists(file_name):
+            with open(file_name, 'r', encoding='utf-8') as f:
+                for line in f:
+                    # A line truncated by an interruption is ignored
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['input']] = entry
+
+    @staticmethod
+    def _stat(input_fname: str) -> dict:
+        stat = os.stat(input_fname)
+        return dict(size=stat.st_size, mtime=stat.st_mtime_ns)
+
+    def is_done(self, input_fname: str, params: dict) -> bool:
+        """
+        Checks whether the input was processed with the given parameters.
+
+        Parameters
+        ----------
+        input_fname: str
+            input file name
+        params: dict
+            processing parameters
+
+        Returns
+        -------
+        bool:
+            whether the processing can be skipped
+        """
+        entry = self.entries.get(os.path.abspath(input_fname))
+
+        # Compare in the JSON form the parameters are stored in
+        if entry is None or entry['params'] != json.loads(json.dumps(params)):
+            return False
+        if entry['stat'] != self._stat(input_fname):
+            return False
+
+        return all(os.path.exists(output) for output in entry['outputs'])
+
+    def record(self, input_fname: str, params: dict, outputs: list) -> None:
+        """
+        Records the input as processed.
+
+        Parameters
+        ----------
+        input_fname: str
+            input file name
+        params: dict
+            processing parameters; must be JSON-serializable
+        outputs: list
+            names of the written output files
+        """
+        entry = dict(
+            input=os.path.abspath(input_fname),
+            stat=self._stat(input_fname),
+            params=params,
+            outputs=[os.path.abspath(output) for output in outputs],
+        )
+
+        # A line truncated by an interruption is terminated,
+        # so that the entry is not glued onto it
+        prefix = ''
+        if os.path.exists(self.file_name) and os.path.getsize(self.file_name):
+            with open(self.file_name, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                prefix = '' if f.read(1) == b'\n' else '\n'
+
+        with open(self.file_name, 'a', encoding='utf-8') as f:
+            f.write(prefix + json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.entries[entry['input']] = entry
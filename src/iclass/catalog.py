@@ -0,0 +1,249 @@
+"""Catalog of the MC production files: per-file metadata (row counts,
+column schema, observation IDs, energy and pointing ranges and the
+simulation configuration summary) scanned once and cached.
+
+The cached entries are keyed by the file path and the table key and
+validated with the file size and modification time, so that only the
+new or modified files are scanned again.
+"""
+
+import json
+import logging
+import os
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from iclass.io import iter_chunks, read_simulation_config
+from iclass.plan import table_row_width
+
+logger = logging.getLogger(__name__)
+
+# Columns to summarize with their value ranges - the energies and pointing
+RANGE_COLUMNS = ('mc_energy', 'reco_energy', 'alt_tel', 'az_tel')
+
+
+def _normalize_key(key: str) -> str:
+    return '/' + key.strip('/')
+
+
+def _file_stat(file_name: str) -> dict:
+    stat = os.stat(file_name)
+    return dict(size=stat.st_size, mtime=stat.st_mtime_ns)
+
+
+def scan_file(file_name: str, key: str, cfg_key: str = '', chunk_size: int = 1_000_000) -> dict:
+    """
+    Collects the metadata of the event file, reading it chunk by chunk.
+
+    Parameters
+    ----------
+    file_name: str
+        HDF5 file to scan
+    key: str
+        HDF key of the event table
+    cfg_key: str
+        HDF key of the simulation configuration; skipped if empty or missing
+    chunk_size: int
+        number of events to read at a time
+
+    Returns
+    -------
+    metadata: dict
+        "size" and "mtime" - file size and modification time, ns;
+        "key" - event table key; "nrows" - number of events;
+        "row_width" - table row size, bytes (see table_row_width());
+        "columns" - column data types; "obs_ids" - observation IDs;
+        "ranges" - [min, max] of the RANGE_COLUMNS present;
+        "run_config" - number of rows, observation IDs and the total
+        "n_showers" of the simulation configuration, or None
+    """
+    metadata = dict(_file_stat(file_name), key=_normalize_key(key), nrows=0)
+    columns = None
+    obs_ids = set()
+    ranges = {}
+
+    for chunk in iter_chunks(file_name, key, chunk_size):
+        if columns is None:
+            columns = {name: str(dtype) for name, dtype in chunk.dtypes.items()}
+
+        metadata['nrows'] += len(chunk)
+        if 'obs_id' in chunk:
+            obs_ids.update(np.unique(chunk['obs_id'].values).tolist())
+
+        for name in RANGE_COLUMNS:
+            if name not in chunk:
+                continue
+            values = chunk[name].values
+            values = values[np.isfinite(values)]
+            if len(values):
+                low, high = ranges.get(name, (np.inf, -np.inf))
+                ranges[name] = (min(low, values.min().item()), max(high, values.max().item()))
+
+    metadata['row_width'] = table_row_width(file_name, key)
+    metadata['columns'] = columns
+    metadata['obs_ids'] = sorted(obs_ids)
+    metadata['ranges'] = {name: list(limits) for name, limits in ranges.items()}
+
+    metadata['run_config'] = None
+    if cfg_key:
+        try:
+            cfg = read_simulation_config(file_name, key=cfg_key)
+        except KeyError:
+            logger.warning("no simulation configuration %s in %s", cfg_key, file_name)
+        else:
+            metadata['run_config'] = dict(
+                key=_normalize_key(cfg_key),
+                nrows=len(cfg),
+                obs_ids=sorted(np.unique(cfg['obs_id']).tolist()) if 'obs_id' in cfg else [],
+                n_showers=int(cfg['n_showers'].sum()) if 'n_showers' in cfg else None,
+            )
+
+    return metadata
+
+
+class Catalog:
+    """
+    Cached metadata of the MC production files.
+
+    Parameters
+    ----------
+    file_name: str
+        JSON file to cache the metadata in; loaded if present.
+        With an empty name the catalog is kept in memory only.
+
+    Example
+    -------
+    >>> catalog = Catalog('catalog.json')
+    >>> catalog.update(glob.glob('dl2/*.h5'), key, n_jobs=8)
+    >>> nevents = sum(catalog.get(name, key)['nrows'] for name in catalog.entries)
+
+    The "entries" map the absolute file paths to the metadata
+    of their tables by the table key.
+    """
+
+    def __init__(self, file_name: str = ''):
+        self.file_name = file_name
+        self.entries = {}
+
+        if file_name and os.path.exists(file_name):
+            with open(file_name, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+            # The entries cached by path only are scanned again
+            self.entries = {
+                path: tables for path, tables in self.entries.items()
+                if 'size' not in tables
+            }
+
+    def get(self, file_name: str, key: str) -> dict:
+        """
+        Looks up the metadata of the file.
+
+        Parameters
+        ----------
+        file_name: str
+            HDF5 file name
+        key: str
+            HDF key of the event table
+
+        Returns
+        -------
+        metadata: dict
+            metadata as returned by scan_file(), or None if the file
+            is not catalogued or was modified since
+        """
+        entry = self.entries.get(os.path.abspath(file_name), {}).get(_normalize_key(key))
+
+        if entry is None:
+            return None
+        if not os.path.exists(file_name):
+            return None
+        if {name: entry[name] for name in ('size', 'mtime')} != _file_stat(file_name):
+            return None
+
+        return entry
+
+    def update(
+        self,
+        file_names: list,
+        key: str,
+        cfg_key: str = '',
+        n_jobs: int = None,
+        chunk_size: int = 1_000_000
+    ) -> list:
+        """
+        Scans the new and modified files in a process pool
+        and saves the updated catalog.
+
+        Parameters
+        ----------
+        file_names: list
+            HDF5 files to catalog
+        key: str
+            HDF key of the event tables
+        cfg_key: str
+            HDF key of the simulation configuration
+        n_jobs: int
+            number of worker processes; defaults to the number of CPUs
+        chunk_size: int
+            number of events to read at a time
+
+        Returns
+        -------
+        entries: list
+            metadata of the given files
+        """
+        stale = [name for name in file_names if self.get(name, key) is None]
+
+        if stale:
+            scan = partial(scan_file, key=key, cfg_key=cfg_key, chunk_size=chunk_size)
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                for name, metadata in zip(stale, pool.map(scan, stale)):
+                    logger.info("scanned %s: %d events", name, metadata['nrows'])
+                    self.entries.setdefault(os.path.abspath(name), {})[metadata['key']] = metadata
+
+            self.save()
+
+        return [self.get(name, key) for name in file_names]
+
+    def save(self) -> None:
+        """
+        Writes the catalog to its file, replacing it atomically.
+        """
+        if not self.file_name:
+            return
+
+        with open(self.file_name + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(self.file_name + '.tmp', self.file_name)
+
+
+def load_catalog(file_name: str, file_names: list, key: str, n_jobs: int = None) -> Catalog:
+    """
+    Loads the catalog, adding the missing or outdated entries of the files.
+
+    Parameters
+    ----------
+    file_name: str
+        catalog file name (see Catalog)
+    file_names: list
+        HDF5 files to catalog
+    key: str
+        HDF key of the event tables
+    n_jobs: int
+        number of processes to scan the files with
+
+    Returns
+    -------
+    catalog: Catalog
+        updated catalog, or None if no file name is given
+    """
+    if not file_name:
+        return None
+
+    catalog = Catalog(file_name)
+    catalog.update(file_names, key, n_jobs=n_jobs)
+
+    return catalog
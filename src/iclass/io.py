@@ -1,6 +1,28 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import tokenize
+import numpy as np
 import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
 from itertools import accumulate
-from tables import open_file
+from tables import Filters, Table, open_file
+
+
+# HDF5 library calls are not thread-safe; helpers that may be called
+# from several threads (e.g. the iclass.pipeline stages) hold this lock.
+HDF5_LOCK = threading.RLock()
+
+# Columns stored along with the predictions in the sidecar tables
+# to verify their alignment with the event tables
+SIDECAR_ID_COLUMNS = ('obs_id', 'event_id')
+
+_LOGICAL_OPERATORS = {'&': '&', '|': '|', 'and': '&', 'or': '|'}
+_NEGATION_OPERATORS = {'~', 'not'}
 
 
 def read_simulation_config(file_name: str, key: str) -> pd.DataFrame:
@@ -69,3 +91,640 @@ def write_simulation_config(cfg: pd.DataFrame, file_name: str, key: str) -> None
 
         table.append(structured_array)
         table.flush()
+
+
+def common_dtype(dtypes: list) -> np.dtype:
+    """
+    Get the record dtype able to store the rows of all the tables
+    with the given record dtypes.
+
+    The string columns get the largest of their widths,
+    the numeric ones the common numpy type.
+
+    Parameters
+    ----------
+    dtypes: list
+        structured (record) dtypes of the tables
+
+    Returns
+    -------
+    np.dtype:
+        common record dtype with the column order of the first table
+
+    Raises
+    ------
+    ValueError
+        if the tables have different columns or
+        mix string and numeric values in a column
+    """
+    names = dtypes[0].names
+
+    for dtype in dtypes[1:]:
+        if set(dtype.names) != set(names):
+            raise ValueError(
+                f"tables have different columns: {sorted(set(names) ^ set(dtype.names))}"
+            )
+
+    fields = []
+    for name in names:
+        types = [dtype.fields[name][0] for dtype in dtypes]
+        is_string = [ftype.kind == 'S' for ftype in types]
+
+        if all(is_string):
+            fields.append((name, f'S{max(ftype.itemsize for ftype in types)}'))
+        elif any(is_string):
+            raise ValueError(f"column '{name}' mixes string and numeric values")
+        else:
+            fields.append((name, np.result_type(*types)))
+
+    return np.dtype(fields)
+
+
+def to_records(data: pd.DataFrame, dtype: np.dtype = None) -> np.ndarray:
+    """
+    Convert the data frame to a structured array storable
+    in a PyTables table.
+
+    The string columns are encoded to fixed-width UTF-8 byte strings.
+    If the record dtype is given, the columns are cast to it.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Data frame to convert
+    dtype: np.dtype
+        record dtype to cast to; defaults to that of the data frame columns
+
+    Returns
+    -------
+    np.ndarray:
+        structured array with the data frame rows
+
+    Raises
+    ------
+    ValueError
+        if the columns can not be stored with the given record dtype
+        without truncating the strings or changing the numeric types
+    """
+    columns = {}
+    for name in data.columns:
+        values = data[name].to_numpy()
+        if values.dtype.kind in 'OSU':
+            values = np.array(
+                [value.encode() if isinstance(value, str) else value for value in values],
+                dtype='S'
+            )
+        columns[name] = values
+
+    fields = [(name, values.dtype) for name, values in columns.items()]
+    records = np.empty(len(data), dtype=fields)
+    for name, values in columns.items():
+        records[name] = values
+
+    if dtype is not None and records.dtype != dtype:
+        if common_dtype([dtype, records.dtype]) != dtype:
+            raise ValueError(
+                f"can not store the columns of types {records.dtype} in a table of types {dtype}; "
+                "set the common table types up front (see common_dtype())"
+            )
+        # Structured arrays are cast by the field position, not the name
+        records = records[list(dtype.names)].astype(dtype)
+
+    return records
+
+
+def append_table(
+    data: pd.DataFrame,
+    file_name: str,
+    key: str,
+    complevel: int = 0,
+    dtype: np.dtype = None
+) -> None:
+    """
+    Append data frame rows to the PyTables table at
+    the specified key of the HDF5 file.
+
+    The table (and its parent groups) is created on the first call,
+    subsequent calls append to it. Unlike DataFrame.to_hdf(..., format='table')
+    the rows are stored directly under the given key, as lstchain expects.
+
+    If provided data frame defines a dictionary-like "attrs" attribute,
+    it will be used to set the attributes of a newly created table.
+
+    The appended rows are cast to the table column types. As the string
+    widths of a table are fixed on its creation, the frames with differing
+    string widths or column types should set the common "dtype" up front.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Data frame to be written down
+    file_name: str
+        HDF5 file to write to.
+    key: str
+        HDF key to write the table to.
+    complevel: int
+        zlib compression level of a newly created table.
+    dtype: np.dtype
+        record dtype of a newly created table; defaults to
+        that of the data frame (see to_records())
+    """
+    key = '/' + key.strip('/')
+
+    with HDF5_LOCK, open_file(file_name, mode="a") as file:
+        if key in file:
+            table = file.get_node(key)
+            structured_array = to_records(data, table.dtype)
+        else:
+            structured_array = to_records(data, dtype)
+            where, _, name = key.rpartition('/')
+            table = file.create_table(
+                where or '/',
+                name,
+                structured_array.dtype,
+                filters=Filters(complevel=complevel, complib='zlib'),
+                createparents=True
+            )
+            if hasattr(data, 'attrs'):
+                for attr in data.attrs:
+                    table.attrs[attr] = data.attrs[attr]
+
+        table.append(structured_array)
+        table.flush()
+
+
+class AppendProcess:
+    """
+    Appender of the data frames to the HDF5 tables (see append_table())
+    in a dedicated process.
+
+    The HDF5 library serializes all its calls within a process, including
+    the compression, so that the writes of one thread can not overlap the
+    reads of another. Writing in a separate process with its own instance
+    of the library lets them run concurrently. Each append waits for its
+    completion, so the files are complete once it returns; the data frame
+    is pickled to the writer process, which costs a memory copy.
+
+    A file being read by this process must not be written this way.
+
+    Example
+    -------
+    >>> with AppendProcess() as writer:
+    ...     run_pipeline(chunks, process, lambda data: writer.append(data, file_name, key))
+    """
+
+    def __init__(self):
+        # Forked workers could inherit the locks held by the other threads
+        # of this process (e.g. the iclass.pipeline reader), hence "forkserver"
+        self.pool = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context('forkserver')
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool.shutdown()
+
+    def append(self, data: pd.DataFrame, file_name: str, key: str, complevel: int = 0) -> None:
+        """
+        Appends the data frame rows to the table, see append_table().
+
+        Parameters
+        ----------
+        data: pd.DataFrame
+            Data frame to be written down
+        file_name: str
+            HDF5 file to write to.
+        key: str
+            HDF key to write the table to.
+        complevel: int
+            zlib compression level of a newly created table.
+        """
+        self.pool.submit(append_table, data, file_name, key, complevel).result()
+
+
+def _translate_cuts(tokens: list) -> str:
+    terms = [[]]
+    operators = []
+    depth = 0
+
+    for token in tokens:
+        if token.string in ('(', '['):
+            depth += 1
+        elif token.string in (')', ']'):
+            depth -= 1
+
+        if depth == 0 and token.string in _LOGICAL_OPERATORS:
+            operators.append(_LOGICAL_OPERATORS[token.string])
+            terms.append([])
+        else:
+            terms[-1].append(token)
+
+    if any(not term for term in terms):
+        raise ValueError("empty term in the cuts expression")
+
+    if len(terms) > 1:
+        condition = f'({_translate_cuts(terms[0])})'
+        for operator, term in zip(operators, terms[1:]):
+            condition += f' {operator} ({_translate_cuts(term)})'
+        return condition
+
+    term = terms[0]
+    if term[0].string in _NEGATION_OPERATORS:
+        return f'~({_translate_cuts(term[1:])})'
+
+    if term[0].string == '(' and term[-1].string == ')':
+        depth = 0
+        for token in term[:-1]:
+            depth += {'(': 1, ')': -1}.get(token.string, 0)
+            if depth == 0:
+                break
+        else:
+            return f'({_translate_cuts(term[1:-1])})'
+
+    return ' '.join(token.string for token in term)
+
+
+def cuts_to_condition(cuts: str) -> str:
+    """
+    Translate the DataFrame.query() cuts expression
+    to a PyTables (numexpr) condition.
+
+    In DataFrame.query() the logical operators bind weaker than
+    the comparisons, whereas in numexpr (as in Python) "&" and "|"
+    take precedence. Every operand of the logical operators is therefore
+    put into parentheses; "and", "or" and "not" are replaced with "&",
+    "|" and "~" correspondingly.
+
+    Parameters
+    ----------
+    cuts: str
+        DataFrame.query() expression,
+        e.g. "gammaness > 0.7 & intensity > 50"
+
+    Returns
+    -------
+    condition: str
+        PyTables condition,
+        e.g. "(gammaness > 0.7) & (intensity > 50)"
+    """
+    skip = (tokenize.NEWLINE, tokenize.NL, tokenize.ENDMARKER)
+    tokens = [
+        token for token in tokenize.generate_tokens(StringIO(cuts).readline)
+        if token.type not in skip
+    ]
+
+    return _translate_cuts(tokens)
+
+
+def iter_chunks(file_name: str, key: str, chunk_size: int, cuts: str = ''):
+    """
+    Iterate over the table at the specified key of
+    the HDF5 file in chunks of the given number of rows.
+
+    Both PyTables tables (as written by lstchain or `append_table`) and
+    pandas "table" format are read chunk by chunk. Pandas "fixed"
+    format does not support partial reads and is read at once.
+
+    For PyTables tables the cuts are evaluated by PyTables during
+    the read (see cuts_to_condition()), so that only the passing rows
+    are materialized. If the cuts can not be translated to a PyTables
+    condition - or for the pandas formats - they are applied to each
+    chunk with DataFrame.query().
+
+    Parameters
+    ----------
+    file_name: str
+        HDF5 file to read.
+    key: str
+        HDF key to read the table from.
+    chunk_size: int
+        number of rows per chunk; 0 reads the whole table at once
+    cuts: str
+        DataFrame.query() expression of the event cuts to apply
+
+    Yields
+    ------
+    chunk: pd.DataFrame
+        consecutive table rows (passing the cuts);
+        at least one, possibly empty, chunk is yielded
+    """
+    log = logging.getLogger(__name__)
+    key = '/' + key.strip('/')
+
+    with HDF5_LOCK, open_file(file_name) as file:
+        node = file.get_node(key)
+        is_pytables = isinstance(node, Table)
+        nrows = node.nrows if is_pytables else None
+
+    if nrows is None:
+        with HDF5_LOCK, pd.HDFStore(file_name, mode='r') as store:
+            storer = store.get_storer(key)
+            if storer.is_table:
+                nrows = storer.nrows
+            else:
+                data = store.select(key)
+
+    if nrows is None:
+        if cuts:
+            data = data.query(cuts)
+        step = chunk_size or max(len(data), 1)
+        for start in range(0, max(len(data), 1), step):
+            yield data.iloc[start:start + step]
+        return
+
+    condition = ''
+    if cuts and is_pytables:
+        try:
+            condition = cuts_to_condition(cuts)
+        except (ValueError, tokenize.TokenError) as exc:
+            log.info("cuts '%s' can not be pushed down to PyTables: %s", cuts, exc)
+
+    step = chunk_size or max(nrows, 1)
+    for start in range(0, max(nrows, 1), step):
+        with HDF5_LOCK:
+            if is_pytables:
+                with open_file(file_name) as file:
+                    table = file.get_node(key)
+                    chunk = None
+                    if condition:
+                        try:
+                            chunk = table.read_where(condition, start=start, stop=start + step)
+                        except (NameError, NotImplementedError, SyntaxError, TypeError, ValueError) as exc:
+                            log.info("cuts '%s' can not be pushed down to PyTables: %s", cuts, exc)
+                            condition = ''
+                    if chunk is None:
+                        chunk = table.read(start, start + step)
+            else:
+                chunk = pd.read_hdf(file_name, key=key, start=start, stop=start + step)
+
+        # The conversion of the read records needs no lock
+        if is_pytables:
+            chunk = pd.DataFrame(chunk)
+
+        if cuts and not condition:
+            chunk = chunk.query(cuts)
+
+        yield chunk
+
+
+def read_events(file_name: str, key: str, cuts: str = '') -> pd.DataFrame:
+    """
+    Read the event table from the HDF5 file, applying the cuts
+    during the read where possible (see iter_chunks()).
+
+    Parameters
+    ----------
+    file_name: str
+        HDF5 file to read.
+    key: str
+        HDF key to read the table from.
+    cuts: str
+        DataFrame.query() expression of the event cuts to apply
+
+    Returns
+    -------
+    events: pd.DataFrame
+        events passing the cuts
+    """
+    return next(iter_chunks(file_name, key, 0, cuts))
+
+
+def table_nrows(file_name: str, key: str) -> int:
+    """
+    Get the number of rows of the table at the specified key
+    of the HDF5 file from its metadata, without reading the data.
+
+    Parameters
+    ----------
+    file_name: str
+        HDF5 file to read.
+    key: str
+        HDF key of the table.
+
+    Returns
+    -------
+    int:
+        number of table rows
+    """
+    key = '/' + key.strip('/')
+
+    with HDF5_LOCK, open_file(file_name) as file:
+        node = file.get_node(key)
+        if isinstance(node, Table):
+            return node.nrows
+
+    with HDF5_LOCK, pd.HDFStore(file_name, mode='r') as store:
+        storer = store.get_storer(key)
+        nrows = storer.nrows if storer.is_table else storer.shape[0]
+
+    return int(nrows)
+
+
+def table_dtype(file_name: str, key: str) -> np.dtype:
+    """
+    Get the record dtype of the PyTables table at the specified key
+    of the HDF5 file from its metadata, without reading the data.
+
+    Parameters
+    ----------
+    file_name: str
+        HDF5 file to read.
+    key: str
+        HDF key of the table.
+
+    Returns
+    -------
+    np.dtype:
+        table record dtype
+    """
+    key = '/' + key.strip('/')
+
+    with HDF5_LOCK, open_file(file_name) as file:
+        return file.get_node(key).dtype
+
+
+def _read_file(file_name: str, key: str, cuts: str) -> tuple:
+    start = time.perf_counter()
+    data = read_events(file_name, key, cuts)
+
+    return data, time.perf_counter() - start
+
+
+def read_files(
+    file_names: list,
+    key: str,
+    cuts: str = '',
+    n_jobs: int = None,
+    catalog=None
+) -> pd.DataFrame:
+    """
+    Read and concatenate the event tables of several HDF5 files,
+    decoding the files concurrently.
+
+    Since the HDF5 library serializes the calls from the threads of a single
+    process, the files are decoded in a process pool. The decoded tables are
+    copied straight into a preallocated output frame in the order of
+    the input files, sized from the table metadata, which avoids the
+    intermediate copies of pd.concat(). The frame is shrunk to the events
+    passing the cuts once all files are read. At most "n_jobs" decoded tables
+    are held awaiting the copy at a time. The read throughput of each
+    file is logged.
+
+    Parameters
+    ----------
+    file_names: list
+        HDF5 files to read; the tables should have the same columns
+        and data types.
+    key: str
+        HDF key to read the tables from.
+    cuts: str
+        DataFrame.query() expression of the event cuts to apply;
+        evaluated during the read where possible (see iter_chunks()).
+    n_jobs: int
+        number of worker processes; defaults to the number of CPUs
+    catalog: iclass.catalog.Catalog
+        catalog to take the table sizes from instead of
+        opening the files; optional
+
+    Returns
+    -------
+    events: pd.DataFrame
+        events of all files passing the cuts
+    """
+    log = logging.getLogger(__name__)
+
+    def nrows_of(file_name):
+        entry = catalog.get(file_name, key) if catalog is not None else None
+        return entry['nrows'] if entry else table_nrows(file_name, key)
+
+    # Upper bound of the output size; exact if no cuts are given
+    nrows = sum(nrows_of(file_name) for file_name in file_names)
+
+    columns = None
+    nfilled = 0
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        def results():
+            # The files are submitted as the results are consumed, so that
+            # the decoded tables do not pile up in memory
+            pending = deque()
+            for file_name in file_names:
+                pending.append(pool.submit(_read_file, file_name, key, cuts))
+                if len(pending) >= n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        for file_name, (data, elapsed) in zip(file_names, results()):
+            dtypes = {name: data[name].to_numpy().dtype for name in data.columns}
+            if columns is None:
+                columns = {name: np.empty(nrows, dtype=dtype) for name, dtype in dtypes.items()}
+            elif set(dtypes) != set(columns):
+                raise ValueError(
+                    f"columns of {file_name} differ from those of {file_names[0]}"
+                )
+
+            mismatch = [name for name, dtype in dtypes.items() if dtype != columns[name].dtype]
+            if mismatch:
+                raise ValueError(
+                    f"data types of {mismatch} columns of {file_name} differ from those of {file_names[0]}"
+                )
+
+            for name, values in columns.items():
+                values[nfilled:nfilled + len(data)] = data[name].values
+            nfilled += len(data)
+
+            size = data.memory_usage(index=False).sum() / 1024**2
+            log.info(
+                "read %s: %d events, %.1f MB in %.2f s (%.1f MB/s)",
+                file_name, len(data), size, elapsed, size / max(elapsed, 1e-9)
+            )
+            del data
+
+    if columns is None:
+        return pd.DataFrame()
+
+    if nfilled < nrows:
+        # Shrink the buffers oversized by the cuts in place, so that the
+        # returned columns do not keep the whole allocation alive;
+        # one column at a time at most is reallocated
+        for values in columns.values():
+            values.resize(nfilled, refcheck=False)
+
+    events = pd.DataFrame(columns, copy=False)
+
+    return events
+
+
+def read_with_sidecar(
+    file_name: str,
+    key: str,
+    sidecar_key: str,
+    sidecar_file: str = ''
+) -> pd.DataFrame:
+    """
+    Read the event table joined with the columns of
+    its row-aligned sidecar table.
+
+    Parameters
+    ----------
+    file_name: str
+        HDF5 file to read the events from.
+    key: str
+        HDF key to read the events from.
+    sidecar_key: str
+        HDF key to read the sidecar table from.
+    sidecar_file: str
+        HDF5 file to read the sidecar table from;
+        defaults to the event file.
+
+    Returns
+    -------
+    events: pd.DataFrame
+        events with the sidecar columns added
+    """
+    events = read_events(file_name, key)
+    sidecar = read_events(sidecar_file or file_name, sidecar_key)
+
+    if len(sidecar) != len(events):
+        raise ValueError(
+            f"sidecar table {sidecar_key} has {len(sidecar)} rows"
+            f" while the event table {key} has {len(events)}"
+        )
+
+    for name in SIDECAR_ID_COLUMNS:
+        if name in sidecar and name in events:
+            if not np.array_equal(sidecar[name].values, events[name].values):
+                raise ValueError(
+                    f"sidecar table {sidecar_key} is not aligned"
+                    f" with the event table {key} in '{name}'"
+                )
+
+    for name in sidecar.columns:
+        if name not in events:
+            events[name] = sidecar[name].values
+
+    return events
+
+
+def remove_node(file_name: str, key: str) -> None:
+    """
+    Remove the node (and its children) at the specified
+    key of the HDF5 file, if present.
+
+    Parameters
+    ----------
+    file_name: str
+        HDF5 file to modify.
+    key: str
+        HDF key of the node to remove.
+    """
+    key = '/' + key.strip('/')
+
+    with HDF5_LOCK, open_file(file_name, mode="a") as file:
+        if key in file:
+            file.remove_node(key, recursive=True)
@@ -1,10 +1,479 @@
+import json
 import logging
 import numpy as np
 import pandas as pd
 from astropy.coordinates import angular_separation
+from joblib import Parallel, delayed
 
+from iclass.io import read_events
 
-def mkmarkup(input_fname: str, key: str, ebinsdec: float, cuts: str = '') -> pd.DataFrame:
+
+def reco_offset(data: pd.DataFrame) -> np.ndarray:
+    """
+    Calculates the reconstructed event angular offset
+    wrt to the true coordinates.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        MC event list with the "mc_az", "mc_alt", "reco_az"
+        and "reco_alt" columns (in radians)
+
+    Returns
+    -------
+    offset: np.ndarray
+        angular offsets in degrees
+    """
+    return 180 / np.pi * angular_separation(
+        data['mc_az'].values,
+        data['mc_alt'].values,
+        data["reco_az"].values,
+        data["reco_alt"].values,
+    )
+
+
+# Default class definition: PSF classes from the offset quartiles in the true energy bins;
+# the events with negative offsets are assigned class 0
+PSF_CLASS = dict(
+    name='psf_class',
+    metric='reco_offset',
+    quantiles=[25, 50, 75],
+    binning='mc_energy',
+    lower=0,
+)
+
+
+def bootstrap_quantiles(
+    values: np.ndarray,
+    quantiles: list,
+    n_bootstrap: int = 1000,
+    confidence: float = 0.68,
+    seed=None
+) -> tuple:
+    """
+    Computes the percentiles of the values with their bootstrap
+    confidence intervals.
+
+    Only the order statistics the percentiles are interpolated from
+    (as in np.percentile()) are drawn for each resample. The rank k
+    (counting from 0) statistic of n uniform variates follows
+    Beta(k + 1, n - k), and that of a resample of the sorted values is
+    the value at the uniform one scaled by n. The next order statistic
+    is the least of the n - k - 1 uniform variates above the drawn one.
+    Thus each percentile costs O(n_bootstrap) once the values are sorted.
+    The percentiles are drawn independently, which leaves their
+    individual intervals exact.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        sorted values
+    quantiles: list
+        percentiles to compute
+    n_bootstrap: int
+        number of resamples
+    confidence: float
+        confidence level of the intervals
+    seed: int | np.random.SeedSequence
+        random seed
+
+    Returns
+    -------
+    percentiles: np.ndarray
+        percentiles of the values, NaN if there are none
+    intervals: np.ndarray
+        lower and upper bounds of the confidence intervals
+        of shape (n_quantiles, 2)
+    """
+    nvalues = len(values)
+    if nvalues == 0:
+        return np.full(len(quantiles), np.nan), np.full((len(quantiles), 2), np.nan)
+
+    # np.percentile() "linear" interpolation between the order statistics
+    positions = (nvalues - 1) * np.asarray(quantiles, dtype=float) / 100
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, nvalues - 1)
+    fraction = positions - lower
+
+    rng = np.random.default_rng(seed)
+    size = (n_bootstrap, len(quantiles))
+
+    low = rng.beta(lower + 1, nvalues - lower, size=size)
+    gap = np.zeros(size)
+    has_next = upper > lower
+    gap[:, has_next] = rng.beta(1, nvalues - upper[has_next], size=(n_bootstrap, np.sum(has_next)))
+    high = low + (1 - low) * gap
+
+    low = values[np.minimum((nvalues * low).astype(int), nvalues - 1)]
+    high = values[np.minimum((nvalues * high).astype(int), nvalues - 1)]
+    samples = low + fraction * (high - low)
+
+    intervals = np.percentile(
+        samples,
+        [50 * (1 - confidence), 50 * (1 + confidence)],
+        axis=0
+    ).T
+    percentiles = np.percentile(values, quantiles)
+
+    return percentiles, intervals
+
+
+def _unstable(intervals: np.ndarray) -> bool:
+    """Whether the confidence intervals of the adjacent edges overlap."""
+    return bool(np.any(intervals[1:, 0] <= intervals[:-1, 1]))
+
+
+def bootstrap_table(
+    table: dict,
+    metric: np.ndarray,
+    bin_ids: np.ndarray,
+    n_bootstrap: int = 1000,
+    confidence: float = 0.68,
+    merge_unstable: bool = False,
+    n_jobs: int = None,
+    seed: int = None
+) -> dict:
+    """
+    Adds the bootstrap confidence intervals to the class edges,
+    optionally merging the bins with unstable edges.
+
+    The edges of a bin are unstable if the confidence intervals of the
+    adjacent edges overlap, i.e. the classes are not resolved. Such bins -
+    starting from the last, usually the sparsest one - are merged with
+    their lower (the first bin with the upper) neighbour until all the
+    populated bins are stable or a single bin is left.
+
+    Parameters
+    ----------
+    table: dict
+        class edge table with the "quantiles", "bin_edges" and "edges"
+    metric: np.ndarray
+        class metric of the events sorted by their bins
+    bin_ids: np.ndarray
+        sorted bin indices of the events (starting from 1)
+    n_bootstrap: int
+        number of resamples
+    confidence: float
+        confidence level of the intervals
+    merge_unstable: bool
+        whether to merge the bins with unstable edges
+    n_jobs: int
+        number of the bins to process in parallel
+    seed: int | np.random.SeedSequence
+        random seed
+
+    Returns
+    -------
+    table: dict
+        edge table with the (merged) "bin_edges" and "edges", the confidence
+        intervals "edges_ci" of shape (n_bins, n_quantiles, 2) and the
+        event counts "n_events" of the bins
+    """
+    log = logging.getLogger(__name__)
+
+    quantiles = table['quantiles']
+    bin_edges = list(table['bin_edges'])
+    bounds = np.searchsorted(bin_ids, np.arange(1, len(bin_edges) + 2))
+    starts, stops = list(bounds[:-1]), list(bounds[1:])
+    seeds = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+    def compute(start, stop, bin_seed):
+        values = metric[start:stop]
+        values = np.sort(values[~np.isnan(values)])
+        return bootstrap_quantiles(values, quantiles, n_bootstrap, confidence, bin_seed)
+
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(compute)(start, stop, bin_seed)
+        for start, stop, bin_seed in zip(starts, stops, seeds.spawn(len(starts)))
+    )
+    edges = [result[0] for result in results]
+    intervals = [result[1] for result in results]
+
+    while merge_unstable and len(bin_edges) > 1:
+        unstable = [i for i, ci in enumerate(intervals) if _unstable(ci)]
+        if not unstable:
+            break
+
+        upper = max(unstable[-1], 1)
+        lower = upper - 1
+        log.info(
+            "merging the %s bins from %g with unstable edges",
+            table.get('name', ''), bin_edges[lower]
+        )
+
+        stops[lower] = stops.pop(upper)
+        starts.pop(upper)
+        bin_edges.pop(upper)
+        edges.pop(upper)
+        intervals.pop(upper)
+        edges[lower], intervals[lower] = compute(starts[lower], stops[lower], seeds.spawn(1)[0])
+
+    table = dict(
+        table,
+        bin_edges=np.array(bin_edges),
+        edges=np.array(edges),
+        edges_ci=np.array(intervals),
+        n_events=np.subtract(stops, starts),
+    )
+
+    return table
+
+
+def compute_edges(
+    data: pd.DataFrame,
+    ebinsdec: float,
+    cuts: str = '',
+    classes: list = None,
+    n_bootstrap: int = 0,
+    confidence: float = 0.68,
+    merge_unstable: bool = False,
+    n_jobs: int = None,
+    seed: int = None
+) -> dict:
+    """
+    Computes the class edges - the population percentiles of the class
+    metrics within the logarithmic bins of the pre-defined width.
+
+    Each class is defined by a dictionary with the following entries:
+    "name" - name of the class column;
+    "metric" - DataFrame.eval() expression of the metric,
+    e.g. "reco_offset" or "abs(reco_energy / mc_energy - 1)";
+    "quantiles" - percentiles of the metric separating the classes;
+    "binning" - positive variable to bin the events in, e.g. "mc_energy";
+    "lower" - optional lower bound of the metric, the events below it
+    are assigned class 0.
+
+    The events with undefined (NaN) metric are ignored in the percentiles.
+
+    All classes are computed in a single pass: the events are binned
+    and sorted once per binning variable and the sorted bins are reused
+    for all the metrics.
+
+    With "n_bootstrap" set, the bootstrap confidence intervals of the edges
+    are computed too, and the bins with unstable edges may be merged
+    (see bootstrap_table()).
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        MC event list with the columns required by the class definitions
+    ebinsdec: float
+        number of bins per dec of the binning variables to assume
+    cuts: str
+        event cuts applied to the data; only stored as metadata
+    classes: list
+        class definitions; defaults to the PSF classes (PSF_CLASS)
+    n_bootstrap: int
+        number of bootstrap resamples; 0 skips the confidence intervals
+    confidence: float
+        confidence level of the intervals
+    merge_unstable: bool
+        whether to merge the bins with unstable edges
+    n_jobs: int
+        number of bins to bootstrap in parallel
+    seed: int
+        random seed of the bootstrap; the intervals are
+        only reproducible if it is set
+
+    Returns
+    -------
+    edges: dict
+        Edge table with the following entries:
+        "classes" - class definitions updated with the "bin_edges" (lower
+        edges of the bins, the last bin extends to infinity) and
+        "edges" (metric percentiles of shape (n_bins, n_quantiles),
+        NaN for the bins without events), as well as "edges_ci"
+        and "n_events" if bootstrapped;
+        "ebinsdec" and "cuts" - the markup settings.
+    """
+    classes = classes or [PSF_CLASS]
+    tables = [None] * len(classes)
+    seeds = np.random.SeedSequence(seed).spawn(len(classes))
+
+    for binning in dict.fromkeys(definition['binning'] for definition in classes):
+        values = data[binning].values
+        bin_edges = 10**np.arange(
+            np.log10(values.min()),
+            np.log10(values.max()),
+            step=1 / ebinsdec
+        )
+
+        bin_ids = np.digitize(values, bin_edges)
+        order = np.argsort(bin_ids, kind='stable')
+        present, starts = np.unique(bin_ids[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+
+        for i, definition in enumerate(classes):
+            if definition['binning'] != binning:
+                continue
+
+            metric = np.asarray(data.eval(definition['metric']), dtype=float)[order]
+            edges = np.full((len(bin_edges), len(definition['quantiles'])), np.nan)
+
+            for bin_id, start, stop in zip(present, starts, stops):
+                values = metric[start:stop]
+                if np.isnan(values).all():
+                    continue
+                edges[bin_id - 1] = np.nanpercentile(values, definition['quantiles'])
+
+            tables[i] = dict(definition, bin_edges=bin_edges, edges=edges)
+
+            if n_bootstrap:
+                tables[i] = bootstrap_table(
+                    tables[i],
+                    metric,
+                    bin_ids[order],
+                    n_bootstrap,
+                    confidence,
+                    merge_unstable,
+                    n_jobs,
+                    seed=seeds[i]
+                )
+
+    edges = dict(
+        ebinsdec=ebinsdec,
+        cuts=cuts,
+        classes=tables,
+    )
+
+    return edges
+
+
+def assign_classes(data: pd.DataFrame, edges: dict) -> dict:
+    """
+    Assigns the classes by looking up the pre-computed edges.
+
+    Events outside the range of the binning variable are assigned
+    to the nearest (first or last) bin. Events below the "lower" bound
+    of the metric, if defined, are assigned class 0. Events in the bins
+    without edges or with undefined metric are not classified.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        MC event list with the columns required by the class definitions
+    edges: dict
+        edge table as returned by compute_edges()
+
+    Returns
+    -------
+    classes: dict
+        class column names and values 1 ... n_quantiles + 1
+        (0 below the "lower" bound); -1 for the not classified events
+    """
+    bin_ids = {}
+    classes = {}
+
+    for table in edges['classes']:
+        bin_edges = np.asarray(table['bin_edges'])
+        if table['binning'] not in bin_ids:
+            bin_ids[table['binning']] = np.clip(
+                np.digitize(data[table['binning']].values, bin_edges),
+                1,
+                len(bin_edges)
+            )
+        rows = np.asarray(table['edges'])[bin_ids[table['binning']] - 1]
+
+        # Row-wise search of the metric among the bin edges
+        metric = np.asarray(data.eval(table['metric']), dtype=float)
+        values = 1 + np.sum(metric[:, None] >= rows, axis=1)
+        if table.get('lower') is not None:
+            values[metric < table['lower']] = 0
+
+        invalid = np.isnan(rows).any(axis=1) | np.isnan(metric)
+        values[invalid] = -1
+
+        classes[table['name']] = values
+
+    return classes
+
+
+def save_edges(edges: dict, file_name: str) -> None:
+    """
+    Saves the edge table to a JSON file.
+
+    Parameters
+    ----------
+    edges: dict
+        edge table as returned by compute_edges()
+    file_name: str
+        output file name
+    """
+    table = dict(
+        edges,
+        classes=[
+            {
+                name: value.tolist() if isinstance(value, np.ndarray) else value
+                for name, value in definition.items()
+            }
+            for definition in edges['classes']
+        ]
+    )
+
+    with open(file_name, 'w', encoding='utf-8') as f:
+        json.dump(table, f, indent=2)
+
+
+def load_edges(file_name: str) -> dict:
+    """
+    Loads the edge table from a JSON file.
+
+    Parameters
+    ----------
+    file_name: str
+        input file name
+
+    Returns
+    -------
+    edges: dict
+        edge table as returned by compute_edges()
+    """
+    with open(file_name, 'r', encoding='utf-8') as f:
+        edges = json.load(f)
+
+    for definition in edges['classes']:
+        definition['bin_edges'] = np.array(definition['bin_edges'])
+        definition['edges'] = np.array(definition['edges'], dtype=float)
+        if 'edges_ci' in definition:
+            definition['edges_ci'] = np.array(definition['edges_ci'], dtype=float)
+
+    return edges
+
+
+def _drop_unmarked(data: pd.DataFrame, names: list) -> pd.DataFrame:
+    log = logging.getLogger(__name__)
+
+    unmarked = np.array([data[name].values == -1 for name in names])
+    for name, column in zip(names, unmarked):
+        if any(column):
+            log.warning(
+                "%d events are not marked in %s; "
+                "this may indicate the class metric "
+                "was not defined for them",
+                np.sum(column), name
+            )
+
+    # The events are kept as long as any of their classes is defined
+    unmarked = unmarked.all(axis=0)
+    if any(unmarked):
+        log.warning("%d events not marked in any class will be dropped", np.sum(unmarked))
+        data = data[~unmarked]
+
+    return data
+
+
+def mkmarkup(
+    input_fname: str,
+    key: str,
+    ebinsdec: float,
+    cuts: str = '',
+    return_edges: bool = False,
+    classes: list = None,
+    n_bootstrap: int = 0,
+    merge_unstable: bool = False,
+    n_jobs: int = None,
+    seed: int = None
+) -> pd.DataFrame:
     """
     Marks up the PSF classes within the MC file.
 
@@ -17,6 +486,10 @@ def mkmarkup(input_fname: str, key: str, ebinsdec: float, cuts: str = '') -> pd.
     reconstructed event directions ("reco_src_x" and "reco_src_y"
     columns describing it in the telescope camera frame).
 
+    Other event classes (e.g. in energy resolution or gammaness) can
+    be requested with the "classes" definitions (see compute_edges()),
+    all of them being computed in a single pass.
+
     Parameters
     ----------
     input_fname: str
@@ -26,57 +499,77 @@ def mkmarkup(input_fname: str, key: str, ebinsdec: float, cuts: str = '') -> pd.
     ebinsdec: float
         number of true energy bins per dec to assume
     cuts: str
-        event cuts to apply
+        event cuts to apply; evaluated during the read where possible
+    return_edges: bool
+        whether to return the computed edge table too
+    classes: list
+        class definitions; defaults to the PSF classes (PSF_CLASS)
+    n_bootstrap: int
+        number of bootstrap resamples to estimate the confidence
+        intervals of the edges with; 0 skips them
+    merge_unstable: bool
+        whether to merge the bins with unstable edges (see compute_edges())
+    n_jobs: int
+        number of bins to bootstrap in parallel
+    seed: int
+        random seed of the bootstrap
 
     Returns
     -------
     df: pd.DataFrame
-        MC event list with the "psf_class" column
+        MC event list with the "psf_class" (or requested class) columns
+    edges: dict
+        edge table as returned by compute_edges();
+        only if "return_edges" is set
     """
+    data = read_events(input_fname, key, cuts)
 
-    log = logging.getLogger(__name__)
-    data = pd.read_hdf(input_fname, key=key)
-
-    if cuts:
-        data = data.query(cuts)
+    data.loc[:, 'reco_offset'] = reco_offset(data)
 
-    data.loc[:, 'reco_offset'] = 180 / np.pi * angular_separation(
-        data['mc_az'].values,
-        data['mc_alt'].values,
-        data["reco_az"].values,
-        data["reco_alt"].values,
+    edges = compute_edges(
+        data,
+        ebinsdec,
+        cuts,
+        classes,
+        n_bootstrap=n_bootstrap,
+        merge_unstable=merge_unstable,
+        n_jobs=n_jobs,
+        seed=seed
     )
-    data['psf_class'] = -1
+    marked = assign_classes(data, edges)
+    data = data.assign(**marked)
+    data = _drop_unmarked(data, list(marked))
 
-    energy_edges = 10**np.arange(
-        np.log10(data['mc_energy'].min()),
-        np.log10(data['mc_energy'].max()),
-        step=1 / ebinsdec
-    )
+    if return_edges:
+        return data, edges
 
-    energy_ids = np.digitize(data['mc_energy'], energy_edges)
+    return data
 
-    for energy_id in np.unique(energy_ids):
-        selection = energy_ids == energy_id
-        mid_edges = np.percentile(
-            data['reco_offset'][selection],
-            [25, 50, 75]
-        )
-        offset_edges = np.concatenate(
-            ([0], mid_edges, [np.inf])
-        )
-        psf_class = np.digitize(
-            data['reco_offset'][selection],
-            offset_edges
-        )
-        data.loc[selection, 'psf_class'] = psf_class
 
-    if any(data['psf_class'].values == -1):
-        log.warning(
-            "not marked events found and will be dropped; "
-            "this may indicate reconstructed offsets were "
-            "outside the [0;inf] range"
-        )
-        data = data.query('psf_class != -1')
+def apply_markup(data: pd.DataFrame, edges: dict) -> pd.DataFrame:
+    """
+    Marks up the event classes using the pre-computed edge table,
+    without re-computing the metric percentiles.
+
+    The cuts stored in the edge table are applied first.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        MC event list
+    edges: dict
+        edge table as returned by compute_edges() or load_edges()
+
+    Returns
+    -------
+    df: pd.DataFrame
+        MC event list with the class columns
+    """
+    if edges['cuts']:
+        data = data.query(edges['cuts'])
+
+    data = data.assign(reco_offset=reco_offset(data))
+    marked = assign_classes(data, edges)
+    data = data.assign(**marked)
 
-    return data
\ No newline at end of file
+    return _drop_unmarked(data, list(marked))
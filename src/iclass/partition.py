@@ -0,0 +1,385 @@
+"""Partitioned event datasets: the events are stored in a directory with
+one sub-directory per partition, e.g. "obs_id=<id>/class=<k>/", holding
+a file per input, along with an index of the partitions, their row counts
+and simulation configuration.
+
+The readers may thus open only the partitions they need, in parallel.
+"""
+
+import json
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from iclass.io import append_table, read_files, write_simulation_config
+
+# Name of the partition index file within the dataset directory
+INDEX_NAME = 'index.json'
+
+
+def partition_path(values: dict) -> str:
+    """
+    Relative path of the partition directory.
+
+    Parameters
+    ----------
+    values: dict
+        partition values by their labels, e.g. {"obs_id": 1, "class": 2}
+
+    Returns
+    -------
+    str:
+        path like "obs_id=1/class=2"
+    """
+    names = [f'{label}={value}' for label, value in values.items()]
+
+    return os.path.join(*names)
+
+
+def source_name(input_fname: str) -> str:
+    """
+    Name of the partition files written from the input file.
+
+    Parameters
+    ----------
+    input_fname: str
+        input file name
+
+    Returns
+    -------
+    str:
+        input file name without the directory and extension
+    """
+    return os.path.splitext(os.path.basename(input_fname))[0]
+
+
+def _write_partition(data: pd.DataFrame, file_name: str, key: str, complevel: int) -> None:
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    append_table(data, file_name, key, complevel)
+
+
+class PartitionWriter:
+    """
+    Writer of the events into a partitioned dataset.
+
+    The events of each input, possibly coming chunk by chunk, are grouped
+    by the partition columns and the groups are appended to the input files
+    of the partitions concurrently in a process pool (HDF5 serializes the
+    writes within a process). The pool is shared by all the inputs.
+
+    The inputs sharing a partition (e.g. several files of the same
+    observation) are written to separate files of the partition directory,
+    named after the inputs; those must thus be unique. The files of an
+    input processed again are replaced.
+
+    Parameters
+    ----------
+    directory: str
+        dataset directory
+    key: str
+        HDF5 key to write the events to
+    by: dict
+        partition columns by their labels used in the directory names,
+        e.g. {"obs_id": "obs_id", "class": "reco_psf_class"}
+    complevel: int
+        HDF5 data compression level
+    n_jobs: int
+        number of writer processes; defaults to the number of CPUs.
+        With n_jobs=1 the partitions are written in the calling process.
+
+    Example
+    -------
+    >>> with PartitionWriter('dataset', key, dict(obs_id='obs_id')) as writer:
+    ...     for input_fname in input_fnames:
+    ...         with atomic_outputs() as temporary:
+    ...             writer.start(input_fname, temporary)
+    ...             for chunk in iter_chunks(input_fname, key, chunk_size):
+    ...                 writer.write(chunk)
+    ...             entries = writer.finish(cfg, cfg_key)
+    ...         update_index('dataset', entries, key, cfg_key)
+    """
+
+    def __init__(self, directory: str, key: str, by: dict, complevel: int = 0, n_jobs: int = None):
+        self.directory = directory
+        self.key = key
+        self.by = dict(by)
+        self.complevel = complevel
+        self.sources = {}
+        self.start('')
+
+        self.pool = None
+        if n_jobs != 1:
+            # Forked workers could inherit the locks held by the other threads
+            # of this process (e.g. the iclass.pipeline reader), hence "forkserver"
+            self.pool = ProcessPoolExecutor(
+                max_workers=n_jobs,
+                mp_context=multiprocessing.get_context('forkserver')
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def start(self, input_fname: str, temporary=None) -> None:
+        """
+        Starts writing the events of the next input.
+
+        Parameters
+        ----------
+        input_fname: str
+            input file name
+        temporary: Callable
+            function mapping the partition file names to the temporary
+            ones to write to (see iclass.batch.atomic_outputs);
+            by default the files are written directly
+        """
+        self.input = os.path.abspath(input_fname) if input_fname else ''
+        self.source = source_name(input_fname)
+        self.temporary = temporary or (lambda file_name: file_name)
+        self.nrows = {}
+        self.values = {}
+
+        if not input_fname:
+            return
+
+        # Inputs of the same name would write to the same partition files
+        indexed = {
+            file_entry['source']: file_entry['input']
+            for entry in read_index(self.directory)['partitions']
+            for file_entry in entry['files']
+        }
+        other = self.sources.get(self.source, indexed.get(self.source, self.input))
+        if other != self.input:
+            raise ValueError(
+                f"partition files of {input_fname} would replace those of {other} of the same name"
+            )
+        self.sources[self.source] = self.input
+
+    def write(self, data: pd.DataFrame) -> None:
+        """
+        Appends the events of the current input to their partitions.
+
+        Parameters
+        ----------
+        data: pd.DataFrame
+            events including the partition columns
+        """
+        parts = []
+        file_names = []
+
+        for values, part in data.groupby(list(self.by.values()), sort=False):
+            values = dict(zip(self.by, np.atleast_1d(values).tolist()))
+            path = os.path.join(partition_path(values), f'{self.source}.h5')
+
+            parts.append(part)
+            # A stale temporary file is removed on its first mapping
+            file_names.append(self.temporary(os.path.join(self.directory, path)))
+
+            self.values[path] = values
+            self.nrows[path] = self.nrows.get(path, 0) + len(part)
+
+        args = (parts, file_names, [self.key] * len(parts), [self.complevel] * len(parts))
+        if self.pool is None:
+            list(map(_write_partition, *args))
+        else:
+            # Each partition is written by a single worker at a time;
+            # the next chunk is only dispatched once this one is written.
+            list(self.pool.map(_write_partition, *args))
+
+    def finish(self, cfg: pd.DataFrame = None, cfg_key: str = '') -> list:
+        """
+        Completes the partition files of the current input,
+        adding the simulation configuration.
+
+        Parameters
+        ----------
+        cfg: pd.DataFrame
+            simulation configuration; if it has an "obs_id" column and the
+            events are partitioned by "obs_id", only the rows of the partition
+            observation are written to and listed for each partition file
+        cfg_key: str
+            HDF5 key to write the configuration to
+
+        Returns
+        -------
+        entries: list
+            index entries of the written partition files (see update_index())
+        """
+        entries = []
+
+        for path, nrows in self.nrows.items():
+            values = self.values[path]
+            entry = dict(path=path, **values, input=self.input, source=self.source, nrows=nrows)
+
+            if cfg is not None:
+                rows = cfg
+                if 'obs_id' in cfg and 'obs_id' in values:
+                    rows = cfg[cfg['obs_id'] == values['obs_id']]
+                write_simulation_config(rows, self.temporary(os.path.join(self.directory, path)), cfg_key)
+                entry['run_config'] = json.loads(rows.to_json(orient='records'))
+
+            entries.append(entry)
+
+        return entries
+
+
+def read_index(directory: str) -> dict:
+    """
+    Reads the partition index of the dataset.
+
+    Parameters
+    ----------
+    directory: str
+        dataset directory
+
+    Returns
+    -------
+    index: dict
+        "key" and "cfg_key" - HDF5 keys of the events and configuration;
+        "partitions" - list of the partition entries with the directory
+        "path", partition values, total "nrows" and the "files" entries
+        with the "path", "input", "source", "nrows" and "run_config"
+        fields of the partition files
+    """
+    file_name = os.path.join(directory, INDEX_NAME)
+    if not os.path.exists(file_name):
+        return dict(partitions=[])
+
+    with open(file_name, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def update_index(directory: str, entries: list, key: str, cfg_key: str = '') -> dict:
+    """
+    Adds the partition files to the dataset index, replacing the entries
+    of the same files and summing up the row counts of the partitions.
+    The files of the same inputs not written anymore are removed.
+
+    The index is replaced atomically, so that the readers only see
+    the completely written partitions.
+
+    Parameters
+    ----------
+    directory: str
+        dataset directory
+    entries: list
+        partition file entries as returned by PartitionWriter.finish()
+    key: str
+        HDF5 key of the events
+    cfg_key: str
+        HDF5 key of the simulation configuration
+
+    Returns
+    -------
+    index: dict
+        updated index
+    """
+    partitions = {entry['path']: entry for entry in read_index(directory)['partitions']}
+
+    # Files left from a previous run of the same inputs in the other partitions
+    inputs = {entry['input'] for entry in entries}
+    paths = {entry['path'] for entry in entries}
+    for partition in partitions.values():
+        stale = [
+            file_entry for file_entry in partition['files']
+            if file_entry['input'] in inputs and file_entry['path'] not in paths
+        ]
+        for file_entry in stale:
+            partition['files'].remove(file_entry)
+            if os.path.exists(os.path.join(directory, file_entry['path'])):
+                os.remove(os.path.join(directory, file_entry['path']))
+        partition['nrows'] = sum(file_entry['nrows'] for file_entry in partition['files'])
+
+    for entry in entries:
+        path = os.path.dirname(entry['path'])
+        labels = {
+            label: value for label, value in entry.items()
+            if label not in ('path', 'input', 'source', 'nrows', 'run_config')
+        }
+        partition = partitions.setdefault(path, dict(path=path, **labels, nrows=0, files=[]))
+
+        files = {file_entry['path']: file_entry for file_entry in partition['files']}
+        files[entry['path']] = {
+            name: value for name, value in entry.items() if name not in labels
+        }
+        partition['files'] = [files[file_path] for file_path in sorted(files)]
+        partition['nrows'] = sum(file_entry['nrows'] for file_entry in partition['files'])
+
+    index = dict(
+        key=key,
+        cfg_key=cfg_key,
+        partitions=[partitions[path] for path in sorted(partitions) if partitions[path]['files']],
+    )
+
+    os.makedirs(directory, exist_ok=True)
+    file_name = os.path.join(directory, INDEX_NAME)
+    with open(file_name + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+    os.replace(file_name + '.tmp', file_name)
+
+    return index
+
+
+def select_partitions(directory: str, selection: dict = None) -> list:
+    """
+    Selects the dataset partitions from its index.
+
+    Parameters
+    ----------
+    directory: str
+        dataset directory
+    selection: dict
+        partition values to select by their labels; either single
+        values or lists of them, e.g. {"obs_id": [1, 2], "class": 3}.
+        Defaults to all the partitions.
+
+    Returns
+    -------
+    file_names: list
+        files of the selected partitions
+    """
+    selection = {
+        label: values if isinstance(values, (list, tuple, set)) else [values]
+        for label, values in (selection or {}).items()
+    }
+
+    file_names = [
+        os.path.join(directory, file_entry['path'])
+        for entry in read_index(directory)['partitions']
+        if all(entry.get(label) in values for label, values in selection.items())
+        for file_entry in entry['files']
+    ]
+
+    return file_names
+
+
+def read_partitions(directory: str, selection: dict = None, cuts: str = '', n_jobs: int = None) -> pd.DataFrame:
+    """
+    Reads the selected dataset partitions in parallel.
+
+    Parameters
+    ----------
+    directory: str
+        dataset directory
+    selection: dict
+        partition values to select (see select_partitions())
+    cuts: str
+        event cuts to apply
+    n_jobs: int
+        number of reader processes; defaults to the number of CPUs
+
+    Returns
+    -------
+    events: pd.DataFrame
+        events of the selected partitions
+    """
+    key = read_index(directory).get('key')
+    file_names = select_partitions(directory, selection)
+
+    return read_files(file_names, key, cuts, n_jobs=n_jobs)
@@ -0,0 +1,159 @@
+"""Producer/consumer pipeline overlapping the reading, processing
+and writing of data chunks.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def _put(target: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+    Put the item to the bounded queue unless the pipeline is being stopped.
+
+    Returns
+    -------
+    bool:
+        whether the item was queued
+    """
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def run_pipeline(
+    chunks: Iterable,
+    process: Callable,
+    write: Callable,
+    maxsize: int = 2
+) -> int:
+    """
+    Process the data chunks with the reading, processing
+    and writing stages running concurrently.
+
+    A reader thread prefetches the next chunks from the "chunks" iterable,
+    the calling thread applies "process" to the current chunk and a writer
+    thread passes the previous results to "write". The stages exchange
+    the chunks through queues of the limited size, so that at most
+    about 2 * (maxsize + 1) chunks are held in memory at a time.
+
+    The stages overlap as far as they release the GIL, e.g. during the
+    forest prediction with several jobs. The HDF5 calls, including the
+    (de)compression, are serialized within a process (see iclass.io.HDF5_LOCK):
+    for the writes to overlap the reads, "write" should pass the data to
+    another process, e.g. with iclass.io.AppendProcess. The total run time
+    then approaches that of the slowest stage.
+
+    An exception raised in any of the stages stops the pipeline
+    and is re-raised in the calling thread.
+
+    Parameters
+    ----------
+    chunks: Iterable
+        data chunks to process; iterated in the reader thread
+    process: Callable
+        function to apply to each chunk
+    write: Callable
+        function to pass the processed chunks to; called in the writer thread
+    maxsize: int
+        maximal number of chunks waiting in each of the queues
+
+    Returns
+    -------
+    int:
+        number of processed chunks
+    """
+    read_queue = queue.Queue(maxsize=maxsize)
+    write_queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    errors = []
+    timing = dict(read=0.0, process=0.0, write=0.0)
+
+    def reader():
+        iterator = iter(chunks)
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = next(iterator, _DONE)
+                timing['read'] += time.perf_counter() - start
+                if chunk is _DONE or not _put(read_queue, chunk, stop):
+                    break
+        except Exception as exc:
+            errors.append(exc)
+            stop.set()
+        _put(read_queue, _DONE, stop)
+
+    def writer():
+        while True:
+            result = write_queue.get()
+            if result is _DONE:
+                break
+            # After a failure the queue is only drained
+            if errors:
+                continue
+            try:
+                start = time.perf_counter()
+                write(result)
+                timing['write'] += time.perf_counter() - start
+            except Exception as exc:
+                errors.append(exc)
+                stop.set()
+
+    threads = [
+        threading.Thread(target=reader, name='iclass-reader', daemon=True),
+        threading.Thread(target=writer, name='iclass-writer', daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    nchunks = 0
+    total_start = time.perf_counter()
+    try:
+        while not stop.is_set():
+            try:
+                chunk = read_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chunk is _DONE:
+                break
+
+            start = time.perf_counter()
+            result = process(chunk)
+            timing['process'] += time.perf_counter() - start
+
+            if not _put(write_queue, result, stop):
+                break
+            nchunks += 1
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        # The writer keeps draining its queue until it gets the sentinel
+        write_queue.put(_DONE)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    logger.info(
+        "processed %d chunks in %.1f s (read %.1f s, process %.1f s, write %.1f s)",
+        nchunks,
+        time.perf_counter() - total_start,
+        timing['read'],
+        timing['process'],
+        timing['write'],
+    )
+
+    return nchunks
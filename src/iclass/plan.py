@@ -0,0 +1,342 @@
+"""Resource planning: choice of the chunk sizes and the numbers of
+parallel workers from the CPUs and memory available to the job -
+including the cgroup limits of the batch systems and containers -
+and the sizes of the input tables.
+"""
+
+import logging
+import math
+import os
+import pandas as pd
+
+from tables import Table, open_file
+
+from iclass.io import HDF5_LOCK, table_nrows
+
+logger = logging.getLogger(__name__)
+
+# Tasks the resources can be planned for
+TASKS = ('markup', 'split', 'train', 'apply', 'validate')
+
+# Approximate number of the copies of the events held in memory while
+# processing them: e.g. the read table, the float32 feature block,
+# the predictions and the records being written
+MEMORY_OVERHEAD = 4
+
+# Share of the available memory the plan may use
+MEMORY_FRACTION = 0.5
+
+# Chunk size limits, events
+MIN_CHUNK_SIZE = 10_000
+MAX_CHUNK_SIZE = 10_000_000
+
+
+def _read_first_line(file_name: str) -> str:
+    try:
+        with open(file_name, 'r', encoding='utf-8') as f:
+            return f.readline().strip()
+    except OSError:
+        return ''
+
+
+def cgroup_dirs(controller: str, cgroup_root: str = '/sys/fs/cgroup', proc_cgroup: str = '/proc/self/cgroup') -> list:
+    """
+    Directories of the cgroups the process belongs to, from its own
+    (e.g. the batch job step) up to the root one, for the controller.
+
+    The batch systems (e.g. Slurm, HTCondor) place the jobs in the nested
+    cgroups, with the job limits set in one of them, so the limit files
+    of all these directories apply.
+
+    Parameters
+    ----------
+    controller: str
+        cgroup v1 controller name, e.g. "cpu" or "memory";
+        not used for the cgroup v2 unified hierarchy
+    cgroup_root: str
+        cgroup file system mount point
+    proc_cgroup: str
+        cgroup membership file of the process
+
+    Returns
+    -------
+    list:
+        existing cgroup directories, the innermost first
+    """
+    paths = {}
+    try:
+        with open(proc_cgroup, 'r', encoding='utf-8') as f:
+            for line in f:
+                hierarchy, _, rest = line.strip().partition(':')
+                controllers, _, path = rest.partition(':')
+                if hierarchy == '0' and not controllers:
+                    paths['v2'] = path
+                elif controller in controllers.split(','):
+                    paths['v1'] = (controllers, path)
+    except OSError:
+        pass
+
+    if 'v1' in paths and not os.path.exists(os.path.join(cgroup_root, 'cgroup.controllers')):
+        controllers, path = paths['v1']
+        # v1 controllers are mounted as e.g. "cpu,cpuacct" with a "cpu" link
+        base = os.path.join(cgroup_root, controllers)
+        if not os.path.isdir(base):
+            base = os.path.join(cgroup_root, controller)
+    elif 'v2' in paths:
+        base, path = cgroup_root, paths['v2']
+    else:
+        # Unknown membership: the root cgroups of both versions
+        dirs = [cgroup_root, os.path.join(cgroup_root, controller)]
+        return [directory for directory in dirs if os.path.isdir(directory)]
+
+    dirs = []
+    parts = [part for part in path.split('/') if part]
+    for depth in range(len(parts), -1, -1):
+        directory = os.path.join(base, *parts[:depth])
+        # In a container the cgroup of the process may be the mount root itself
+        if os.path.isdir(directory) and directory not in dirs:
+            dirs.append(directory)
+
+    return dirs
+
+
+def available_cpus(cgroup_root: str = '/sys/fs/cgroup', proc_cgroup: str = '/proc/self/cgroup') -> int:
+    """
+    Number of CPUs available to the process, accounting for the CPU
+    affinity and the CPU quotas of the cgroups it belongs to.
+
+    Parameters
+    ----------
+    cgroup_root: str
+        cgroup file system mount point
+    proc_cgroup: str
+        cgroup membership file of the process
+
+    Returns
+    -------
+    int:
+        number of CPUs, at least 1
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+
+    for directory in cgroup_dirs('cpu', cgroup_root, proc_cgroup):
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        quota, _, period = _read_first_line(os.path.join(directory, 'cpu.max')).partition(' ')
+        if not quota:
+            # cgroup v1
+            quota = _read_first_line(os.path.join(directory, 'cpu.cfs_quota_us'))
+            period = _read_first_line(os.path.join(directory, 'cpu.cfs_period_us'))
+
+        try:
+            quota, period = int(quota), int(period)
+        except ValueError:
+            continue
+
+        if quota > 0 and period > 0:
+            cpus = min(cpus, math.ceil(quota / period))
+
+    return max(cpus, 1)
+
+
+def available_memory(
+    cgroup_root: str = '/sys/fs/cgroup',
+    meminfo: str = '/proc/meminfo',
+    proc_cgroup: str = '/proc/self/cgroup'
+) -> int:
+    """
+    Memory available to the process: the smallest of the system available
+    memory and the remaining memory limits of the cgroups it belongs to.
+
+    Parameters
+    ----------
+    cgroup_root: str
+        cgroup file system mount point
+    meminfo: str
+        system memory information file
+    proc_cgroup: str
+        cgroup membership file of the process
+
+    Returns
+    -------
+    int:
+        available memory, bytes; None if unknown
+    """
+    available = []
+
+    try:
+        with open(meminfo, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+
+    for directory in cgroup_dirs('memory', cgroup_root, proc_cgroup):
+        # cgroup v2 and v1 limits along with the current usage
+        for limit_name, usage_name in (
+            ('memory.max', 'memory.current'),
+            ('memory.limit_in_bytes', 'memory.usage_in_bytes'),
+        ):
+            limit = _read_first_line(os.path.join(directory, limit_name))
+            if not limit.isdigit():
+                continue
+
+            usage = _read_first_line(os.path.join(directory, usage_name))
+            usage = int(usage) if usage.isdigit() else 0
+            # cgroup v1 reports "no limit" as a huge number
+            if int(limit) < 2**60:
+                available.append(max(int(limit) - usage, 0))
+            break
+
+    return min(available) if available else None
+
+
+def table_row_width(file_name: str, key: str) -> int:
+    """
+    Size of the table row from the HDF5 metadata, reading
+    at most a single row for the pandas fixed format tables.
+
+    Parameters
+    ----------
+    file_name: str
+        HDF5 file to read.
+    key: str
+        HDF key of the table.
+
+    Returns
+    -------
+    int:
+        row size, bytes
+    """
+    key = '/' + key.strip('/')
+
+    with HDF5_LOCK, open_file(file_name) as file:
+        node = file.get_node(key)
+        if isinstance(node, Table):
+            return node.rowsize
+
+    with HDF5_LOCK, pd.HDFStore(file_name, mode='r') as store:
+        storer = store.get_storer(key)
+        if storer.is_table:
+            return storer.table.rowsize
+
+        row = store.select(key, start=0, stop=1)
+
+    return int(row.memory_usage(index=False).sum())
+
+
+def plan_resources(
+    task: str,
+    file_names: list,
+    key: str,
+    cpus: int = None,
+    memory: int = None,
+    catalog=None,
+    queue_size: int = None
+) -> dict:
+    """
+    Chooses the chunk size and the numbers of workers for the task.
+
+    - "apply", "markup" (with the pre-computed edges) and "validate"
+      stream the files in chunks: the chunk size is chosen so that the
+      chunks in flight in all the workers fit into the memory budget.
+      For "apply" the CPUs are shared between the pipeline stages: the
+      reader thread, the writers ("n_jobs" partition writer processes or
+      the writer thread) and the random forest threads take the rest;
+    - "split" and "train" hold complete files (or the whole training set)
+      in memory: the number of the parallel files is limited by the budget,
+      and a warning is issued if a single file (or the training set)
+      does not fit.
+
+    Parameters
+    ----------
+    task: str
+        one of TASKS
+    file_names: list
+        input files
+    key: str
+        HDF key of the event tables
+    cpus: int
+        number of CPUs; defaults to available_cpus()
+    memory: int
+        available memory, bytes; defaults to available_memory()
+    catalog: iclass.catalog.Catalog
+        catalog to take the table sizes and row widths from
+        instead of opening the files; optional
+    queue_size: int
+        number of chunks queued between the pipeline stages
+        (see iclass.pipeline.run_pipeline()) to fit the chunk size to;
+        defaults to 2
+
+    Returns
+    -------
+    plan: dict
+        "cpus" and "memory" - resources assumed;
+        "chunk_size" - number of events to process at a time;
+        "n_jobs" - number of parallel file reader / writer processes
+        (for "apply" - the partition writer processes);
+        "queue_size" - number of chunks queued between the pipeline stages,
+        to be passed to run_pipeline();
+        "rf_n_jobs" - number of the random forest threads
+    """
+    if task not in TASKS:
+        raise ValueError(f"unknown task '{task}', expected one of {TASKS}")
+
+    cpus = cpus or available_cpus()
+    memory = memory or available_memory() or 4 * 1024**3
+    budget = MEMORY_FRACTION * memory
+
+    nrows = []
+    width = None
+    for file_name in file_names:
+        entry = catalog.get(file_name, key) if catalog is not None else None
+        nrows.append(entry['nrows'] if entry else table_nrows(file_name, key))
+        if width is None and entry:
+            width = entry.get('row_width')
+
+    # The tables of a production share the columns
+    if width is None:
+        width = table_row_width(file_names[0], key) if file_names else 1
+    max_nrows = max(nrows, default=0)
+    file_size = max_nrows * width * MEMORY_OVERHEAD
+
+    plan = dict(cpus=cpus, memory=memory, queue_size=queue_size or 2, rf_n_jobs=cpus)
+
+    if task in ('split', 'train'):
+        # Whole files are held in memory by each of the workers
+        n_jobs = int(budget // max(file_size, 1))
+        plan['n_jobs'] = max(1, min(cpus, len(file_names), n_jobs))
+        plan['chunk_size'] = 0
+
+        total = sum(nrows) * width * MEMORY_OVERHEAD if task == 'train' else file_size
+        if total > budget:
+            logger.warning(
+                "%s needs about %.1f GB while %.1f GB are available",
+                task, total / 1024**3, budget / 1024**3
+            )
+    else:
+        if task == 'validate':
+            n_jobs = max(1, min(cpus, len(file_names)))
+            in_flight = n_jobs
+        else:
+            n_jobs = max(1, cpus // 4)
+            # The reader thread and the writers run alongside the forest
+            plan['rf_n_jobs'] = max(1, cpus - n_jobs - 1)
+            # Chunks in the reader and writer queues and in each stage
+            in_flight = 2 * plan['queue_size'] + 3
+
+        chunk_size = int(budget // (in_flight * width * MEMORY_OVERHEAD))
+        plan['n_jobs'] = n_jobs
+        plan['chunk_size'] = max(MIN_CHUNK_SIZE, min(chunk_size, MAX_CHUNK_SIZE, max(max_nrows, 1)))
+
+    logger.info(
+        "%s plan for %d files (%d events, %d bytes per event) with %d CPUs and %.1f GB: "
+        "chunk size %d, %d jobs, %d forest jobs",
+        task, len(file_names), sum(nrows), width, cpus, memory / 1024**3,
+        plan['chunk_size'], plan['n_jobs'], plan['rf_n_jobs']
+    )
+
+    return plan
@@ -0,0 +1,192 @@
+"""Re-labelling of the classified events from their stored class
+probabilities: the class assignment rules (e.g. a minimal probability
+of the best class or merging of the classes) are applied to the
+probability columns written by apply_rf(), without the random forest.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Prefix of the class probability columns, appended with the class value
+PROBA_PREFIX = 'reco_psf_proba_'
+
+# Data types the probabilities may be stored with
+PROBA_DTYPES = ('uint8', 'float16')
+
+# Largest quantized uint8 probability, corresponding to 1
+_UINT8_SCALE = np.iinfo(np.uint8).max
+
+
+def proba_columns(classes) -> list:
+    """
+    Names of the class probability columns.
+
+    Parameters
+    ----------
+    classes: array-like
+        class values
+
+    Returns
+    -------
+    list:
+        column names like "reco_psf_proba_0"
+    """
+    return [f'{PROBA_PREFIX}{value}' for value in classes]
+
+
+def quantize_proba(proba: np.ndarray, dtype: str) -> np.ndarray:
+    """
+    Quantizes the class probabilities for the storage.
+
+    Parameters
+    ----------
+    proba: np.ndarray
+        probabilities in [0, 1]
+    dtype: str
+        one of PROBA_DTYPES: "uint8" stores the probabilities in
+        steps of 1/255, "float16" with 11 significant bits
+
+    Returns
+    -------
+    np.ndarray:
+        quantized probabilities
+    """
+    if dtype == 'uint8':
+        return np.rint(np.asarray(proba) * _UINT8_SCALE).astype(np.uint8)
+    if dtype == 'float16':
+        return np.asarray(proba, dtype=np.float16)
+
+    raise ValueError(f"unsupported probability data type '{dtype}', expected one of {PROBA_DTYPES}")
+
+
+def dequantize_proba(values: np.ndarray) -> np.ndarray:
+    """
+    Restores the probabilities from their quantized values.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        quantized probabilities (see quantize_proba())
+
+    Returns
+    -------
+    np.ndarray:
+        float32 probabilities
+    """
+    values = np.asarray(values)
+    if values.dtype == np.uint8:
+        return values.astype(np.float32) / _UINT8_SCALE
+
+    return values.astype(np.float32)
+
+
+def read_proba(data: pd.DataFrame) -> tuple:
+    """
+    Extracts the class probabilities from the event data frame.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        events with the class probability columns
+
+    Returns
+    -------
+    classes: np.ndarray
+        class values, sorted
+    proba: np.ndarray
+        float32 probabilities of shape (n_events, n_classes)
+    """
+    names = [name for name in data.columns if name.startswith(PROBA_PREFIX)]
+    if not names:
+        raise KeyError(f"no class probability columns '{PROBA_PREFIX}*' in the data")
+
+    classes = np.array([int(name[len(PROBA_PREFIX):]) for name in names])
+    order = np.argsort(classes)
+
+    proba = np.empty((len(data), len(names)), dtype=np.float32)
+    for i, index in enumerate(order):
+        proba[:, i] = dequantize_proba(data[names[index]].values)
+
+    return classes[order], proba
+
+
+def relabel(
+    data: pd.DataFrame,
+    merge: dict = None,
+    min_proba: float | dict = 0,
+    fallback: int = -1,
+    column: str = 'reco_psf_class'
+) -> pd.DataFrame:
+    """
+    Assigns the event classes from the stored class probabilities.
+
+    The rules are applied in order:
+    - "merge" maps the classes to the ones they are merged into, e.g.
+      {4: 3}; the probabilities of the merged classes are summed up;
+    - the event is assigned the class of the highest probability;
+    - if that probability is below "min_proba" (either a single value
+      or the values by class), the event is assigned the "fallback" class.
+
+    The classes tied within the quantization step are resolved in favour
+    of the class already stored in the data (merged the same way), so
+    that with no rules the stored prediction is reproduced.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        events with the class probability columns
+    merge: dict
+        classes to merge by the classes to merge them into
+    min_proba: float | dict
+        minimal probability of the assigned class
+    fallback: int
+        class of the events failing the "min_proba" threshold
+    column: str
+        column to store the classes in
+
+    Returns
+    -------
+    pd.DataFrame:
+        data frame with the updated class column
+    """
+    classes, proba = read_proba(data)
+    merge = {int(source): int(target) for source, target in (merge or {}).items()}
+
+    if merge:
+        targets = np.array([merge.get(value, value) for value in classes])
+        merged = np.unique(targets)
+        # Probabilities of the classes merged into the same target are summed up
+        merged_proba = np.zeros((len(data), len(merged)), dtype=np.float32)
+        for i, j in enumerate(np.searchsorted(merged, targets)):
+            merged_proba[:, j] += proba[:, i]
+        classes, proba = merged, merged_proba
+
+    rows = np.arange(len(data))
+    best = np.argmax(proba, axis=1)
+
+    if column in data:
+        # The stored prediction comes from the unquantized probabilities
+        stored = data[column].values
+        mapped = stored.copy()
+        for source, target in merge.items():
+            mapped[stored == source] = target
+        stored = mapped
+
+        index = np.clip(np.searchsorted(classes, stored), 0, len(classes) - 1)
+        tied = (classes.take(index) == stored) & (proba[rows, index] == proba[rows, best])
+        best = np.where(tied, index, best)
+
+    labels = classes.take(best)
+
+    if isinstance(min_proba, dict):
+        min_proba = {int(value): float(threshold) for value, threshold in min_proba.items()}
+        thresholds = np.array([min_proba.get(value, 0) for value in classes])
+        threshold = thresholds.take(best)
+    else:
+        threshold = min_proba
+
+    labels = np.where(proba[rows, best] < threshold, fallback, labels)
+
+    data.loc[:, column] = labels
+
+    return data
@@ -2,16 +2,385 @@
 module.
 """
 
+import copy
 import logging
+import os
+import joblib
+import numexpr
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from sklearn.ensemble import RandomForestClassifier
 
+from iclass.relabel import proba_columns, quantize_proba
+
 logger = logging.getLogger(__name__)
 
 
+def parse_features(features: list) -> tuple:
+    """
+    Parses the list of the RF features, which may include the
+    derived features given as "name = expression", e.g.
+    "log_intensity = log10(intensity)".
+
+    The expressions are evaluated with numexpr (see feature_frame()),
+    so the derived features need not be stored in the event files.
+
+    Parameters
+    ----------
+    features: list
+        feature column names or definitions
+
+    Returns
+    -------
+    names: list
+        feature names
+    expressions: dict
+        expressions of the derived features by their names
+    """
+    names = []
+    expressions = {}
+
+    for feature in features:
+        name, sep, expression = feature.partition('=')
+        name = name.strip()
+
+        # "==" is a comparison within an expression, not a definition
+        if sep and name.isidentifier() and not expression.startswith('='):
+            expressions[name] = expression.strip()
+        else:
+            name = feature.strip()
+
+        names.append(name)
+
+    return names, expressions
+
+
+def feature_frame(data: pd.DataFrame, features: list, expressions: dict = None) -> pd.DataFrame:
+    """
+    Builds the RF feature matrix, evaluating the derived features.
+
+    The features are written into a single preallocated float32 block
+    in the column-major order - the layout the scikit-learn trees work
+    with - so that no further conversion copies are needed. The derived
+    features are evaluated with numexpr straight into the block.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        events with the feature columns and the columns
+        used in the derived feature expressions
+    features: list
+        feature names
+    expressions: dict
+        expressions of the derived features by their names
+
+    Returns
+    -------
+    pd.DataFrame:
+        feature values, backed by the float32 block
+    """
+    expressions = expressions or {}
+    block = np.empty((len(data), len(features)), dtype=np.float32, order='F')
+    columns = None
+
+    for i, name in enumerate(features):
+        if name in expressions:
+            if columns is None:
+                columns = {column: data[column].values for column in data.columns}
+            numexpr.evaluate(expressions[name], local_dict=columns, out=block[:, i], casting='unsafe')
+        else:
+            block[:, i] = data[name].values
+
+    return pd.DataFrame(block, columns=list(features), index=data.index, copy=False)
+
+
+def _feature_expressions(rf) -> dict:
+    """Derived feature expressions stored on the model, if any."""
+    expressions = getattr(rf, 'feature_expressions_', None)
+    return expressions if isinstance(expressions, dict) else {}
+
+
+# Allowance for the round-off errors of the summed tree
+# probabilities in the early stopping criterion
+_MARGIN_TOLERANCE = 1e-9
+
+
+def predict_early(
+    forest: RandomForestClassifier,
+    X: pd.DataFrame,
+    block_size: int = 10
+) -> tuple:
+    """
+    Predicts the event classes evaluating the trees in blocks and stopping
+    for each event once its class can not change anymore.
+
+    The forest class is the one with the largest probability summed over
+    the trees. Each tree adds at most 1 to the sum of any class, so once the
+    lead of the top class over the runner-up exceeds the number of trees
+    left, the remaining trees can not overturn it and the event is dropped
+    from the evaluation. The predictions are thus the same as those of
+    forest.predict(), with most events needing only a fraction of the trees.
+
+    The trees of a block are evaluated in "forest.n_jobs" threads,
+    so the blocks should be at least as large as the number of threads.
+
+    Parameters
+    ----------
+    forest: RandomForestClassifier
+        trained single-output forest
+    X: pd.DataFrame
+        events with the forest feature columns
+    block_size: int
+        number of trees to evaluate between the checks of the margins
+
+    Returns
+    -------
+    prediction: np.ndarray
+        predicted classes
+    n_trees: np.ndarray
+        number of trees evaluated per event
+    """
+    # Trees work in float32; converting once avoids a copy per tree
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    trees = forest.estimators_
+
+    proba = np.zeros((len(X), len(forest.classes_)))
+    n_trees = np.zeros(len(X), dtype=np.int32)
+    active = np.arange(len(X))
+
+    parallel = Parallel(n_jobs=forest.n_jobs, prefer='threads')
+
+    for start in range(0, len(trees), block_size):
+        X_active = X[active]
+        proba_active = proba[active]
+
+        tree_proba = parallel(
+            delayed(tree.predict_proba)(X_active, check_input=False)
+            for tree in trees[start:start + block_size]
+        )
+        # Summed tree by tree in the forest order, as in forest.predict()
+        for values in tree_proba:
+            proba_active += values
+
+        proba[active] = proba_active
+        n_trees[active] = min(start + block_size, len(trees))
+        remaining = len(trees) - start - block_size
+
+        if remaining <= 0 or proba.shape[1] < 2:
+            break
+
+        top = np.partition(proba_active, -2, axis=1)
+        margin = top[:, -1] - top[:, -2]
+        active = active[margin <= remaining + _MARGIN_TOLERANCE]
+
+        if len(active) == 0:
+            break
+
+    prediction = forest.classes_.take(np.argmax(proba, axis=1))
+
+    return prediction, n_trees
+
+
+class PointingBinnedForest:
+    """
+    Set of random forests, each trained on the events
+    of a single telescope pointing bin.
+
+    The pointing bins are defined by the edges of the pointing variables
+    (e.g. "alt_tel" and "sin_az_tel"); events outside of the edges are
+    assigned to the outermost bins. Bins without training events use
+    the forest of the nearest trained bin.
+
+    The ensemble mimics the RandomForestClassifier interface used in this
+    module ("feature_names_in_", "feature_importances_", "classes_"
+    and "predict"), so that it can be stored and applied in the same way.
+
+    Parameters
+    ----------
+    binning: dict
+        pointing variable names and the corresponding bin edges
+    features: list
+        features to train the forests with
+    classifier_args: dict
+        keyword arguments of the individual RandomForestClassifier instances
+    """
+
+    def __init__(self, binning: dict, features: list, classifier_args: dict = None):
+        self.binning = {name: np.asarray(edges) for name, edges in binning.items()}
+        self.features = list(features)
+        self.classifier_args = dict(classifier_args or {})
+
+        self.feature_names_in_ = np.array(
+            self.features + [name for name in self.binning if name not in self.features],
+            dtype=object
+        )
+        self.shape = tuple(len(edges) - 1 for edges in self.binning.values())
+
+    def bin_ids(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Computes the flat pointing bin indices of the events.
+
+        Parameters
+        ----------
+        X: pd.DataFrame
+            events with the pointing variable columns
+
+        Returns
+        -------
+        np.ndarray:
+            flat pointing bin indices
+        """
+        ids = [
+            np.digitize(X[name].values, edges[1:-1])
+            for name, edges in self.binning.items()
+        ]
+
+        return np.ravel_multi_index(ids, self.shape)
+
+    def fit(self, X: pd.DataFrame, y: pd.Series, n_jobs: int = None):
+        """
+        Trains the forests of all populated pointing bins in parallel.
+
+        Parameters
+        ----------
+        X: pd.DataFrame
+            training events with the feature and pointing variable columns
+        y: pd.Series
+            training event classes
+        n_jobs: int
+            number of forests to train in parallel;
+            each forest is trained with a single job
+
+        Returns
+        -------
+        self
+        """
+        bin_ids = self.bin_ids(X)
+        trained = np.unique(bin_ids)
+        y = np.asarray(y)
+
+        def fit_bin(bin_id):
+            selection = bin_ids == bin_id
+            model = RandomForestClassifier(**{**self.classifier_args, 'n_jobs': 1})
+            model.fit(X.loc[selection, self.features], y[selection])
+            model.set_params(n_jobs=self.classifier_args.get('n_jobs'))
+            return model
+
+        models = Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(fit_bin)(bin_id) for bin_id in trained
+        )
+        self.models_ = list(models)
+        self.n_events_ = np.array([np.sum(bin_ids == bin_id) for bin_id in trained])
+        self.classes_ = np.unique(y)
+
+        # Nearest trained bin (in the bin index space) for every bin
+        grid = np.indices(self.shape).reshape(len(self.shape), -1).T
+        trained_grid = grid[trained]
+        distance = np.sum((grid[:, None, :] - trained_grid[None, :, :])**2, axis=-1)
+        self.bin_models_ = np.argmin(distance, axis=1)
+
+        return self
+
+    @property
+    def feature_importances_(self) -> np.ndarray:
+        """Feature importances averaged over the forests,
+        weighted with their training event counts."""
+        importances = np.average(
+            [model.feature_importances_ for model in self.models_],
+            axis=0,
+            weights=self.n_events_
+        )
+        return importances
+
+    def _model_groups(self, X: pd.DataFrame):
+        """Yields the forests along with the positions of their events."""
+        model_ids = self.bin_models_[self.bin_ids(X)]
+
+        # Group the events by model with a single sort
+        order = np.argsort(model_ids, kind='stable')
+        sorted_ids = model_ids[order]
+        starts = np.flatnonzero(np.diff(sorted_ids, prepend=-1))
+        stops = np.append(starts[1:], len(sorted_ids))
+
+        for start, stop in zip(starts, stops):
+            yield self.models_[sorted_ids[start]], order[start:stop]
+
+    def predict(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Predicts the event classes with the forests of their pointing bins.
+
+        Parameters
+        ----------
+        X: pd.DataFrame
+            events with the feature and pointing variable columns
+
+        Returns
+        -------
+        np.ndarray:
+            predicted classes
+        """
+        prediction = np.empty(len(X), dtype=self.classes_.dtype)
+        for model, rows in self._model_groups(X):
+            prediction[rows] = model.predict(X.iloc[rows][self.features])
+
+        return prediction
+
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Predicts the class probabilities with the forests of their pointing bins.
+
+        Parameters
+        ----------
+        X: pd.DataFrame
+            events with the feature and pointing variable columns
+
+        Returns
+        -------
+        np.ndarray:
+            probabilities of shape (n_events, n_classes), with
+            the classes ordered as in "classes_"
+        """
+        proba = np.zeros((len(X), len(self.classes_)))
+        for model, rows in self._model_groups(X):
+            # A bin forest may lack some of the classes
+            columns = np.searchsorted(self.classes_, model.classes_)
+            proba[np.ix_(rows, columns)] = model.predict_proba(X.iloc[rows][self.features])
+
+        return proba
+
+    def predict_early(self, X: pd.DataFrame, block_size: int = 10) -> tuple:
+        """
+        Predicts the event classes with the forests of their pointing
+        bins, stopping the tree evaluation early (see predict_early()).
+
+        Parameters
+        ----------
+        X: pd.DataFrame
+            events with the feature and pointing variable columns
+        block_size: int
+            number of trees to evaluate between the checks of the margins
+
+        Returns
+        -------
+        prediction: np.ndarray
+            predicted classes
+        n_trees: np.ndarray
+            number of trees evaluated per event
+        """
+        prediction = np.empty(len(X), dtype=self.classes_.dtype)
+        n_trees = np.empty(len(X), dtype=np.int32)
+        for model, rows in self._model_groups(X):
+            prediction[rows], n_trees[rows] = predict_early(
+                model, X.iloc[rows][self.features], block_size
+            )
+
+        return prediction, n_trees
+
+
 def feature_importance(
     feature_names: list,
-    clf: RandomForestClassifier
+    clf: RandomForestClassifier | PointingBinnedForest
 ) -> pd.DataFrame:
     """Function to estimate the importance of features in a Random Forest
     classifier based on the Gini index.
@@ -20,7 +389,7 @@ def feature_importance(
     ----------
     feature_names : list
         Name of the columns of the dataframe used to train the RF.
-    clf : RandomForestClassifier
+    clf : RandomForestClassifier | PointingBinnedForest
         Trained RF for which the importance of features shall be checked.
 
     Returns
@@ -43,10 +412,28 @@ def feature_importance(
 def train_rf(
     df_train: pd.DataFrame,
     config: dict = None
-) -> RandomForestClassifier:
+) -> RandomForestClassifier | PointingBinnedForest:
     """
     Train a Random Forest Regressor for the classification of irf classes.
 
+    If the config defines the "pointing_binning" section, a set of
+    forests - one per telescope pointing bin - is trained instead
+    (see PointingBinnedForest), e.g.
+
+        "pointing_binning": {
+            "bins": {"alt_tel": [0.5, 0.9, 1.2, 1.6], "sin_az_tel": [-1, 0, 1]},
+            "random_forest_args": {"max_depth": 20, "n_estimators": 50}
+        }
+
+    where the optional "random_forest_args" override those of the
+    individual forests. The forests are trained in parallel with
+    "n_jobs" from the main "random_forest_args".
+
+    The "random_forest_features" may define derived features as
+    "name = expression" (see parse_features()). The expressions are
+    stored in the "feature_expressions_" attribute of the trained
+    classifier, so that apply_rf() evaluates them in the same way.
+
     Parameters
     ----------
     train: `pandas.DataFrame`
@@ -62,16 +449,40 @@ def train_rf(
     model = RandomForestClassifier
     logger.info("Number of events for training: %d", df_train.shape[0])
 
-    if config:
+    if config and config.get('pointing_binning'):
+        binning = config['pointing_binning']
+        classifier_args = {
+            **config.get('random_forest_args', {}),
+            **binning.get('random_forest_args', {})
+        }
+        features, expressions = parse_features(config['random_forest_features'])
+        clf = PointingBinnedForest(
+            binning['bins'],
+            features,
+            classifier_args
+        )
+
+        logger.info("Given features: %s", repr(clf.features))
+        logger.info("Training Random Forest Classifiers for PSF Classes "
+                    "in %d pointing bins ...", np.prod(clf.shape))
+
+        clf.fit(feature_frame(df_train, clf.feature_names_in_, expressions),
+                df_train['psf_class'],
+                n_jobs=classifier_args.get('n_jobs'))
+        clf.feature_expressions_ = expressions
+
+    elif config:
         classifier_args = config['random_forest_args']
-        features = config['random_forest_features']
+        features, expressions = parse_features(config['random_forest_features'])
         clf = model(**classifier_args)
 
         logger.info("Given features: %s", repr(features))
+        logger.info("Derived features: %s", repr(expressions))
         logger.info("Training Random Forest Classifier for PSF Classes ...")
 
-        clf.fit(df_train[features],
+        clf.fit(feature_frame(df_train, features, expressions),
                 df_train['psf_class'])
+        clf.feature_expressions_ = expressions
 
     else:
         clf = model()
@@ -87,7 +498,216 @@ def train_rf(
     return clf
 
 
-def apply_rf(sample: pd.DataFrame, rf: RandomForestClassifier) -> pd.DataFrame:
+def shard_config(config: dict, shard: int, n_shards: int) -> dict:
+    """
+    Derives the training configuration of a forest shard.
+
+    The shard gets its part of the "n_estimators" trees and a "random_state"
+    derived from the configured one and the shard index, so that the shards
+    grow different trees and the merged forest is reproducible.
+
+    Parameters
+    ----------
+    config: dict
+        training configuration (see train_rf())
+    shard: int
+        shard index, from 0 to n_shards - 1
+    n_shards: int
+        total number of shards
+
+    Returns
+    -------
+    config: dict
+        training configuration of the shard
+    """
+    if not 0 <= shard < n_shards:
+        raise ValueError(f"shard index {shard} is out of the [0; {n_shards}) range")
+
+    config = copy.deepcopy(config)
+    args = config.setdefault('random_forest_args', {})
+    if config.get('pointing_binning'):
+        # The pointing bin forests may override the main arguments
+        args = config['pointing_binning'].setdefault('random_forest_args', {})
+        args = {**config['random_forest_args'], **args}
+        config['pointing_binning']['random_forest_args'] = args
+
+    n_estimators = args.get('n_estimators', 100)
+    args['n_estimators'] = n_estimators // n_shards + (shard < n_estimators % n_shards)
+    if args['n_estimators'] == 0:
+        raise ValueError(f"{n_estimators} trees can not be split into {n_shards} shards")
+
+    # Without a configured seed the shards are random anyway
+    if args.get('random_state') is not None:
+        seeds = np.random.SeedSequence([args['random_state'], shard])
+        args['random_state'] = int(seeds.generate_state(1)[0])
+
+    return config
+
+
+def shard_file_name(directory: str, shard: int, n_shards: int) -> str:
+    """Name of the file a forest shard is stored to in the shard directory."""
+    return os.path.join(directory, f'shard{shard:04d}_of_{n_shards:04d}.pkl')
+
+
+def train_rf_shard(
+    df_train: pd.DataFrame,
+    config: dict,
+    shard: int,
+    n_shards: int,
+    directory: str
+) -> str:
+    """
+    Trains a shard of the forest - a part of its trees - and stores it in
+    the shard directory, shared by the processes (or hosts) training the
+    other shards. The shards are then combined with merge_shards().
+
+    Parameters
+    ----------
+    df_train: pd.DataFrame
+        Data frame of events to train the RF with.
+    config: dict
+        training configuration of the complete forest (see train_rf())
+    shard: int
+        shard index, from 0 to n_shards - 1
+    n_shards: int
+        total number of shards
+    directory: str
+        shard directory
+
+    Returns
+    -------
+    str:
+        name of the stored shard file
+    """
+    clf = train_rf(df_train, shard_config(config, shard, n_shards))
+
+    os.makedirs(directory, exist_ok=True)
+    file_name = shard_file_name(directory, shard, n_shards)
+
+    # Written under a temporary name, so that a merge never sees partial shards
+    joblib.dump(clf, file_name + '.tmp')
+    os.replace(file_name + '.tmp', file_name)
+    logger.info("Shard %d of %d stored to %s", shard, n_shards, file_name)
+
+    return file_name
+
+
+def _merge_estimators(forests: list) -> RandomForestClassifier:
+    merged = copy.deepcopy(forests[0])
+
+    for forest in forests[1:]:
+        if not np.array_equal(forest.classes_, merged.classes_):
+            raise ValueError(f"forest classes differ: {forest.classes_} vs {merged.classes_}")
+        merged.estimators_ += forest.estimators_
+
+    merged.n_estimators = len(merged.estimators_)
+
+    # Out-of-bag estimates of the individual shards do not apply to the merged forest
+    for name in ('oob_score_', 'oob_decision_function_'):
+        if hasattr(merged, name):
+            delattr(merged, name)
+
+    return merged
+
+
+def merge_forests(forests: list) -> RandomForestClassifier | PointingBinnedForest:
+    """
+    Combines the trees of several forests trained with the same features
+    and classes - e.g. the shards of a forest - into a single forest.
+
+    Parameters
+    ----------
+    forests: list
+        RandomForestClassifier or PointingBinnedForest instances;
+        the latter should share the pointing binning and trained bins
+
+    Returns
+    -------
+    RandomForestClassifier | PointingBinnedForest:
+        merged forest
+    """
+    first = forests[0]
+    for forest in forests[1:]:
+        if type(forest) is not type(first):
+            raise ValueError("forests of different types can not be merged")
+        if list(forest.feature_names_in_) != list(first.feature_names_in_):
+            raise ValueError(
+                f"forest features differ: {forest.feature_names_in_} vs {first.feature_names_in_}"
+            )
+        if _feature_expressions(forest) != _feature_expressions(first):
+            raise ValueError("derived feature expressions of the forests differ")
+
+    if isinstance(first, PointingBinnedForest):
+        for forest in forests[1:]:
+            if not np.array_equal(forest.bin_models_, first.bin_models_):
+                raise ValueError("forests are trained in different pointing bins")
+
+        merged = copy.copy(first)
+        merged.models_ = [
+            _merge_estimators([forest.models_[i] for forest in forests])
+            for i in range(len(first.models_))
+        ]
+        merged.classifier_args = {
+            **first.classifier_args,
+            'n_estimators': merged.models_[0].n_estimators
+        }
+    else:
+        merged = _merge_estimators(forests)
+
+    return merged
+
+
+def merge_shards(directory: str, n_shards: int) -> RandomForestClassifier | PointingBinnedForest:
+    """
+    Loads the forest shards stored by train_rf_shard() and merges them.
+
+    Parameters
+    ----------
+    directory: str
+        shard directory
+    n_shards: int
+        total number of shards
+
+    Returns
+    -------
+    RandomForestClassifier | PointingBinnedForest:
+        merged forest
+    """
+    file_names = [shard_file_name(directory, shard, n_shards) for shard in range(n_shards)]
+
+    missing = [name for name in file_names if not os.path.exists(name)]
+    if missing:
+        raise FileNotFoundError(f"missing forest shards: {missing}")
+
+    merged = merge_forests([joblib.load(name) for name in file_names])
+    logger.info("Merged %d forest shards from %s", n_shards, directory)
+
+    return merged
+
+
+def set_n_jobs(rf: RandomForestClassifier | PointingBinnedForest, n_jobs: int) -> None:
+    """
+    Sets the number of threads the forest predicts with, e.g.
+    replacing the one of the training node.
+
+    Parameters
+    ----------
+    rf: RandomForestClassifier | PointingBinnedForest
+        trained forest
+    n_jobs: int
+        number of threads
+    """
+    models = rf.models_ if isinstance(rf, PointingBinnedForest) else [rf]
+    for model in models:
+        model.set_params(n_jobs=n_jobs)
+
+
+def apply_rf(
+    sample: pd.DataFrame,
+    rf: RandomForestClassifier | PointingBinnedForest,
+    block_size: int = 0,
+    proba_dtype: str = ''
+) -> pd.DataFrame:
     """
     Apply the pre-trained random forest to the given data frame
 
@@ -95,16 +715,59 @@ def apply_rf(sample: pd.DataFrame, rf: RandomForestClassifier) -> pd.DataFrame:
     ----------
     sample: pd.DataFrame
         Data frame to apply the random forest to.
-    rf: RandomForestClassifier
+    rf: RandomForestClassifier | PointingBinnedForest
         Pre-trained random forest
+    block_size: int
+        If positive, the trees are evaluated in blocks of this size,
+        stopping for each event once its class is settled (see predict_early());
+        the predictions are the same as with the full evaluation.
+    proba_dtype: str
+        If given, the class probabilities are stored as well, quantized
+        to this data type (see iclass.relabel.quantize_proba()), so that
+        the events can be re-labelled later without the forest.
+        Not compatible with the early stopping.
 
     Returns
     -------
     pd.DataFrame:
         Original data frame with the added 'reco_psf_class' column
-        containing the random forest predictions
+        containing the random forest predictions and, optionally,
+        the 'reco_psf_proba_<class>' probability columns
     """
+    if block_size > 0 and proba_dtype:
+        raise ValueError("class probabilities can not be stored with the early stopping")
+
     features = rf.feature_names_in_
-    sample.loc[:, 'reco_psf_class'] = rf.predict(sample[features])
+    expressions = _feature_expressions(rf)
+
+    if expressions:
+        X = feature_frame(sample, features, expressions)
+    else:
+        X = sample[features]
+
+    if block_size > 0:
+        if isinstance(rf, PointingBinnedForest):
+            prediction, n_trees = rf.predict_early(X, block_size)
+        else:
+            prediction, n_trees = predict_early(rf, X, block_size)
+
+        logger.info(
+            "trees evaluated per event: %.1f on average, %d at most (%d events)",
+            n_trees.mean() if len(n_trees) else 0,
+            n_trees.max(initial=0),
+            len(n_trees)
+        )
+        sample.loc[:, 'reco_psf_class'] = prediction
+    elif proba_dtype:
+        # A single forest pass: the prediction is the most probable class,
+        # as in rf.predict()
+        proba = rf.predict_proba(X)
+        sample.loc[:, 'reco_psf_class'] = rf.classes_.take(np.argmax(proba, axis=1))
+
+        quantized = quantize_proba(proba, proba_dtype)
+        for i, name in enumerate(proba_columns(rf.classes_)):
+            sample[name] = quantized[:, i]
+    else:
+        sample.loc[:, 'reco_psf_class'] = rf.predict(X)
 
     return sample
@@ -1,11 +1,9 @@
 import argparse
+import glob
 import logging
 import os
-import joblib
-import pandas as pd
 
-from iclass.rf import apply_rf
-from iclass.io import read_simulation_config, write_simulation_config
+logger = logging.getLogger(__name__)
 
 
 def main() -> None:
@@ -18,14 +16,47 @@ def main() -> None:
 
         The input data file should be of DL2 level
         and include all the columns used during the RF training.
+
+        The file is processed in chunks, with the reading, the RF
+        application and the writing of the chunks running concurrently;
+        the writing runs in a separate process.
+
+        The output event tables are PyTables tables stored directly under
+        the event key, as written by lstchain, rather than the pandas
+        "fixed" format of the earlier versions; they are read with
+        pandas.read_hdf() and the 'tables' module as before.
+
+        With the '--sidecar' option the event table is not rewritten;
+        only the predictions (along with the "obs_id" and "event_id"
+        columns) are stored as a separate row-aligned table - in the input
+        file itself or in the file given with '--sidecar-file'.
+
+        Several input files are processed one after another. With the
+        '--manifest' option each completed input is recorded, so that
+        a restarted run skips the inputs already processed with the same
+        parameters and model. The outputs are written under temporary names
+        and renamed once complete - except for the sidecar tables written
+        into the input files themselves: an interrupted run leaves a partial
+        sidecar table there (detected as misaligned when read), which is
+        replaced when the input is processed again.
+
+        With the '--partition' option the events of all the inputs are
+        written to a dataset directory, one file per observation, PSF class
+        and input. The partitions of each input are listed in the dataset
+        index once the input is complete; the inputs must be named uniquely.
+
+        With the '--store-proba' option the class probabilities are stored
+        as well, quantized to 8-bit integers or half-precision floats, so that
+        the classes can be re-assigned with 'icrelabel' without the forest.
         """
     )
 
     parser.add_argument(
         '-i',
         "--input",
-        default='',
-        help='input Monte Carlo file name'
+        default=[],
+        nargs="+",
+        help='input Monte Carlo file name(s) or mask(s)'
     )
     parser.add_argument(
         '-r',
@@ -62,6 +93,21 @@ def main() -> None:
         action='store_true',
         help='split output MC file into the parts with individual PSF classes'
     )
+    parser.add_argument(
+        "--partition",
+        default='',
+        help="directory to write the events to as a partitioned dataset "
+        "with 'obs_id=<id>/class=<k>/<input name>.h5' files and the 'index.json' file "
+        "listing the partitions"
+    )
+    parser.add_argument(
+        '-j',
+        "--n-jobs",
+        type=int,
+        default=None,
+        help="number of parallel partition writer processes with '--partition'; "
+        'defaults to the number of available CPUs'
+    )
     parser.add_argument(
         '-z',
         "--complevel",
@@ -69,43 +115,300 @@ def main() -> None:
         default=7,
         help='HDF5 data compression level'
     )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help='number of events to process at a time; 0 processes the whole file at once. '
+        'Defaults to the one fitting the available memory'
+    )
+    parser.add_argument(
+        "--sidecar",
+        action='store_true',
+        help='write only the predictions as a sidecar table, '
+        'leaving the input event table untouched'
+    )
+    parser.add_argument(
+        "--sidecar-file",
+        default='',
+        help="file to write the sidecar table to; defaults to the input file"
+    )
+    parser.add_argument(
+        "--sidecar-key",
+        default='',
+        help="HDF5 key of the sidecar table; defaults to the event key "
+        "appended with '_iclass'"
+    )
+    parser.add_argument(
+        "--early-stopping",
+        type=int,
+        default=0,
+        metavar='BLOCK_SIZE',
+        help='evaluate the trees in blocks of this size, stopping for each event '
+        'once its class can not change anymore; the predictions are identical '
+        'to the full evaluation. Disabled by default'
+    )
+    parser.add_argument(
+        "--store-proba",
+        default='',
+        choices=('uint8', 'float16'),
+        help="also store the class probabilities as 'reco_psf_proba_<class>' "
+        'columns of this data type; not compatible with the early stopping'
+    )
+    parser.add_argument(
+        "--manifest",
+        default='',
+        help='file to record the processed inputs in and to skip them on restart'
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=None,
+        help='maximal number of chunks waiting to be processed or written; '
+        'defaults to the planned one, the chunk size is fitted to it'
+    )
+    parser.add_argument(
+        "--catalog",
+        default='',
+        help='catalog file (see iccatalog) to look up the input file metadata in; '
+        'the missing or outdated entries are added'
+    )
     args = parser.parse_args()
 
+    if sum(map(bool, (args.sidecar, args.split, args.partition))) > 1:
+        parser.error("'--sidecar', '--split' and '--partition' options are mutually exclusive")
+    if args.store_proba and args.early_stopping:
+        parser.error("'--store-proba' and '--early-stopping' options are mutually exclusive")
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-30s : %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+    input_fnames = sorted(
+        set(fname for mask in args.input for fname in glob.glob(mask))
+    )
+    if not input_fnames:
+        parser.error(f'no input files found matching {args.input}')
+    if args.sidecar_file and len(input_fnames) > 1:
+        parser.error("'--sidecar-file' can only be used with a single input file")
+
+    # Heavy dependencies are only loaded once the arguments and inputs are
+    # validated, keeping "--help" and argument errors fast.
+    import joblib
+
+    from iclass.batch import Manifest, atomic_outputs, file_hash
+    from iclass.catalog import load_catalog
+    from iclass.plan import available_cpus, plan_resources
+    from iclass.rf import set_n_jobs
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    params = {
+        name: value for name, value in vars(args).items()
+        if name not in ('input', 'manifest', 'catalog', 'chunk_size', 'queue_size', 'n_jobs', 'early_stopping')
+    }
+    params['rf_hash'] = file_hash(args.rf)
+
+    pending = []
+    for input_fname in input_fnames:
+        if manifest and manifest.is_done(input_fname, params):
+            logger.info("skipping %s - already processed", input_fname)
+        else:
+            pending.append(input_fname)
+    if not pending:
+        return
+
     rf = joblib.load(args.rf)
-    sample = pd.read_hdf(args.input, key=args.event_key)
-    sample = apply_rf(sample, rf)
 
-    if args.cfg_key:
-        cfg = read_simulation_config(args.input, key=args.cfg_key)
-
-    if args.split:
-        _, file_name = os.path.split(args.input)
-        fname, _ = os.path.splitext(file_name)
-
-        for psf_class in sample['reco_psf_class'].unique():
-            output = f'{args.prefix}{fname}_class{psf_class}.h5'
-            subsample = sample.query(f'reco_psf_class == {psf_class}')
-            subsample.to_hdf(output, key=args.event_key, complevel=args.complevel)
-            if args.cfg_key:
-                # MC configuration table has to be written with `tables`
-                # as DataFrame.to_hdf(..., format='table') stores the resulting
-                # table under the additional '.../table' key.
-                write_simulation_config(cfg, output, args.cfg_key)
+    # Unless given explicitly, the chunk size, workers and queue size
+    # fit the job resources of the inputs left to process
+    if None in (args.chunk_size, args.n_jobs, args.queue_size):
+        catalog = load_catalog(args.catalog, pending, args.event_key)
+        plan = plan_resources('apply', pending, args.event_key, catalog=catalog, queue_size=args.queue_size)
+        if args.chunk_size is None:
+            args.chunk_size = plan['chunk_size']
+        if args.n_jobs is None:
+            args.n_jobs = plan['n_jobs']
+        if args.queue_size is None:
+            args.queue_size = plan['queue_size']
+
+    # The forest runs alongside the reader thread and the writer processes
+    writers = args.n_jobs if args.partition else 1
+    set_n_jobs(rf, max(1, available_cpus() - writers - 1))
+
+    # A single writer process (or pool) serves all the inputs, writing
+    # concurrently with the reads of this process
+    if args.partition:
+        from iclass.partition import PartitionWriter, update_index
+
+        by = {'obs_id': 'obs_id', 'class': 'reco_psf_class'}
+        writer = PartitionWriter(args.partition, args.event_key, by, args.complevel, args.n_jobs)
     else:
-        _, file_name = os.path.split(args.input)
-        output = f'{args.prefix}{file_name}'
-        sample.to_hdf(output, key=args.event_key, complevel=args.complevel)
-        if args.cfg_key:
+        from iclass.io import AppendProcess
+
+        writer = AppendProcess()
+
+    with writer:
+        for input_fname in pending:
+            with atomic_outputs() as temporary:
+                if args.partition:
+                    entries = apply_partitioned(input_fname, rf, args, writer, temporary)
+                    outputs = [os.path.join(args.partition, entry['path']) for entry in entries]
+                else:
+                    outputs = apply_file(input_fname, rf, args, temporary, writer.append)
+
+            if args.partition:
+                # The partitions become visible to the readers only once complete
+                update_index(args.partition, entries, args.event_key, args.cfg_key)
+
+            if manifest:
+                manifest.record(input_fname, params, outputs)
+
+
+def apply_file(input_fname: str, rf, args: argparse.Namespace, temporary, append=None) -> list:
+    """
+    Applies the random forest to a single input file.
+
+    Parameters
+    ----------
+    input_fname: str
+        input file name
+    rf: RandomForestClassifier | PointingBinnedForest
+        pre-trained random forest
+    args: argparse.Namespace
+        command line arguments
+    temporary: Callable
+        function mapping the output file names to the temporary
+        ones to write to (see iclass.batch.atomic_outputs)
+    append: Callable
+        function appending the data frames to the output tables, e.g.
+        iclass.io.AppendProcess.append; defaults to iclass.io.append_table
+
+    Returns
+    -------
+    list:
+        names of the written output files
+    """
+    from iclass.rf import apply_rf
+    from iclass.io import (
+        SIDECAR_ID_COLUMNS,
+        append_table,
+        iter_chunks,
+        read_simulation_config,
+        remove_node,
+        write_simulation_config,
+    )
+    from iclass.pipeline import run_pipeline
+    from iclass.relabel import PROBA_PREFIX
+
+    _, file_name = os.path.split(input_fname)
+    fname, _ = os.path.splitext(file_name)
+    outputs = []
+    append = append or append_table
+
+    sidecar_key = args.sidecar_key or f'{args.event_key}_iclass'
+    if args.sidecar_file:
+        sidecar_file = temporary(args.sidecar_file)
+    elif args.sidecar:
+        # The sidecar table is added to the input file itself, replacing
+        # the one left from a previous run. This write is not atomic: copying
+        # the whole input to write it under a temporary name would cost more
+        # than rewriting the events, which the sidecar is meant to avoid.
+        sidecar_file = input_fname
+        remove_node(sidecar_file, sidecar_key)
+        # The input being read can only be written by this process
+        append = append_table
+
+    def write(sample):
+        if args.sidecar:
+            columns = [name for name in SIDECAR_ID_COLUMNS if name in sample]
+            columns += [name for name in sample.columns if name.startswith(PROBA_PREFIX)]
+            append(
+                sample[columns + ['reco_psf_class']],
+                sidecar_file,
+                sidecar_key,
+                args.complevel
+            )
+            return
+
+        if args.split:
+            parts = sample.groupby('reco_psf_class', sort=False)
+        else:
+            parts = [(None, sample)]
+
+        for psf_class, subsample in parts:
+            if args.split:
+                output = f'{args.prefix}{fname}_class{psf_class}.h5'
+            else:
+                output = f'{args.prefix}{file_name}'
+
+            if output not in outputs:
+                outputs.append(output)
+
+            append(subsample, temporary(output), args.event_key, args.complevel)
+
+    run_pipeline(
+        iter_chunks(input_fname, args.event_key, args.chunk_size),
+        lambda sample: apply_rf(sample, rf, args.early_stopping, args.store_proba),
+        write,
+        maxsize=args.queue_size
+    )
+
+    if args.sidecar:
+        return [args.sidecar_file or input_fname]
+
+    if args.cfg_key:
+        cfg = read_simulation_config(input_fname, key=args.cfg_key)
+        for output in outputs:
             # MC configuration table has to be written with `tables`
             # as DataFrame.to_hdf(..., format='table') stores the resulting
             # table under the additional '.../table' key.
-            write_simulation_config(cfg, output, args.cfg_key)
+            write_simulation_config(cfg, temporary(output), args.cfg_key)
 
+    return outputs
 
-if __name__ == "__main__":
-    logging.basicConfig(
-        level=logging.WARNING,
-        format='%(asctime)s %(name)-30s : %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
+
+def apply_partitioned(input_fname: str, rf, args: argparse.Namespace, writer, temporary) -> list:
+    """
+    Applies the random forest to a single input file,
+    writing the events to the partitioned dataset.
+
+    Parameters
+    ----------
+    input_fname: str
+        input file name
+    rf: RandomForestClassifier | PointingBinnedForest
+        pre-trained random forest
+    args: argparse.Namespace
+        command line arguments
+    writer: iclass.partition.PartitionWriter
+        writer of the dataset
+    temporary: Callable
+        function mapping the output file names to the temporary
+        ones to write to (see iclass.batch.atomic_outputs)
+
+    Returns
+    -------
+    entries: list
+        index entries of the written partition files
+    """
+    from iclass.rf import apply_rf
+    from iclass.io import iter_chunks, read_simulation_config
+    from iclass.pipeline import run_pipeline
+
+    writer.start(input_fname, temporary)
+    run_pipeline(
+        iter_chunks(input_fname, args.event_key, args.chunk_size),
+        lambda sample: apply_rf(sample, rf, args.early_stopping, args.store_proba),
+        writer.write,
+        maxsize=args.queue_size
     )
+
+    cfg = read_simulation_config(input_fname, key=args.cfg_key) if args.cfg_key else None
+
+    return writer.finish(cfg, args.cfg_key)
+
+
+if __name__ == "__main__":
     main()
@@ -0,0 +1,95 @@
+import argparse
+import glob
+import logging
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=r"""
+        Catalog tool for CTA-compatible Monte Carlo productions.
+
+        Scans the input files in parallel and caches their metadata - event
+        counts, column schema, observation IDs, energy and pointing ranges
+        and the simulation configuration summary - in a JSON catalog file.
+        Files already catalogued and unchanged since (same size and
+        modification time) are not scanned again.
+
+        The catalog can be used by the other tools (e.g. ictrainrf) to plan
+        the reading without opening the files.
+        """
+    )
+
+    parser.add_argument(
+        '-i',
+        "--input",
+        default=[],
+        nargs="+",
+        help='input Monte Carlo file name(s) or mask(s)'
+    )
+    parser.add_argument(
+        '-o',
+        "--output",
+        default='./catalog.json',
+        help='catalog file name; updated if present'
+    )
+    parser.add_argument(
+        '-e',
+        "--event-key",
+        default='/dl2/event/telescope/parameters/LST_LSTCam',
+        help='input HDF5 file key to read the events from'
+    )
+    parser.add_argument(
+        '-c',
+        "--cfg-key",
+        default='/simulation/run_config',
+        help='input HDF5 file key to read the config from'
+    )
+    parser.add_argument(
+        '-j',
+        "--n-jobs",
+        type=int,
+        default=None,
+        help='number of parallel processes; defaults to the number of CPUs'
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1_000_000,
+        help='number of events to read at a time'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-30s : %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+    input_fnames = sorted(
+        set(fname for mask in args.input for fname in glob.glob(mask))
+    )
+    if not input_fnames:
+        parser.error(f'no input files found matching {args.input}')
+
+    # pandas and tables are only needed once the arguments and inputs are validated
+    from iclass.catalog import Catalog
+
+    catalog = Catalog(args.output)
+    entries = catalog.update(
+        input_fnames,
+        args.event_key,
+        args.cfg_key,
+        n_jobs=args.n_jobs,
+        chunk_size=args.chunk_size
+    )
+
+    for fname, entry in zip(input_fnames, entries):
+        print(
+            f"{fname}: {entry['nrows']} events, obs_ids {entry['obs_ids']}, "
+            f"mc_energy {entry['ranges'].get('mc_energy')}"
+        )
+    print(f"total: {sum(entry['nrows'] for entry in entries)} events in {len(entries)} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import argparse
+import glob
+import json
 import logging
+import os
 
 from shutil import copyfile
 
-from iclass.markup import mkmarkup
+logger = logging.getLogger(__name__)
 
 
 def main() -> None:
@@ -19,14 +22,33 @@ def main() -> None:
         The input MC file should be of DL2 level - i.e. include the
         reconstructed event directions ("reco_src_x" and "reco_src_y"
         columns describing it in the telescope camera frame).
+
+        Further event classes, e.g. in energy resolution or gammaness,
+        can be defined in a JSON file given with the '--classes' option
+        and are marked up in the same pass.
+
+        The computed class edges can be saved with the '--save-edges' option.
+        With '--bootstrap' their confidence intervals are estimated and
+        saved too; '--merge-unstable' then merges the bins whose adjacent
+        class edges are not resolved within them.
+        If the edges are given with '--edges' instead, the events are
+        classified by looking up these edges, reading the input in chunks.
+
+        Several input files can be processed in one go with the '--prefix'
+        option; each input is then marked up on its own. With the
+        '--manifest' option each completed input is recorded, so that
+        a restarted run skips the inputs already processed with the same
+        parameters. The outputs are written under temporary names
+        and renamed once complete.
         """
     )
 
     parser.add_argument(
         '-i',
         "--input",
-        default='',
-        help='input Monte Carlo file name'
+        default=[],
+        nargs="+",
+        help='input Monte Carlo file name(s) or mask(s)'
     )
     parser.add_argument(
         '-o',
@@ -34,6 +56,13 @@ def main() -> None:
         default='out.h5',
         help='output Monte Carlo file name with event classes marked'
     )
+    parser.add_argument(
+        '-p',
+        "--prefix",
+        default='',
+        help="output file name prefix to prepend to the input file names; "
+        "overrides '--output'"
+    )
     parser.add_argument(
         '-k',
         "--key",
@@ -43,6 +72,7 @@ def main() -> None:
     parser.add_argument(
         '-e',
         "--ebinsdec",
+        type=float,
         default=10,
         help='number of true energy bins per dec to assume'
     )
@@ -59,17 +89,205 @@ def main() -> None:
         default=7,
         help='HDF5 data compression level'
     )
+    parser.add_argument(
+        "--classes",
+        default='',
+        help='JSON file with the list of the class definitions, e.g. '
+        '[{"name": "eres_class", "metric": "abs(reco_energy / mc_energy - 1)", '
+        '"quantiles": [25, 50, 75], "binning": "mc_energy"}]; '
+        'defaults to the PSF classes only'
+    )
+    parser.add_argument(
+        "--save-edges",
+        default='',
+        help='JSON file to save the computed class edges to'
+    )
+    parser.add_argument(
+        "--edges",
+        default='',
+        help='JSON file with the pre-computed class edges to apply; '
+        "'--ebinsdec' and '--cuts' are then taken from this file"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="number of events to process at a time with '--edges'; "
+        'defaults to the one fitting the available memory'
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        metavar='N',
+        help='number of bootstrap resamples to estimate the 68%% confidence '
+        'intervals of the computed class edges with; stored in the edge table'
+    )
+    parser.add_argument(
+        "--merge-unstable",
+        action='store_true',
+        help="merge the bins with overlapping edge confidence intervals; "
+        "requires '--bootstrap'"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="random seed of '--bootstrap', making the confidence intervals reproducible"
+    )
+    parser.add_argument(
+        '-j',
+        "--n-jobs",
+        type=int,
+        default=None,
+        help='number of bins to bootstrap in parallel; '
+        'defaults to the number of available CPUs'
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=None,
+        help="maximal number of chunks waiting to be processed or written with '--edges'; "
+        'defaults to the planned one, the chunk size is fitted to it'
+    )
+    parser.add_argument(
+        "--manifest",
+        default='',
+        help='file to record the processed inputs in and to skip them on restart'
+    )
+    parser.add_argument(
+        "--catalog",
+        default='',
+        help='catalog file (see iccatalog) to look up the input file metadata in; '
+        'the missing or outdated entries are added'
+    )
     args = parser.parse_args()
 
+    input_fnames = sorted(
+        set(fname for mask in args.input for fname in glob.glob(mask))
+    )
+    if not input_fnames:
+        parser.error(f'no input files found matching {args.input}')
+    if len(input_fnames) > 1 and not args.prefix:
+        parser.error("'--prefix' is required for several input files")
+    if args.merge_unstable and not args.bootstrap:
+        parser.error("'--merge-unstable' requires '--bootstrap'")
+    if len(input_fnames) > 1 and args.save_edges:
+        parser.error("'--save-edges' can only be used with a single input file")
+
     logging.basicConfig(
         level=logging.WARNING,
         format='%(asctime)s %(name)-30s : %(levelname)-8s %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
-    copyfile(args.input, args.output)
-    data = mkmarkup(args.input, args.key, args.ebinsdec, args.cuts)
-    data.to_hdf(args.output, key=args.key, complevel=args.complevel)
+    from iclass.batch import Manifest, atomic_outputs, file_hash
+    from iclass.catalog import load_catalog
+    from iclass.plan import available_cpus, plan_resources
+
+    classes = None
+    if args.classes:
+        with open(args.classes, 'r', encoding='utf-8') as f:
+            classes = json.load(f)
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    params = dict(
+        key=args.key,
+        complevel=args.complevel,
+        output=args.output if not args.prefix else '',
+        prefix=args.prefix,
+    )
+    if args.edges:
+        params['edges_hash'] = file_hash(args.edges)
+    else:
+        params.update(
+            ebinsdec=args.ebinsdec,
+            cuts=args.cuts,
+            classes=classes,
+            bootstrap=args.bootstrap,
+            merge_unstable=args.merge_unstable,
+            seed=args.seed,
+        )
+
+    pending = []
+    for input_fname in input_fnames:
+        if manifest and manifest.is_done(input_fname, params):
+            logger.info("skipping %s - already processed", input_fname)
+        else:
+            pending.append(input_fname)
+
+    # The resources are planned for the inputs left to process only
+    if args.edges and None in (args.chunk_size, args.queue_size) and pending:
+        catalog = load_catalog(args.catalog, pending, args.key)
+        plan = plan_resources('markup', pending, args.key, catalog=catalog, queue_size=args.queue_size)
+        if args.chunk_size is None:
+            args.chunk_size = plan['chunk_size']
+        if args.queue_size is None:
+            args.queue_size = plan['queue_size']
+    if args.n_jobs is None:
+        args.n_jobs = available_cpus()
+
+    for input_fname in pending:
+        if args.prefix:
+            output = args.prefix + os.path.basename(input_fname)
+        else:
+            output = args.output
+
+        with atomic_outputs() as temporary:
+            markup_file(input_fname, temporary(output), args, classes)
+
+        if manifest:
+            manifest.record(input_fname, params, [output])
+
+
+def markup_file(input_fname: str, output: str, args: argparse.Namespace, classes: list = None) -> None:
+    """
+    Marks up the event classes of a single input file.
+
+    Parameters
+    ----------
+    input_fname: str
+        input Monte Carlo file name
+    output: str
+        output file name
+    args: argparse.Namespace
+        command line arguments
+    classes: list
+        class definitions; defaults to the PSF classes only
+    """
+    # astropy and pandas are only needed past the argument parsing
+    from iclass.io import append_table, iter_chunks, remove_node
+    from iclass.markup import apply_markup, load_edges, mkmarkup, save_edges
+    from iclass.pipeline import run_pipeline
+
+    copyfile(input_fname, output)
+
+    if args.edges:
+        edges = load_edges(args.edges)
+        remove_node(output, args.key)
+        run_pipeline(
+            iter_chunks(input_fname, args.key, args.chunk_size),
+            lambda chunk: apply_markup(chunk, edges),
+            lambda data: append_table(data, output, args.key, args.complevel),
+            maxsize=args.queue_size
+        )
+    else:
+        data, edges = mkmarkup(
+            input_fname,
+            args.key,
+            args.ebinsdec,
+            args.cuts,
+            return_edges=True,
+            classes=classes,
+            n_bootstrap=args.bootstrap,
+            merge_unstable=args.merge_unstable,
+            n_jobs=args.n_jobs,
+            seed=args.seed
+        )
+        data.to_hdf(output, key=args.key, complevel=args.complevel)
+
+    if args.save_edges:
+        save_edges(edges, args.save_edges)
 
 
 if __name__ == "__main__":
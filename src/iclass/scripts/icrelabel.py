@@ -0,0 +1,264 @@
+import argparse
+import glob
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def parse_class_pairs(values: list, value_type=int) -> dict:
+    """
+    Parses the "CLASS:VALUE" command line entries.
+
+    Parameters
+    ----------
+    values: list
+        entries like "4:3"
+    value_type: type
+        type of the values
+
+    Returns
+    -------
+    dict:
+        values by the classes
+    """
+    pairs = {}
+    for entry in values:
+        value_class, _, value = entry.partition(':')
+        pairs[int(value_class)] = value_type(value)
+
+    return pairs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=r"""
+        Event class re-assignment tool for the classified event files.
+
+        Assigns the event classes from the class probabilities stored
+        by 'icapplyrf --store-proba', without the random forest. The
+        classes to merge are given as '--merge 4:3' (class 4 merged into
+        class 3, with their probabilities summed up); the events with
+        the probability of the assigned class below '--min-proba' - either
+        a single value or 'CLASS:VALUE' entries - are assigned the
+        '--fallback' class.
+
+        The files are streamed in chunks, with the reading, the
+        re-labelling and the writing running concurrently. The sidecar
+        tables written with 'icapplyrf --sidecar' are re-labelled
+        the same way, giving their key with '--event-key'.
+        """
+    )
+
+    parser.add_argument(
+        '-i',
+        "--input",
+        default=[],
+        nargs="+",
+        help='input classified file name(s) or mask(s)'
+    )
+    parser.add_argument(
+        '-p',
+        "--prefix",
+        default='./relabelled_',
+        help='output file name prefix. '
+        "It will be appended with the original file name."
+        "If '--split' option is specified, mulptiple files "
+        "with endings like 'class0.h5', 'class1.h5' etc. will be created."
+    )
+    parser.add_argument(
+        '-e',
+        "--event-key",
+        default='/dl2/event/telescope/parameters/LST_LSTCam',
+        help='input HDF5 file key to read the events from'
+    )
+    parser.add_argument(
+        '-c',
+        "--cfg-key",
+        default='',
+        help='input HDF5 file key to read the config from. '
+            'For LST MCs the path is "/simulation/run_config".'
+    )
+    parser.add_argument(
+        "--merge",
+        default=[],
+        nargs="+",
+        metavar='CLASS:TARGET',
+        help='classes to merge into the target ones'
+    )
+    parser.add_argument(
+        "--min-proba",
+        default=['0'],
+        nargs="+",
+        help="minimal probability of the assigned class; "
+        "a single value or 'CLASS:VALUE' entries"
+    )
+    parser.add_argument(
+        "--fallback",
+        type=int,
+        default=-1,
+        help="class of the events below the '--min-proba' threshold"
+    )
+    parser.add_argument(
+        "--column",
+        default='reco_psf_class',
+        help='column to write the classes to'
+    )
+    parser.add_argument(
+        '-s',
+        "--split",
+        action='store_true',
+        help='split output file into the parts with individual classes'
+    )
+    parser.add_argument(
+        '-z',
+        "--complevel",
+        type=int,
+        default=7,
+        help='HDF5 data compression level'
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help='number of events to process at a time; 0 processes the whole file at once. '
+        'Defaults to the one fitting the available memory'
+    )
+    parser.add_argument(
+        "--manifest",
+        default='',
+        help='file to record the processed inputs in and to skip them on restart'
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=None,
+        help='maximal number of chunks waiting to be processed or written; '
+        'defaults to the planned one, the chunk size is fitted to it'
+    )
+    parser.add_argument(
+        "--catalog",
+        default='',
+        help='catalog file (see iccatalog) to look up the input file metadata in; '
+        'the missing or outdated entries are added'
+    )
+    args = parser.parse_args()
+
+    try:
+        args.merge = parse_class_pairs(args.merge)
+        if len(args.min_proba) == 1 and ':' not in args.min_proba[0]:
+            args.min_proba = float(args.min_proba[0])
+        else:
+            args.min_proba = parse_class_pairs(args.min_proba, float)
+    except ValueError as err:
+        parser.error(f"invalid '--merge' or '--min-proba' value: {err}")
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-30s : %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+    input_fnames = sorted(
+        set(fname for mask in args.input for fname in glob.glob(mask))
+    )
+    if not input_fnames:
+        parser.error(f'no input files found matching {args.input}')
+
+    # Heavy dependencies are only loaded once the arguments and inputs are validated,
+    # keeping "--help" and argument errors fast.
+    from iclass.batch import Manifest, atomic_outputs
+    from iclass.catalog import load_catalog
+    from iclass.plan import plan_resources
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    params = {
+        name: value for name, value in vars(args).items()
+        if name not in ('input', 'manifest', 'catalog', 'chunk_size', 'queue_size')
+    }
+
+    pending = []
+    for input_fname in input_fnames:
+        if manifest and manifest.is_done(input_fname, params):
+            logger.info("skipping %s - already processed", input_fname)
+        else:
+            pending.append(input_fname)
+
+    # The chunk and queue sizes are planned for the inputs left to process only
+    if None in (args.chunk_size, args.queue_size) and pending:
+        catalog = load_catalog(args.catalog, pending, args.event_key)
+        plan = plan_resources('apply', pending, args.event_key, catalog=catalog, queue_size=args.queue_size)
+        if args.chunk_size is None:
+            args.chunk_size = plan['chunk_size']
+        if args.queue_size is None:
+            args.queue_size = plan['queue_size']
+
+    for input_fname in pending:
+        with atomic_outputs() as temporary:
+            outputs = relabel_file(input_fname, args, temporary)
+
+        if manifest:
+            manifest.record(input_fname, params, outputs)
+
+
+def relabel_file(input_fname: str, args: argparse.Namespace, temporary) -> list:
+    """
+    Re-labels the events of a single input file.
+
+    Parameters
+    ----------
+    input_fname: str
+        input file name
+    args: argparse.Namespace
+        command line arguments
+    temporary: Callable
+        function mapping the output file names to the temporary
+        ones to write to (see iclass.batch.atomic_outputs)
+
+    Returns
+    -------
+    list:
+        names of the written output files
+    """
+    from iclass.io import append_table, iter_chunks, read_simulation_config, write_simulation_config
+    from iclass.pipeline import run_pipeline
+    from iclass.relabel import relabel
+
+    _, file_name = os.path.split(input_fname)
+    fname, _ = os.path.splitext(file_name)
+    outputs = []
+
+    def write(sample):
+        if args.split:
+            parts = sample.groupby(args.column, sort=False)
+        else:
+            parts = [(None, sample)]
+
+        for event_class, subsample in parts:
+            if args.split:
+                output = f'{args.prefix}{fname}_class{event_class}.h5'
+            else:
+                output = f'{args.prefix}{file_name}'
+
+            if output not in outputs:
+                outputs.append(output)
+
+            append_table(subsample, temporary(output), args.event_key, args.complevel)
+
+    run_pipeline(
+        iter_chunks(input_fname, args.event_key, args.chunk_size),
+        lambda sample: relabel(sample, args.merge, args.min_proba, args.fallback, args.column),
+        write,
+        maxsize=args.queue_size
+    )
+
+    if args.cfg_key:
+        cfg = read_simulation_config(input_fname, key=args.cfg_key)
+        for output in outputs:
+            write_simulation_config(cfg, temporary(output), args.cfg_key)
+
+    return outputs
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,6 @@ import json
 import logging
 import sys
 
-import joblib
-import pandas as pd
-
-from iclass.rf import feature_importance, train_rf
-
 
 logging.basicConfig(
         level=logging.INFO,
@@ -29,6 +24,11 @@ def main() -> None:
     parser = argparse.ArgumentParser(
         description=r"""
         Random forest training to determine IRF classes for CTAO telescopes.
+
+        The training can be distributed over several processes or hosts
+        sharing a directory: each run with '--shard i --n-shards N' trains
+        its part of the trees, and a final run with '--merge-shards --n-shards N'
+        combines them into a single forest.
         """
     )
 
@@ -66,26 +66,59 @@ def main() -> None:
         default=7,
         help='scikit-learn data compression level'
     )
+    parser.add_argument(
+        '-j',
+        "--n-jobs",
+        type=int,
+        default=None,
+        help='number of processes to read the input files with; '
+        'defaults to the number of files fitting the available CPUs and memory. '
+        'The random forest "n_jobs": -1 is also replaced with the number of available CPUs'
+    )
+    parser.add_argument(
+        "--catalog",
+        default='',
+        help='catalog file (see iccatalog) to look up the input file metadata in; '
+        'the missing or outdated entries are added'
+    )
+    parser.add_argument(
+        "--n-shards",
+        type=int,
+        default=1,
+        help="number of shards the forest trees are split into for the "
+        "distributed training with '--shard' and '--merge-shards'"
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        default=None,
+        help='train only the given shard (from 0 to n_shards - 1) of the '
+        "forest trees and store it to the '--shard-dir' directory"
+    )
+    parser.add_argument(
+        "--shard-dir",
+        default='./shards',
+        help='directory shared by the processes training the forest shards'
+    )
+    parser.add_argument(
+        "--merge-shards",
+        action='store_true',
+        help="merge the forest shards stored in the '--shard-dir' directory "
+        'into a single forest instead of training'
+    )
 
     args = parser.parse_args()
 
-    try:
-        train_df = pd.concat(
-            [
-                pd.read_hdf(file_name, key=args.event_key)
-                for file_name in glob.glob(args.input)
-            ]
-        )
-    except FileNotFoundError:
-        logger.error("Error: The file %s was not found.", args.input)
-        sys.exit(1)
-    except OSError as e:
-        logger.error("Error: An issue occurred while reading the HDF5 file:"
-                     "%s", e)
-        sys.exit(1)
-    except json.JSONDecodeError:
-        logger.error("Error: Failed to decode JSON from %s.", args.input)
-        sys.exit(1)
+    if args.shard is not None and args.merge_shards:
+        parser.error("'--shard' and '--merge-shards' options are mutually exclusive")
+    if args.shard is not None and not 0 <= args.shard < args.n_shards:
+        parser.error(f"'--shard' should be in the [0; {args.n_shards}) range")
+
+    # pandas and scikit-learn are only needed past the argument parsing
+    import joblib
+
+    from iclass.plan import available_cpus
+    from iclass.rf import feature_importance, merge_shards, parse_features, train_rf, train_rf_shard
 
     try:
         with open(args.config, 'r', encoding='utf-8') as f:
@@ -97,14 +130,33 @@ def main() -> None:
         logger.error("Error: The file %s is not a valid JSON.", args.config)
         sys.exit(1)
 
-    if config.get('cuts', None):
-        train_df = train_df.query(config['cuts'])
-
-    # Train the IRF classes random forest.
-    clf = train_rf(train_df, config)
+    # "n_jobs": -1 would use all the CPUs of the node, ignoring the job limits
+    for rf_args in (
+        config.get('random_forest_args', {}),
+        (config.get('pointing_binning') or {}).get('random_forest_args', {}),
+    ):
+        if rf_args.get('n_jobs') == -1:
+            rf_args['n_jobs'] = available_cpus()
+
+    if args.merge_shards:
+        # The shards are trained by the separate "--shard" runs
+        try:
+            clf = merge_shards(args.shard_dir, args.n_shards)
+        except (FileNotFoundError, ValueError) as e:
+            logger.error("Error: Failed to merge the forest shards: %s", e)
+            sys.exit(1)
+    else:
+        train_df = read_training_events(args, config)
+
+        if args.shard is not None:
+            train_rf_shard(train_df, config, args.shard, args.n_shards, args.shard_dir)
+            return
+
+        # Train the IRF classes random forest.
+        clf = train_rf(train_df, config)
 
     # Check the most important features of the rf.
-    feature_names = train_df[config['random_forest_features']].columns.tolist()
+    feature_names, _ = parse_features(config['random_forest_features'])
     df_feature_importance = feature_importance(feature_names, clf)
 
     logger.info("Importance of the features according to their Gini indeces:")
@@ -118,5 +170,77 @@ def main() -> None:
                     )
 
 
+def read_training_events(args: argparse.Namespace, config: dict):
+    """
+    Reads the training events from the input files,
+    exiting with an error if they can not be read.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        command line arguments
+    config: dict
+        training configuration
+
+    Returns
+    -------
+    pd.DataFrame:
+        training events passing the configured cuts
+    """
+    from iclass.catalog import Catalog
+    from iclass.io import read_files
+    from iclass.plan import plan_resources
+    from iclass.rf import parse_features
+
+    file_names = sorted(glob.glob(args.input))
+    if not file_names:
+        logger.error("Error: No files found matching %s.", args.input)
+        sys.exit(1)
+
+    catalog = None
+    if args.catalog:
+        # The catalog tells the file sizes and schemas without reading the events
+        catalog = Catalog(args.catalog)
+        entries = catalog.update(file_names, args.event_key, n_jobs=args.n_jobs)
+
+        names, expressions = parse_features(config.get('random_forest_features', []))
+        required = set(names) - set(expressions) | {'psf_class'}
+        for file_name, entry in zip(file_names, entries):
+            missing = required - set(entry['columns'] or [])
+            if entry['nrows'] and missing:
+                logger.error("Error: The file %s lacks the columns %s.", file_name, sorted(missing))
+                sys.exit(1)
+
+        file_names = [name for name, entry in zip(file_names, entries) if entry['nrows']]
+        logger.info("Reading %d events from %d files.",
+                    sum(entry['nrows'] for entry in entries), len(file_names))
+
+    n_jobs = args.n_jobs
+    if n_jobs is None:
+        n_jobs = plan_resources('train', file_names, args.event_key, catalog=catalog)['n_jobs']
+
+    # The files are decoded in parallel, applying the cuts while reading
+    try:
+        train_df = read_files(
+            file_names,
+            args.event_key,
+            config.get('cuts') or '',
+            n_jobs=n_jobs,
+            catalog=catalog
+        )
+    except FileNotFoundError:
+        logger.error("Error: The file %s was not found.", args.input)
+        sys.exit(1)
+    except OSError as e:
+        logger.error("Error: An issue occurred while reading the HDF5 file:"
+                     "%s", e)
+        sys.exit(1)
+    except json.JSONDecodeError:
+        logger.error("Error: Failed to decode JSON from %s.", args.input)
+        sys.exit(1)
+
+    return train_df
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,161 @@
+import argparse
+import glob
+import logging
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=r"""
+        Event class validation tool for classified CTA-compatible Monte Carlo files.
+
+        Accumulates, chunk by chunk and in parallel over the input files,
+        the reconstructed offset histograms per true energy bin and
+        reconstructed PSF class, as well as the true vs reconstructed
+        PSF class confusion matrices per true energy bin.
+
+        Writes the event counts and the offset containment radii
+        to '{prefix}psf.csv' and the confusion matrices to '{prefix}confusion.csv'.
+        The radii falling beyond the maximal offset are clipped to it
+        and flagged in the 'containment_unbounded' column.
+        """
+    )
+
+    parser.add_argument(
+        '-i',
+        "--input",
+        default=[],
+        nargs="+",
+        help='classified Monte Carlo file name(s) or mask(s)'
+    )
+    parser.add_argument(
+        '-p',
+        "--prefix",
+        default='./validation_',
+        help='output file name prefix'
+    )
+    parser.add_argument(
+        '-k',
+        "--key",
+        default='/dl2/event/telescope/parameters/LST_LSTCam',
+        help='input HDF5 file key to read from'
+    )
+    parser.add_argument(
+        '-c',
+        "--cuts",
+        default='',
+        help='event cuts to apply'
+    )
+    parser.add_argument(
+        '-e',
+        "--ebinsdec",
+        type=float,
+        default=5,
+        help='number of true energy bins per dec to assume'
+    )
+    parser.add_argument(
+        "--energy-range",
+        type=float,
+        nargs=2,
+        default=[0.01, 100],
+        help='true energy range, TeV'
+    )
+    parser.add_argument(
+        "--max-offset",
+        type=float,
+        default=2,
+        help='maximal reconstructed offset to histogram, degrees'
+    )
+    parser.add_argument(
+        "--offset-bins",
+        type=int,
+        default=2000,
+        help='number of reconstructed offset bins'
+    )
+    parser.add_argument(
+        '-n',
+        "--nclasses",
+        type=int,
+        default=4,
+        help='number of PSF classes'
+    )
+    parser.add_argument(
+        '-f',
+        "--fraction",
+        type=float,
+        default=0.68,
+        help='offset containment fraction'
+    )
+    parser.add_argument(
+        '-j',
+        "--n-jobs",
+        type=int,
+        default=None,
+        help='number of parallel processes; defaults to the number of available CPUs'
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help='number of events to process at a time; '
+        'defaults to the one fitting the available memory'
+    )
+    parser.add_argument(
+        "--catalog",
+        default='',
+        help='catalog file (see iccatalog) to look up the input file metadata in; '
+        'the missing or outdated entries are added'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-30s : %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+
+    input_fnames = sorted(
+        set(fname for mask in args.input for fname in glob.glob(mask))
+    )
+    if not input_fnames:
+        parser.error(f'no input files found matching {args.input}')
+
+    # numpy, pandas and tables are only needed once the arguments and inputs are validated
+    import numpy as np
+
+    from iclass.catalog import load_catalog
+    from iclass.plan import plan_resources
+    from iclass.validation import summary_tables, validate
+
+    catalog = load_catalog(args.catalog, input_fnames, args.key)
+    plan = plan_resources('validate', input_fnames, args.key, catalog=catalog)
+    if args.chunk_size is None:
+        args.chunk_size = plan['chunk_size']
+    if args.n_jobs is None:
+        args.n_jobs = plan['n_jobs']
+
+    emin, emax = np.log10(args.energy_range)
+    energy_edges = np.logspace(emin, emax, int(round((emax - emin) * args.ebinsdec)) + 1)
+    # The last offset bin collects all the events beyond the maximal offset
+    offset_edges = np.append(
+        np.linspace(0, args.max_offset, args.offset_bins + 1),
+        np.inf
+    )
+
+    accumulator = validate(
+        input_fnames,
+        args.key,
+        energy_edges,
+        offset_edges,
+        args.nclasses,
+        cuts=args.cuts,
+        chunk_size=args.chunk_size,
+        n_jobs=args.n_jobs
+    )
+    psf, confusion = summary_tables(accumulator, energy_edges, offset_edges, args.fraction)
+
+    psf.to_csv(f'{args.prefix}psf.csv', index=False)
+    confusion.to_csv(f'{args.prefix}confusion.csv')
+
+
+if __name__ == "__main__":
+    main()
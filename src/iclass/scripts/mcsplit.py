@@ -1,9 +1,7 @@
 import argparse
+import glob
 import logging
 
-from iclass.split import evtsplit, cfgsplit
-from iclass.io import write_simulation_config
-
 
 def main() -> None:
     parser = argparse.ArgumentParser(
@@ -12,14 +10,25 @@ def main() -> None:
 
         Input MC file is split following the specified fractions
         and each part is saved as a separate file with the corresponding name.
+
+        Several input files (or masks) are split in parallel, each part
+        being saved to a file named after the corresponding input.
+        With the '--merge' option the parts of all inputs are merged
+        into a single file per fraction instead.
+
+        With the '--partition' option each part of all the inputs is written
+        as a partitioned dataset to the 'part0', 'part1' etc directories,
+        with one 'obs_id=<id>/<input name>.h5' file per observation and
+        input and the 'index.json' file listing them.
         """
     )
 
     parser.add_argument(
         '-i',
         "--input",
-        default='',
-        help='input Monte Carlo file name'
+        default=[],
+        nargs="+",
+        help='input Monte Carlo file name(s) or mask(s)'
     )
     parser.add_argument(
         '-p',
@@ -56,24 +65,90 @@ def main() -> None:
         default=7,
         help='HDF5 data compression level'
     )
+    parser.add_argument(
+        '-j',
+        "--n-jobs",
+        type=int,
+        default=None,
+        help='number of parallel processes for multiple input files; '
+        'defaults to the number of files fitting the available CPUs and memory'
+    )
+    parser.add_argument(
+        '-m',
+        "--merge",
+        action='store_true',
+        help='merge the parts of multiple input files into '
+        "single 'part0.h5', 'part1.h5' etc files"
+    )
+    parser.add_argument(
+        "--partition",
+        action='store_true',
+        help="write the parts as partitioned datasets to 'part0', 'part1' "
+        'etc directories, one file per observation'
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help='random seed of the event shuffling; '
+        'each input file is shuffled with its own seed derived from it'
+    )
+    parser.add_argument(
+        "--catalog",
+        default='',
+        help='catalog file (see iccatalog) to look up the input file metadata in; '
+        'the missing or outdated entries are added'
+    )
     args = parser.parse_args()
 
+    if args.merge and args.partition:
+        parser.error("'--merge' and '--partition' options are mutually exclusive")
+
     logging.basicConfig(
         level=logging.WARNING,
         format='%(asctime)s %(name)-30s : %(levelname)-8s %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
     )
 
-    evt_samples = evtsplit(args.input, args.event_key, args.fractions)
-    cfg_samples = cfgsplit(args.input, args.cfg_key, args.fractions)
+    input_fnames = sorted(
+        set(fname for mask in args.input for fname in glob.glob(mask))
+    )
+    if not input_fnames:
+        parser.error(f'no input files found matching {args.input}')
+
+    # pandas and tables are only needed once the arguments and inputs are validated
+    from iclass.catalog import load_catalog
+    from iclass.plan import plan_resources
+    from iclass.split import batch_mcsplit, mcsplit
+
+    if args.n_jobs is None:
+        catalog = load_catalog(args.catalog, input_fnames, args.event_key)
+        args.n_jobs = plan_resources('split', input_fnames, args.event_key, catalog=catalog)['n_jobs']
 
-    for i, (evt, cfg) in enumerate(zip(evt_samples, cfg_samples)):
-        output = f'{args.prefix}part{i}.h5'
-        evt.to_hdf(output, key=args.event_key, complevel=args.complevel)
-        # MC configuration table has to be written with `tables`
-        # as DataFrame.to_hdf(..., format='table') stores the resulting
-        # table under the additional '.../table' key.
-        write_simulation_config(cfg, output, args.cfg_key)
+    if len(input_fnames) == 1 and not args.merge:
+        mcsplit(
+            input_fnames[0],
+            args.prefix,
+            args.event_key,
+            args.cfg_key,
+            args.fractions,
+            args.complevel,
+            partition=args.partition,
+            seed=args.seed
+        )
+    else:
+        batch_mcsplit(
+            input_fnames,
+            args.prefix,
+            args.event_key,
+            args.cfg_key,
+            args.fractions,
+            args.complevel,
+            n_jobs=args.n_jobs,
+            merge=args.merge,
+            partition=args.partition,
+            seed=args.seed
+        )
 
 
 if __name__ == "__main__":
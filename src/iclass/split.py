@@ -1,16 +1,32 @@
 import logging
+import os
 import random
 import numpy as np
 import pandas as pd
 
-from iclass.io import read_simulation_config
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
+from iclass.batch import atomic_outputs
+from iclass.io import (
+    append_table,
+    common_dtype,
+    read_simulation_config,
+    table_dtype,
+    write_simulation_config,
+)
+from iclass.partition import PartitionWriter, source_name, update_index
 
-def evtsplit(input_fname: str, key: str, fractions: tuple) -> tuple:
+
+def evtsplit(input_fname: str, key: str, fractions: tuple, seed: int = None) -> tuple:
     """
     Splits the input MC events into parts with the counts
     proportional to the indicated fractions.
 
+    The events are shuffled with the given seed. If it is not set,
+    a seed is drawn from the "random" module state, which the forked
+    worker processes share; the parallel callers should pass the seeds.
+
     Parameters
     ----------
     input_fname: str
@@ -19,6 +35,8 @@ def evtsplit(input_fname: str, key: str, fractions: tuple) -> tuple:
         input HDF5 file key to read from
     fractions: tuple
         Relative fractions to split into; must total to <1.
+    seed: int
+        random seed of the event shuffling, in the [0; 2**32) range
 
     Returns
     -------
@@ -49,7 +67,8 @@ def evtsplit(input_fname: str, key: str, fractions: tuple) -> tuple:
         cfractions = np.concatenate(([0], cfractions))
 
     samples = []
-    seed = random.randint(0, 2**32 - 1)
+    if seed is None:
+        seed = random.randint(0, 2**32 - 1)
 
     for obs_id in events.obs_id.unique():
         _events = events.query(f'obs_id == {obs_id}')
@@ -127,3 +146,297 @@ def cfgsplit(input_fname: str, key: str, fractions: tuple) -> tuple:
         part.n_showers = (part.n_showers * frac).astype(int)
 
     return parts
+
+
+def mcsplit(
+    input_fname: str,
+    prefix: str,
+    event_key: str,
+    cfg_key: str,
+    fractions: tuple,
+    complevel: int = 7,
+    partition: bool = False,
+    seed: int = None
+) -> list:
+    """
+    Splits the input MC file into parts with the event counts
+    proportional to the indicated fractions and writes each part
+    to a separate file named "{prefix}part{i}.h5".
+
+    If "partition" is set, each part is written instead as a partitioned
+    dataset (see iclass.partition) in the "{prefix}part{i}" directory,
+    with one "obs_id=<id>/<input name>.h5" file per observation.
+
+    Parameters
+    ----------
+    input_fname: str
+        input Monte Carlo file name
+    prefix: str
+        output file name prefix
+    event_key: str
+        input HDF5 file key to read the events from
+    cfg_key: str
+        input HDF5 file key to read the simulation configuration from
+    fractions: tuple
+        Relative fractions to split into; must total to <1.
+    complevel: int
+        HDF5 data compression level
+    partition: bool
+        whether to write the parts as partitioned datasets
+    seed: int
+        random seed of the event shuffling (see evtsplit())
+
+    Returns
+    -------
+    outputs: list
+        Names of the written files (or dataset directories), one per fraction
+    """
+    if partition:
+        outputs = [f'{prefix}part{i}' for i in range(len(fractions))]
+        entries = split_partitions(input_fname, prefix, event_key, cfg_key, fractions, complevel, seed)
+        for output, part_entries in zip(outputs, entries):
+            update_index(output, part_entries, event_key, cfg_key)
+
+        return outputs
+
+    evt_samples = evtsplit(input_fname, event_key, fractions, seed)
+    cfg_samples = cfgsplit(input_fname, cfg_key, fractions)
+
+    outputs = []
+    for i, (evt, cfg) in enumerate(zip(evt_samples, cfg_samples)):
+        output = f'{prefix}part{i}.h5'
+        evt.to_hdf(output, key=event_key, mode='w', complevel=complevel)
+        # MC configuration table has to be written with `tables`
+        # as DataFrame.to_hdf(..., format='table') stores the resulting
+        # table under the additional '.../table' key.
+        write_simulation_config(cfg, output, cfg_key)
+        outputs.append(output)
+
+    return outputs
+
+
+def _split_tables(
+    input_fname: str,
+    prefix: str,
+    event_key: str,
+    cfg_key: str,
+    fractions: tuple,
+    seed: int = None
+) -> list:
+    # Same as mcsplit(), but writes uncompressed PyTables tables, whose
+    # column types can be read from the metadata before merging
+    evt_samples = evtsplit(input_fname, event_key, fractions, seed)
+    cfg_samples = cfgsplit(input_fname, cfg_key, fractions)
+
+    outputs = []
+    for i, (evt, cfg) in enumerate(zip(evt_samples, cfg_samples)):
+        output = f'{prefix}part{i}.h5'
+        if os.path.exists(output):
+            os.remove(output)
+        append_table(evt, output, event_key)
+        write_simulation_config(cfg, output, cfg_key)
+        outputs.append(output)
+
+    return outputs
+
+
+def split_partitions(
+    input_fname: str,
+    prefix: str,
+    event_key: str,
+    cfg_key: str,
+    fractions: tuple,
+    complevel: int = 7,
+    seed: int = None
+) -> list:
+    """
+    Splits the input MC file into parts with the event counts
+    proportional to the indicated fractions and writes their events
+    to the "{prefix}part{i}" partitioned datasets by observation.
+
+    The partition files are written under temporary names and renamed
+    once complete. The dataset indices are not updated, so that the
+    partitions of several inputs can be written concurrently.
+
+    Parameters
+    ----------
+    input_fname: str
+        input Monte Carlo file name
+    prefix: str
+        output dataset directory prefix
+    event_key: str
+        input HDF5 file key to read the events from
+    cfg_key: str
+        input HDF5 file key to read the simulation configuration from
+    fractions: tuple
+        Relative fractions to split into; must total to <1.
+    complevel: int
+        HDF5 data compression level
+    seed: int
+        random seed of the event shuffling (see evtsplit())
+
+    Returns
+    -------
+    entries: list
+        index entries of the written partitions, one list per fraction
+    """
+    evt_samples = evtsplit(input_fname, event_key, fractions, seed)
+    cfg_samples = cfgsplit(input_fname, cfg_key, fractions)
+
+    entries = []
+    for i, (evt, cfg) in enumerate(zip(evt_samples, cfg_samples)):
+        by = {'obs_id': 'obs_id'}
+        with PartitionWriter(f'{prefix}part{i}', event_key, by, complevel, n_jobs=1) as writer:
+            with atomic_outputs() as temporary:
+                writer.start(input_fname, temporary)
+                writer.write(evt)
+                entries.append(writer.finish(cfg, cfg_key))
+
+    return entries
+
+
+def batch_mcsplit(
+    input_fnames: list,
+    prefix: str,
+    event_key: str,
+    cfg_key: str,
+    fractions: tuple,
+    complevel: int = 7,
+    n_jobs: int = None,
+    merge: bool = False,
+    partition: bool = False,
+    seed: int = None
+) -> list:
+    """
+    Splits a set of MC files in a process pool.
+
+    Each worker splits one input file at a time, so that the memory
+    used per worker is bounded by the size of a single run file.
+    The parts are written to "{prefix}{name}_part{i}.h5" files,
+    where "name" is the input file name without extension.
+    Each input is shuffled with its own seed, spawned from the given one.
+
+    If "merge" is set, the parts of all input files are instead
+    appended to the "{prefix}part{i}.h5" files - one per fraction.
+    The simulation configuration rows of all inputs, with "n_showers"
+    scaled by the fraction, are appended to the same files, so that
+    the merged configuration stays consistent with the merged events.
+    The merged tables get the widest string columns and the common
+    numeric types of the parts.
+
+    If "partition" is set, the parts of all input files are written to
+    the "{prefix}part{i}" partitioned datasets (see iclass.partition),
+    with one file per observation and input.
+
+    Parameters
+    ----------
+    input_fnames: list
+        input Monte Carlo file names
+    prefix: str
+        output file name prefix
+    event_key: str
+        input HDF5 file key to read the events from
+    cfg_key: str
+        input HDF5 file key to read the simulation configuration from
+    fractions: tuple
+        Relative fractions to split into; must total to <1.
+    complevel: int
+        HDF5 data compression level
+    n_jobs: int
+        number of worker processes; defaults to the number of CPUs
+    merge: bool
+        whether to merge the parts of all inputs per fraction
+    partition: bool
+        whether to write the parts as partitioned datasets
+    seed: int
+        random seed of the event shuffling; drawn from
+        the system entropy if not set
+
+    Returns
+    -------
+    outputs: list
+        Names of the written files (or dataset directories)
+    """
+    log = logging.getLogger(__name__)
+
+    if merge and partition:
+        raise ValueError("partitioned datasets can not be merged")
+
+    # The outputs (or partition files) are named after the inputs
+    names = [source_name(fname) for fname in input_fnames]
+    if len(set(names)) != len(names):
+        raise ValueError("input file names must be unique")
+
+    # The forked workers share the "random" module state,
+    # so each of them gets an explicit independent seed
+    seeds = [
+        int(sequence.generate_state(1)[0])
+        for sequence in np.random.SeedSequence(seed).spawn(len(input_fnames))
+    ]
+
+    if partition:
+        outputs = [f'{prefix}part{i}' for i in range(len(fractions))]
+        split = partial(
+            split_partitions,
+            prefix=prefix,
+            event_key=event_key,
+            cfg_key=cfg_key,
+            fractions=fractions,
+            complevel=complevel
+        )
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(split, fname, seed=seed) for fname, seed in zip(input_fnames, seeds)]
+            for fname, future in zip(input_fnames, futures):
+                entries = future.result()
+                log.info("split %s", fname)
+                # The indices are only updated by this process
+                for output, part_entries in zip(outputs, entries):
+                    update_index(output, part_entries, event_key, cfg_key)
+
+        return outputs
+
+    prefixes = [f'{prefix}{name}_' for name in names]
+
+    if merge:
+        # Intermediate per-input parts are compressed only once, on merging
+        split = partial(_split_tables, event_key=event_key, cfg_key=cfg_key, fractions=fractions)
+    else:
+        split = partial(mcsplit, event_key=event_key, cfg_key=cfg_key, fractions=fractions, complevel=complevel)
+
+    outputs = []
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [
+            pool.submit(split, fname, part_prefix, seed=seed)
+            for fname, part_prefix, seed in zip(input_fnames, prefixes, seeds)
+        ]
+        for fname, future in zip(input_fnames, futures):
+            outputs.append(future.result())
+            log.info("split %s", fname)
+
+    if not merge:
+        return [output for parts in outputs for output in parts]
+
+    merged = [f'{prefix}part{i}.h5' for i in range(len(fractions))]
+
+    for i, output in enumerate(merged):
+        if os.path.exists(output):
+            os.remove(output)
+
+        parts = [parts[i] for parts in outputs]
+        # The string widths of a table are fixed on its creation,
+        # so the merged tables are created with those of all the parts
+        evt_dtype = common_dtype([table_dtype(part, event_key) for part in parts])
+        cfg_dtype = common_dtype([table_dtype(part, cfg_key) for part in parts])
+
+        # Appending in the input order keeps the merged files reproducible
+        for part in parts:
+            append_table(
+                pd.read_hdf(part, key=event_key), output, event_key, complevel, evt_dtype
+            )
+            append_table(
+                read_simulation_config(part, key=cfg_key), output, cfg_key, complevel, cfg_dtype
+            )
+            os.remove(part)
+
+    return merged
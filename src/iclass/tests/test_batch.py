@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+from iclass.batch import Manifest, atomic_outputs, file_hash
+
+
+def write_file(file_name: str, content: str) -> None:
+    with open(file_name, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+class BatchTest(unittest.TestCase):
+    def test_file_hash(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.txt')
+
+            write_file(fname, 'abc')
+            digest = file_hash(fname, chunk_size=2)
+            self.assertEqual(
+                digest,
+                'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+            )
+
+            write_file(fname, 'abd')
+            self.assertNotEqual(file_hash(fname), digest)
+
+    def test_atomic_outputs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'out.txt')
+
+            with atomic_outputs() as temporary:
+                write_file(temporary(output), 'done')
+                self.assertFalse(os.path.exists(output))
+
+            with open(output, 'r', encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'done')
+
+            # An interrupted job leaves the previous output intact
+            with self.assertRaises(RuntimeError):
+                with atomic_outputs() as temporary:
+                    write_file(temporary(output), 'partial')
+                    raise RuntimeError('interrupted')
+
+            with open(output, 'r', encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'done')
+            self.assertListEqual(os.listdir(tmpdir), ['out.txt'])
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_fname = os.path.join(tmpdir, 'in.txt')
+            output = os.path.join(tmpdir, 'out.txt')
+            manifest_fname = os.path.join(tmpdir, 'manifest.jsonl')
+            params = dict(rf_hash='abc', split=False, cuts=None)
+
+            write_file(input_fname, 'events')
+            write_file(output, 'classified')
+
+            manifest = Manifest(manifest_fname)
+            self.assertFalse(manifest.is_done(input_fname, params))
+            manifest.record(input_fname, params, [output])
+
+            # A truncated last line is skipped on restart
+            with open(manifest_fname, 'a', encoding='utf-8') as f:
+                f.write('{"input": "trunc')
+
+            manifest = Manifest(manifest_fname)
+            self.assertTrue(manifest.is_done(input_fname, params))
+            self.assertFalse(manifest.is_done(input_fname, dict(params, rf_hash='abd')))
+
+            # The entry recorded after the truncated line is kept
+            other_fname = os.path.join(tmpdir, 'other.txt')
+            write_file(other_fname, 'events')
+            manifest.record(other_fname, params, [output])
+            self.assertTrue(Manifest(manifest_fname).is_done(other_fname, params))
+
+            os.remove(output)
+            self.assertFalse(manifest.is_done(input_fname, params))
+
+            write_file(output, 'classified')
+            write_file(input_fname, 'more events')
+            self.assertFalse(manifest.is_done(input_fname, params))
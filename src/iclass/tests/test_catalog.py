@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from unittest.mock import patch
+
+from iclass.catalog import Catalog, load_catalog, scan_file
+from iclass.io import append_table, read_files, write_simulation_config
+from iclass.plan import plan_resources, table_row_width
+
+
+def get_event_df(nevents: int, obs_id: int) -> pd.DataFrame:
+    rng = np.random.default_rng(obs_id)
+
+    data = dict(
+        obs_id=np.full(nevents, obs_id),
+        event_id=np.arange(nevents),
+        mc_energy=10**rng.uniform(-1, 1, nevents),
+        alt_tel=np.full(nevents, 1.2),
+    )
+
+    return pd.DataFrame(data)
+
+
+class CatalogTest(unittest.TestCase):
+    def test_scan_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.h5')
+            events = pd.concat([get_event_df(100, 1), get_event_df(50, 2)])
+            append_table(events, fname, '/events')
+            write_simulation_config(
+                pd.DataFrame(dict(obs_id=[1, 2], n_showers=[10, 20])),
+                fname,
+                '/simulation/run_config'
+            )
+
+            metadata = scan_file(fname, 'events', '/simulation/run_config', chunk_size=40)
+
+            self.assertEqual(metadata['key'], '/events')
+            self.assertEqual(metadata['nrows'], 150)
+            self.assertEqual(metadata['row_width'], table_row_width(fname, '/events'))
+            self.assertListEqual(list(metadata['columns']), list(events.columns))
+            self.assertListEqual(metadata['obs_ids'], [1, 2])
+            self.assertListEqual(
+                metadata['ranges']['mc_energy'],
+                [events['mc_energy'].min(), events['mc_energy'].max()]
+            )
+            self.assertListEqual(metadata['ranges']['alt_tel'], [1.2, 1.2])
+            self.assertEqual(metadata['run_config']['n_showers'], 30)
+
+            metadata = scan_file(fname, '/events', '/missing')
+            self.assertIsNone(metadata['run_config'])
+
+    def test_catalog(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog_fname = os.path.join(tmpdir, 'catalog.json')
+            fnames = []
+            for obs_id in range(3):
+                fname = os.path.join(tmpdir, f'run{obs_id}.h5')
+                append_table(get_event_df(100 + obs_id, obs_id), fname, '/events')
+                fnames.append(fname)
+
+            entries = Catalog(catalog_fname).update(fnames, '/events', n_jobs=2)
+            self.assertListEqual([entry['nrows'] for entry in entries], [100, 101, 102])
+
+            catalog = Catalog(catalog_fname)
+            self.assertEqual(catalog.get(fnames[0], 'events')['obs_ids'], [0])
+            self.assertIsNone(catalog.get(fnames[0], '/other'))
+
+            # Modified files are scanned again
+            append_table(get_event_df(10, 5), fnames[0], '/events')
+            self.assertIsNone(catalog.get(fnames[0], '/events'))
+            entries = catalog.update(fnames, '/events', n_jobs=2)
+            self.assertListEqual(entries[0]['obs_ids'], [0, 5])
+
+            events = read_files(fnames, '/events', n_jobs=2, catalog=Catalog(catalog_fname))
+            self.assertEqual(len(events), 110 + 101 + 102)
+
+    def test_catalog_keys(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog_fname = os.path.join(tmpdir, 'catalog.json')
+            fname = os.path.join(tmpdir, 'run.h5')
+            append_table(get_event_df(100, 1), fname, '/events')
+            append_table(get_event_df(20, 2), fname, '/other')
+
+            catalog = Catalog(catalog_fname)
+            catalog.update([fname], '/events')
+            catalog.update([fname], '/other')
+
+            # The tables of the same file do not replace each other
+            catalog = Catalog(catalog_fname)
+            self.assertEqual(catalog.get(fname, '/events')['nrows'], 100)
+            self.assertEqual(catalog.get(fname, '/other')['nrows'], 20)
+
+            self.assertIsNone(load_catalog('', [fname], '/events'))
+            catalog = load_catalog(catalog_fname, [fname], '/events')
+
+            # The plan takes the table sizes from the catalog without opening the files
+            with patch('iclass.plan.table_nrows') as nrows, patch('iclass.plan.table_row_width') as row_width:
+                plan = plan_resources('split', [fname], '/events', cpus=2, memory=1024**3, catalog=catalog)
+                nrows.assert_not_called()
+                row_width.assert_not_called()
+
+            self.assertEqual(plan, plan_resources('split', [fname], '/events', cpus=2, memory=1024**3))
@@ -0,0 +1,206 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from iclass.io import (
+    AppendProcess,
+    append_table,
+    common_dtype,
+    cuts_to_condition,
+    iter_chunks,
+    read_events,
+    read_files,
+    read_with_sidecar,
+    table_nrows,
+    to_records,
+)
+
+
+class IOTest(unittest.TestCase):
+    def test_iter_chunks(self):
+        data = pd.DataFrame(dict(
+            obs_id=np.repeat([1, 2], 50),
+            energy=np.linspace(0.1, 10, 100),
+        ))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.h5')
+
+            data.to_hdf(fname, key='/events/fixed')
+            data.to_hdf(fname, key='/events/table', format='table')
+            append_table(data.iloc[:60], fname, '/events/pytables', complevel=5)
+            append_table(data.iloc[60:], fname, 'events/pytables', complevel=5)
+
+            for key in ('/events/fixed', '/events/table', '/events/pytables'):
+                chunks = list(iter_chunks(fname, key, chunk_size=30))
+                self.assertListEqual([len(chunk) for chunk in chunks], [30, 30, 30, 10])
+
+                result = pd.concat(chunks).reset_index(drop=True)
+                pd.testing.assert_frame_equal(result, data)
+
+                chunks = list(iter_chunks(fname, key, chunk_size=0))
+                self.assertEqual(len(chunks), 1)
+
+    def test_cuts_to_condition(self):
+        self.assertEqual(
+            cuts_to_condition('gammaness > 0.7 & intensity > 50'),
+            '(gammaness > 0.7) & (intensity > 50)'
+        )
+        self.assertEqual(
+            cuts_to_condition('a > 1 | (b < 2 and not c == 3)'),
+            '(a > 1) | (((b < 2) & (~(c == 3))))'
+        )
+        self.assertEqual(cuts_to_condition('(a > 1)'), '(a > 1)')
+
+        with self.assertRaises(ValueError):
+            cuts_to_condition('a > 1 & ')
+
+    def test_read_events(self):
+        rng = np.random.default_rng(0)
+        data = pd.DataFrame(dict(
+            gammaness=rng.uniform(0, 1, 1000),
+            intensity=rng.uniform(0, 100, 1000),
+            wl=rng.uniform(0, 1.2, 1000),
+        ))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.h5')
+            data.to_hdf(fname, key='/events/fixed')
+            append_table(data, fname, '/events/pytables')
+
+            for cuts in (
+                'gammaness > 0.7 & intensity > 50 & wl < 1',
+                # chained comparisons are not supported by PyTables
+                '0.01 < wl < 1 and gammaness > 0.5',
+                '',
+            ):
+                expected = data.query(cuts) if cuts else data
+                expected = expected.reset_index(drop=True)
+
+                for key in ('/events/fixed', '/events/pytables'):
+                    result = read_events(fname, key, cuts).reset_index(drop=True)
+                    pd.testing.assert_frame_equal(result, expected)
+
+                    chunks = list(iter_chunks(fname, key, chunk_size=300, cuts=cuts))
+                    result = pd.concat(chunks).reset_index(drop=True)
+                    pd.testing.assert_frame_equal(result, expected)
+
+    def test_read_files(self):
+        rng = np.random.default_rng(0)
+        parts = [
+            pd.DataFrame(dict(
+                obs_id=np.full(n, i),
+                gammaness=rng.uniform(0, 1, n).astype(np.float32),
+            ))
+            for i, n in enumerate((100, 250, 0, 50))
+        ]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_names = []
+            for i, part in enumerate(parts):
+                fname = os.path.join(tmpdir, f'test{i}.h5')
+                if i % 2:
+                    part.to_hdf(fname, key='/events')
+                else:
+                    append_table(part, fname, '/events')
+                file_names.append(fname)
+
+            self.assertListEqual(
+                [table_nrows(fname, '/events') for fname in file_names],
+                [100, 250, 0, 50]
+            )
+
+            for cuts in ('', 'gammaness > 0.5'):
+                expected = pd.concat(parts, ignore_index=True)
+                if cuts:
+                    expected = expected.query(cuts).reset_index(drop=True)
+
+                result = read_files(file_names, '/events', cuts, n_jobs=2)
+                pd.testing.assert_frame_equal(result, expected)
+
+                # The columns do not hold on to the buffers sized before the cuts
+                for name in result.columns:
+                    values = result[name].to_numpy()
+                    while values.base is not None:
+                        values = values.base
+                    self.assertEqual(values.nbytes, len(result) * values.itemsize)
+
+            fname = os.path.join(tmpdir, 'other.h5')
+            parts[0].assign(intensity=1.0).to_hdf(fname, key='/events')
+            with self.assertRaises(ValueError):
+                read_files([file_names[0], fname], '/events')
+
+            # Silent casts of the differing types are refused
+            fname = os.path.join(tmpdir, 'float64.h5')
+            parts[0].astype({'gammaness': np.float64}).to_hdf(fname, key='/events')
+            with self.assertRaisesRegex(ValueError, 'gammaness'):
+                read_files([file_names[0], fname], '/events', n_jobs=1)
+
+    def test_append_process(self):
+        data = pd.DataFrame(dict(
+            obs_id=np.repeat([1, 2], 50),
+            reco_psf_class=np.arange(100) % 4,
+        ))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'out.h5')
+
+            with AppendProcess() as writer:
+                for start in range(0, len(data), 30):
+                    writer.append(data.iloc[start:start + 30], fname, '/dl2/events', complevel=5)
+
+            # The plain PyTables table is read by pandas as well
+            pd.testing.assert_frame_equal(pd.read_hdf(fname, '/dl2/events'), data)
+            self.assertEqual(table_nrows(fname, '/dl2/events'), len(data))
+
+    def test_common_dtype(self):
+        short = to_records(pd.DataFrame(dict(source=['Crab'], obs_id=np.array([1], dtype=np.int32))))
+        long = to_records(pd.DataFrame(dict(obs_id=[2], source=['Markarian 421'])))
+
+        dtype = common_dtype([short.dtype, long.dtype])
+        self.assertListEqual(list(dtype.names), ['source', 'obs_id'])
+        self.assertEqual(dtype['source'], np.dtype('S13'))
+        self.assertEqual(dtype['obs_id'], np.int64)
+
+        # Columns are cast by their names
+        records = to_records(pd.DataFrame(dict(obs_id=[2], source=['Markarian 421'])), dtype)
+        self.assertEqual(records['source'][0], b'Markarian 421')
+        self.assertEqual(records['obs_id'][0], 2)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'out.h5')
+            append_table(pd.DataFrame(dict(source=['Crab'])), fname, '/events')
+
+            # The string widths are fixed by the first append
+            with self.assertRaises(ValueError):
+                append_table(pd.DataFrame(dict(source=['Markarian 421'])), fname, '/events')
+
+        with self.assertRaises(ValueError):
+            common_dtype([short.dtype, to_records(pd.DataFrame(dict(source=[1], obs_id=[2]))).dtype])
+
+    def test_read_with_sidecar(self):
+        events = pd.DataFrame(dict(
+            obs_id=np.repeat([1, 2], 50),
+            event_id=np.tile(np.arange(50), 2),
+            energy=np.linspace(0.1, 10, 100),
+        ))
+        sidecar = events[['obs_id', 'event_id']].assign(reco_psf_class=np.arange(100) % 4)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'events.h5')
+            sidecar_fname = os.path.join(tmpdir, 'sidecar.h5')
+
+            append_table(events, fname, '/events/params')
+            append_table(sidecar, fname, '/events/params_iclass')
+            append_table(sidecar.iloc[::-1], sidecar_fname, '/events/params_iclass')
+            append_table(sidecar.iloc[:10], sidecar_fname, '/short')
+
+            result = read_with_sidecar(fname, '/events/params', '/events/params_iclass')
+            pd.testing.assert_frame_equal(result, events.assign(reco_psf_class=sidecar['reco_psf_class']))
+
+            with self.assertRaises(ValueError):
+                read_with_sidecar(fname, '/events/params', '/events/params_iclass', sidecar_fname)
+            with self.assertRaises(ValueError):
+                read_with_sidecar(fname, '/events/params', '/short', sidecar_fname)
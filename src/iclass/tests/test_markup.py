@@ -1,9 +1,20 @@
+import os
+import tempfile
 import unittest
 import numpy as np
 import pandas as pd
 from unittest.mock import patch
 
-from iclass.markup import mkmarkup
+from iclass.markup import (
+    PSF_CLASS,
+    apply_markup,
+    assign_classes,
+    bootstrap_quantiles,
+    compute_edges,
+    load_edges,
+    mkmarkup,
+    save_edges,
+)
 
 
 def get_ref_df(log_emin: float, log_emax: float, ebinsdec: int, nclasses: int, nsamples: int) -> pd.DataFrame:
@@ -54,8 +65,8 @@ def get_ref_df(log_emin: float, log_emax: float, ebinsdec: int, nclasses: int, n
 
 
 class MarkupTest(unittest.TestCase):
-    @patch('pandas.read_hdf')
-    def test_mkmarkup(self, mock_read_hdf):
+    @patch('iclass.markup.read_events')
+    def test_mkmarkup(self, mock_read_events):
         ebinsdec = 4
 
         ref = get_ref_df(
@@ -66,7 +77,7 @@ class MarkupTest(unittest.TestCase):
             nsamples = 100
         )
 
-        mock_read_hdf.configure_mock(
+        mock_read_events.configure_mock(
             return_value = ref
         )
         result = mkmarkup(
@@ -82,3 +93,184 @@ class MarkupTest(unittest.TestCase):
                 result['psf_class_true'].values
             )
         )
+
+    @patch('iclass.markup.read_events')
+    def test_edges(self, mock_read_events):
+        ebinsdec = 4
+
+        ref = get_ref_df(
+            log_emin = 0,
+            log_emax = 2,
+            ebinsdec = ebinsdec,
+            nclasses = 4,
+            nsamples = 100
+        )
+
+        mock_read_events.configure_mock(
+            return_value = ref
+        )
+        result, edges = mkmarkup(
+            input_fname = 'dummy_input',
+            key = 'dummy_key',
+            ebinsdec = ebinsdec,
+            cuts = 'mc_energy > 0',
+            return_edges = True
+        )
+
+        table = edges['classes'][0]
+        self.assertEqual(table['name'], 'psf_class')
+        self.assertEqual(table['edges'].shape, (len(table['bin_edges']), 3))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'edges.json')
+            save_edges(edges, fname)
+            loaded = load_edges(fname)
+
+        self.assertEqual(loaded['cuts'], 'mc_energy > 0')
+        self.assertTrue(np.allclose(loaded['classes'][0]['edges'], table['edges'], equal_nan=True))
+
+        # Classification of the chunks with the stored edges reproduces the markup
+        chunks = [ref.iloc[start:start + 300] for start in range(0, len(ref), 300)]
+        applied = pd.concat([apply_markup(chunk, loaded) for chunk in chunks])
+
+        self.assertTrue(
+            np.array_equal(
+                applied['psf_class'].values,
+                result['psf_class'].values
+            )
+        )
+
+        # Energies beyond the edge table fall into the outermost bins
+        outside = ref.assign(mc_energy=ref['mc_energy'] * 1e3)
+        applied = apply_markup(outside, loaded)
+        self.assertTrue(np.all(applied['psf_class'].values == outside['psf_class_true'].values))
+
+    @patch('iclass.markup.read_events')
+    def test_multiple_classes(self, mock_read_events):
+        ebinsdec = 4
+        nsamples = 100
+
+        ref = get_ref_df(
+            log_emin = 0,
+            log_emax = 2,
+            ebinsdec = ebinsdec,
+            nclasses = 4,
+            nsamples = nsamples
+        )
+        # Energy resolution classes of the same events in reversed order
+        ref['reco_energy'] = ref['mc_energy'] * (1 + 0.1 * (5 - ref['psf_class_true']))
+
+        mock_read_events.configure_mock(
+            return_value = ref
+        )
+        classes = [
+            dict(name='psf_class', metric='reco_offset', quantiles=[25, 50, 75], binning='mc_energy'),
+            dict(name='eres_class', metric='abs(reco_energy / mc_energy - 1)', quantiles=[50], binning='mc_energy'),
+        ]
+        result, edges = mkmarkup(
+            input_fname = 'dummy_input',
+            key = 'dummy_key',
+            ebinsdec = ebinsdec,
+            return_edges = True,
+            classes = classes
+        )
+
+        self.assertTrue(
+            np.array_equal(
+                result['psf_class'].values,
+                result['psf_class_true'].values
+            )
+        )
+        self.assertTrue(
+            np.array_equal(
+                result['eres_class'].values,
+                np.where(result['psf_class_true'] > 2, 1, 2)
+            )
+        )
+        self.assertListEqual([table['name'] for table in edges['classes']], ['psf_class', 'eres_class'])
+
+    @patch('iclass.markup.read_events')
+    def test_undefined_metric(self, mock_read_events):
+        ref = get_ref_df(log_emin=0, log_emax=2, ebinsdec=4, nclasses=4, nsamples=100)
+        ref['reco_energy'] = ref['mc_energy'] * (1 + 0.1 * (5 - ref['psf_class_true']))
+        # A single undefined energy and a negative offset in the first bin
+        ref.loc[0, 'reco_energy'] = np.nan
+        negative = ref.iloc[[1]].assign(reco_offset=-0.1)
+
+        mock_read_events.configure_mock(return_value=ref)
+        classes = [
+            PSF_CLASS,
+            dict(name='eres_class', metric='abs(reco_energy / mc_energy - 1)', quantiles=[50], binning='mc_energy'),
+        ]
+        result, edges = mkmarkup('dummy_input', 'dummy_key', 4, return_edges=True, classes=classes)
+
+        self.assertEqual(len(result), len(ref))
+        populated = ~np.isnan(edges['classes'][0]['edges']).any(axis=1)
+        self.assertFalse(np.isnan(edges['classes'][1]['edges'][populated]).any())
+        self.assertEqual(result['eres_class'].values[0], -1)
+        self.assertTrue(np.all(result['eres_class'].values[1:] > 0))
+        self.assertTrue(np.array_equal(result['psf_class'].values, result['psf_class_true'].values))
+
+        classes = assign_classes(negative, edges)
+        self.assertListEqual(classes['psf_class'].tolist(), [0])
+
+
+class BootstrapTest(unittest.TestCase):
+    def test_bootstrap_quantiles(self):
+        rng = np.random.default_rng(1)
+        values = np.sort(rng.exponential(size=300))
+        quantiles = [25, 50, 75]
+
+        percentiles, intervals = bootstrap_quantiles(values, quantiles, 2000, 0.68, seed=0)
+
+        self.assertTrue(np.allclose(percentiles, np.percentile(values, quantiles)))
+        self.assertTrue(np.all(intervals[:, 0] < percentiles))
+        self.assertTrue(np.all(intervals[:, 1] > percentiles))
+
+        # Agrees with the naive resampling of the values
+        naive = np.array([
+            np.percentile(rng.choice(values, len(values)), quantiles)
+            for _ in range(2000)
+        ])
+        expected = np.percentile(naive, [16, 84], axis=0).T
+        self.assertTrue(np.allclose(intervals, expected, rtol=0.05))
+
+        _, again = bootstrap_quantiles(values, quantiles, 2000, 0.68, seed=0)
+        self.assertTrue(np.array_equal(intervals, again))
+
+        percentiles, intervals = bootstrap_quantiles(values[:0], quantiles)
+        self.assertTrue(np.isnan(percentiles).all() and np.isnan(intervals).all())
+
+    def test_merge_unstable(self):
+        rng = np.random.default_rng(2)
+        # Densely populated low energy bins and a sparse high energy tail
+        energy = np.concatenate([rng.uniform(1, 10, 4000), [20, 40, 60, 80]])
+        data = pd.DataFrame(dict(
+            mc_energy=energy,
+            reco_offset=rng.exponential(size=len(energy)),
+        ))
+        classes = [dict(name='psf_class', metric='reco_offset', quantiles=[25, 50, 75], binning='mc_energy')]
+
+        edges = compute_edges(data, ebinsdec=2, classes=classes, n_bootstrap=200, n_jobs=2)
+        table = edges['classes'][0]
+        self.assertEqual(table['edges_ci'].shape, (len(table['bin_edges']), 3, 2))
+        self.assertEqual(table['n_events'].sum(), len(data))
+
+        # The intervals are reproducible with a seed
+        again = compute_edges(data, ebinsdec=2, classes=classes, n_bootstrap=200, seed=1)['classes'][0]
+        self.assertTrue(np.array_equal(
+            again['edges_ci'],
+            compute_edges(data, ebinsdec=2, classes=classes, n_bootstrap=200, seed=1)['classes'][0]['edges_ci']
+        ))
+
+        merged = compute_edges(data, ebinsdec=2, classes=classes, n_bootstrap=200, merge_unstable=True)['classes'][0]
+        self.assertLess(len(merged['bin_edges']), len(table['bin_edges']))
+        self.assertEqual(merged['n_events'].sum(), len(data))
+        self.assertTrue(np.all(merged['edges_ci'][:, 1:, 0] > merged['edges_ci'][:, :-1, 1]))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'edges.json')
+            save_edges(dict(edges, classes=[merged]), fname)
+            loaded = load_edges(fname)['classes'][0]
+
+        self.assertTrue(np.allclose(loaded['edges_ci'], merged['edges_ci']))
@@ -0,0 +1,110 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from iclass.batch import atomic_outputs
+from iclass.io import read_simulation_config
+from iclass.partition import (
+    INDEX_NAME,
+    PartitionWriter,
+    partition_path,
+    read_index,
+    read_partitions,
+    select_partitions,
+    update_index,
+)
+
+
+def get_classified_df(nevents: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+
+    data = dict(
+        obs_id=rng.integers(1, 4, nevents),
+        event_id=np.arange(nevents),
+        reco_psf_class=rng.integers(1, 5, nevents),
+    )
+
+    return pd.DataFrame(data)
+
+
+class PartitionTest(unittest.TestCase):
+    by = {'obs_id': 'obs_id', 'class': 'reco_psf_class'}
+
+    def test_partition_path(self):
+        self.assertEqual(
+            partition_path({'obs_id': 1, 'class': 2}),
+            os.path.join('obs_id=1', 'class=2')
+        )
+
+    def test_writer(self):
+        inputs = {'run1.h5': get_classified_df(1000), 'run2.h5': get_classified_df(500, seed=1)}
+        cfg = pd.DataFrame(dict(obs_id=[1, 2, 3], n_showers=[10, 20, 30]))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(tmpdir, 'dataset')
+
+            # A rerun replaces the partition files of the previous one
+            for _ in range(2):
+                with PartitionWriter(directory, '/events', self.by, n_jobs=2) as writer:
+                    for input_fname, data in inputs.items():
+                        with atomic_outputs() as temporary:
+                            writer.start(os.path.join(tmpdir, input_fname), temporary)
+                            for start in range(0, len(data), 300):
+                                writer.write(data.iloc[start:start + 300])
+                            entries = writer.finish(cfg, '/simulation/run_config')
+
+                        index = update_index(directory, entries, '/events', '/simulation/run_config')
+
+            self.assertEqual(index, read_index(directory))
+            self.assertEqual(len(index['partitions']), 3 * 4)
+            self.assertEqual(sum(entry['nrows'] for entry in index['partitions']), 1500)
+
+            # The inputs sharing the observations are both kept
+            entry = index['partitions'][0]
+            self.assertEqual(entry['path'], partition_path({'obs_id': 1, 'class': 1}))
+            self.assertListEqual([file_entry['source'] for file_entry in entry['files']], ['run1', 'run2'])
+            self.assertEqual(entry['nrows'], sum(file_entry['nrows'] for file_entry in entry['files']))
+            self.assertListEqual(entry['files'][0]['run_config'], [dict(obs_id=1, n_showers=10)])
+
+            file_name = os.path.join(directory, entry['files'][0]['path'])
+            events = pd.read_hdf(file_name, '/events')
+            expected = inputs['run1.h5'].query('obs_id == 1 & reco_psf_class == 1')
+            self.assertTrue(np.array_equal(events['event_id'].values, expected['event_id'].values))
+            self.assertListEqual(
+                read_simulation_config(file_name, '/simulation/run_config').to_dict('records'),
+                [dict(obs_id=1, n_showers=10)]
+            )
+
+            self.assertEqual(len(select_partitions(directory)), 2 * 3 * 4)
+            self.assertEqual(len(select_partitions(directory, {'obs_id': [1, 2], 'class': 3})), 2 * 2)
+
+            events = read_partitions(directory, {'class': 2}, cuts='obs_id > 1', n_jobs=2)
+            expected = pd.concat(inputs.values()).query('obs_id > 1 & reco_psf_class == 2')
+            self.assertEqual(len(events), len(expected))
+
+            # An input of the same name would overwrite the partition files
+            with PartitionWriter(directory, '/events', self.by, n_jobs=1) as writer:
+                with self.assertRaises(ValueError):
+                    writer.start(os.path.join(tmpdir, 'other', 'run1.h5'))
+
+            # An interrupted input leaves the dataset intact
+            with PartitionWriter(directory, '/events', self.by, n_jobs=1) as writer:
+                with self.assertRaises(RuntimeError):
+                    with atomic_outputs() as temporary:
+                        writer.start(os.path.join(tmpdir, 'run1.h5'), temporary)
+                        writer.write(inputs['run1.h5'].assign(obs_id=4))
+                        raise RuntimeError('interrupted')
+
+            self.assertEqual(read_index(directory), index)
+            written = [
+                os.path.relpath(os.path.join(root, name), directory)
+                for root, _, names in os.walk(directory) for name in names
+            ]
+            self.assertListEqual(
+                sorted(written),
+                sorted([INDEX_NAME] + [
+                    file_entry['path'] for entry in index['partitions'] for file_entry in entry['files']
+                ])
+            )
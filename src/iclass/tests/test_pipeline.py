@@ -0,0 +1,51 @@
+"""Tests for the chunk processing pipeline.
+"""
+
+import unittest
+
+from iclass.pipeline import run_pipeline
+
+
+class PipelineTest(unittest.TestCase):
+    def test_run_pipeline(self):
+        results = []
+
+        nchunks = run_pipeline(
+            iter(range(20)),
+            lambda chunk: chunk**2,
+            results.append,
+            maxsize=1
+        )
+
+        self.assertEqual(nchunks, 20)
+        self.assertListEqual(results, [i**2 for i in range(20)])
+
+    def test_run_pipeline_empty(self):
+        results = []
+        nchunks = run_pipeline([], lambda chunk: chunk, results.append)
+
+        self.assertEqual(nchunks, 0)
+        self.assertListEqual(results, [])
+
+    def test_run_pipeline_errors(self):
+        def failing_reader():
+            yield 1
+            raise OSError('read failed')
+
+        def failing_process(chunk):
+            if chunk == 5:
+                raise ValueError('process failed')
+            return chunk
+
+        def failing_write(chunk):
+            if chunk == 5:
+                raise RuntimeError('write failed')
+
+        with self.assertRaises(OSError):
+            run_pipeline(failing_reader(), lambda chunk: chunk, lambda chunk: None)
+
+        with self.assertRaises(ValueError):
+            run_pipeline(range(100), failing_process, lambda chunk: None, maxsize=1)
+
+        with self.assertRaises(RuntimeError):
+            run_pipeline(range(100), lambda chunk: chunk, failing_write, maxsize=1)
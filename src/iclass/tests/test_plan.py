@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+import numpy as np
+import pandas as pd
+
+from iclass.io import append_table
+from iclass.plan import (
+    MIN_CHUNK_SIZE,
+    available_cpus,
+    cgroup_dirs,
+    available_memory,
+    plan_resources,
+    table_row_width,
+)
+
+
+def write_file(file_name: str, content: str) -> None:
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+class PlanTest(unittest.TestCase):
+    def test_available_cpus(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            missing = os.path.join(tmpdir, 'missing')
+            self.assertGreaterEqual(available_cpus(tmpdir, missing), 1)
+
+            write_file(os.path.join(tmpdir, 'v1', 'cpu', 'cpu.cfs_quota_us'), '50000\n')
+            write_file(os.path.join(tmpdir, 'v1', 'cpu', 'cpu.cfs_period_us'), '100000\n')
+            self.assertEqual(available_cpus(os.path.join(tmpdir, 'v1'), missing), 1)
+
+            write_file(os.path.join(tmpdir, 'v2', 'cpu.max'), 'max 100000\n')
+            self.assertEqual(available_cpus(os.path.join(tmpdir, 'v2'), missing), len(os.sched_getaffinity(0)))
+
+    def test_nested_cgroups(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            proc_cgroup = os.path.join(tmpdir, 'cgroup')
+
+            # cgroup v2: the job limits are set on the job, not the step cgroup
+            root = os.path.join(tmpdir, 'v2')
+            job = os.path.join(root, 'slurm', 'job_1')
+            write_file(os.path.join(root, 'cgroup.controllers'), 'cpu memory\n')
+            write_file(os.path.join(root, 'cpu.max'), 'max 100000\n')
+            write_file(os.path.join(job, 'cpu.max'), '100000 100000\n')
+            write_file(os.path.join(job, 'memory.max'), str(2 * 1024**3))
+            write_file(os.path.join(job, 'memory.current'), str(1024**3))
+            write_file(os.path.join(job, 'step_0', 'memory.max'), 'max\n')
+            write_file(proc_cgroup, '0::/slurm/job_1/step_0\n')
+
+            self.assertEqual(cgroup_dirs('cpu', root, proc_cgroup)[-1], root)
+            self.assertEqual(available_cpus(root, proc_cgroup), 1)
+            self.assertEqual(available_memory(root, os.path.join(tmpdir, 'missing'), proc_cgroup), 1024**3)
+
+            # cgroup v1 with the combined "cpu,cpuacct" hierarchy
+            root = os.path.join(tmpdir, 'v1')
+            job = os.path.join(root, 'cpu,cpuacct', 'htcondor', 'slot1')
+            write_file(os.path.join(job, 'cpu.cfs_quota_us'), '50000\n')
+            write_file(os.path.join(job, 'cpu.cfs_period_us'), '100000\n')
+            write_file(os.path.join(root, 'memory', 'htcondor', 'memory.limit_in_bytes'), str(1024**3))
+            write_file(proc_cgroup, '4:memory:/htcondor/slot1\n2:cpu,cpuacct:/htcondor/slot1\n0::/\n')
+
+            self.assertEqual(available_cpus(root, proc_cgroup), 1)
+            self.assertEqual(available_memory(root, os.path.join(tmpdir, 'missing'), proc_cgroup), 1024**3)
+
+    def test_available_memory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            meminfo = os.path.join(tmpdir, 'meminfo')
+            missing = os.path.join(tmpdir, 'missing')
+            write_file(meminfo, 'MemTotal:       16000000 kB\nMemAvailable:    8000000 kB\n')
+
+            self.assertEqual(available_memory(tmpdir, meminfo, missing), 8000000 * 1024)
+
+            write_file(os.path.join(tmpdir, 'memory.max'), str(2 * 1024**3))
+            write_file(os.path.join(tmpdir, 'memory.current'), str(1024**3))
+            self.assertEqual(available_memory(tmpdir, meminfo, missing), 1024**3)
+
+            self.assertIsNone(available_memory(missing, missing, missing))
+
+    def test_plan_resources(self):
+        data = pd.DataFrame({'obs_id': np.arange(1000), 'x': np.zeros(1000)})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fnames = [os.path.join(tmpdir, f'test{i}.h5') for i in range(3)]
+            append_table(data, fnames[0], '/events')
+            data.to_hdf(fnames[1], key='/events', format='table')
+            data.to_hdf(fnames[2], key='/events')
+
+            for fname in fnames:
+                self.assertGreaterEqual(table_row_width(fname, '/events'), 16)
+
+            # The reader, the writer and the forest share the CPUs
+            plan = plan_resources('apply', fnames, '/events', cpus=8, memory=1024**3)
+            self.assertEqual(plan['n_jobs'], 2)
+            self.assertEqual(plan['rf_n_jobs'], 5)
+            self.assertEqual(plan['chunk_size'], MIN_CHUNK_SIZE)
+
+            # Only two files fit into the memory at once
+            memory = 2.5 * 1000 * 16 * 4 / 0.5
+            plan = plan_resources('split', fnames, '/events', cpus=4, memory=memory)
+            self.assertEqual(plan['n_jobs'], 2)
+
+            with self.assertLogs('iclass.plan', level='WARNING'):
+                plan = plan_resources('train', fnames, '/events', cpus=4, memory=memory)
+
+            with self.assertRaises(ValueError):
+                plan_resources('unknown', fnames, '/events')
+
+        # Deeper pipeline queues hold more chunks, which get smaller
+        catalog = Mock()
+        catalog.get.return_value = dict(nrows=10**9, row_width=100)
+        plans = [
+            plan_resources('apply', ['dummy.h5'], '/events', cpus=8, memory=8 * 1024**3, catalog=catalog, queue_size=size)
+            for size in (None, 8)
+        ]
+        self.assertListEqual([plan['queue_size'] for plan in plans], [2, 8])
+        self.assertLess(plans[1]['chunk_size'], plans[0]['chunk_size'])
@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from iclass.relabel import dequantize_proba, proba_columns, quantize_proba, read_proba, relabel
+
+
+def get_classified(proba: list, labels: list, dtype: str = 'uint8') -> pd.DataFrame:
+    proba = np.asarray(proba)
+    data = pd.DataFrame(dict(zip(proba_columns([1, 2, 3, 4]), quantize_proba(proba, dtype).T)))
+    data['reco_psf_class'] = labels
+
+    return data
+
+
+class RelabelTest(unittest.TestCase):
+    def test_quantize_proba(self):
+        proba = np.random.default_rng(0).dirichlet(np.ones(4), size=1000)
+
+        quantized = quantize_proba(proba, 'uint8')
+        self.assertEqual(quantized.dtype, np.uint8)
+        self.assertTrue(np.all(np.abs(dequantize_proba(quantized) - proba) <= 0.5 / 255 + 1e-7))
+
+        quantized = quantize_proba(proba, 'float16')
+        self.assertEqual(quantized.dtype, np.float16)
+        self.assertTrue(np.allclose(dequantize_proba(quantized), proba, atol=1e-3))
+
+        with self.assertRaises(ValueError):
+            quantize_proba(proba, 'int8')
+
+    def test_read_proba(self):
+        data = get_classified([[0.1, 0.2, 0.3, 0.4]], [4])
+        # Columns in arbitrary order
+        classes, proba = read_proba(data[data.columns[::-1]])
+
+        self.assertListEqual(classes.tolist(), [1, 2, 3, 4])
+        self.assertTrue(np.allclose(proba, [[0.1, 0.2, 0.3, 0.4]], atol=1 / 255))
+
+        with self.assertRaises(KeyError):
+            read_proba(data[['reco_psf_class']])
+
+    def test_relabel(self):
+        data = get_classified(
+            [
+                [0.7, 0.1, 0.1, 0.1],
+                [0.1, 0.2, 0.3, 0.4],
+                [0.0, 0.1, 0.45, 0.45],
+                [0.4, 0.0, 0.3, 0.3],
+            ],
+            [1, 4, 3, 1]
+        )
+
+        # Ties of the quantized probabilities keep the stored class
+        self.assertListEqual(relabel(data.copy())['reco_psf_class'].tolist(), [1, 4, 3, 1])
+        self.assertListEqual(
+            relabel(data.drop(columns=['reco_psf_class']))['reco_psf_class'].tolist(),
+            [1, 4, 3, 1]
+        )
+
+        merged = relabel(data.copy(), merge={4: 3})
+        self.assertListEqual(merged['reco_psf_class'].tolist(), [1, 3, 3, 3])
+
+        thresholded = relabel(data.copy(), min_proba=0.5, fallback=0)
+        self.assertListEqual(thresholded['reco_psf_class'].tolist(), [1, 0, 0, 0])
+
+        thresholded = relabel(data.copy(), merge={'4': '3'}, min_proba={'1': 0.5}, column='new_class')
+        self.assertListEqual(thresholded['new_class'].tolist(), [1, 3, 3, 3])
+        self.assertListEqual(thresholded['reco_psf_class'].tolist(), [1, 4, 3, 1])
@@ -1,10 +1,27 @@
 """Tests for the routines of the RF module (rf_func).
 """
 
+import os
+import tempfile
 import unittest
+from concurrent.futures import ProcessPoolExecutor
 from unittest.mock import Mock, MagicMock, patch
+import numpy as np
 import pandas as pd
-from iclass.rf import feature_importance, train_rf, apply_rf
+from sklearn.ensemble import RandomForestClassifier
+from iclass.rf import (
+    feature_frame,
+    feature_importance,
+    merge_forests,
+    merge_shards,
+    parse_features,
+    shard_config,
+    train_rf,
+    apply_rf,
+    predict_early,
+    train_rf_shard,
+    PointingBinnedForest,
+)
 
 
 class TestFeatureImportance(unittest.TestCase):
@@ -137,3 +154,294 @@ class TestTrainRF(unittest.TestCase):
             result['reco_psf_class'].to_list(),
             rf.predict.return_value
         )
+
+
+class TestDerivedFeatures(unittest.TestCase):
+    """Class for testing the config-declared derived features.
+    """
+
+    def test_parse_features(self):
+        """Testing the parsing of the feature definitions.
+        """
+        names, expressions = parse_features([
+            'width',
+            'log_intensity = log10(intensity)',
+            'where(wl == 1, 0, wl)',
+        ])
+
+        self.assertListEqual(names, ['width', 'log_intensity', 'where(wl == 1, 0, wl)'])
+        self.assertDictEqual(expressions, {'log_intensity': 'log10(intensity)'})
+
+    def test_derived_features(self):
+        """Testing the training and application with derived features.
+        """
+        rng = np.random.default_rng(0)
+        nevents = 1000
+
+        df_train = pd.DataFrame({
+            'intensity': 10**rng.uniform(1, 4, nevents),
+            'az_tel': rng.uniform(0, 2 * np.pi, nevents),
+        })
+        df_train['psf_class'] = np.where(np.log10(df_train['intensity']) > 2.5, 1, 2)
+
+        X = feature_frame(df_train, ['az_tel', 'log_intensity'], {'log_intensity': 'log10(intensity)'})
+        self.assertEqual(X.values.dtype, np.float32)
+        self.assertTrue(X.values.flags.f_contiguous)
+        self.assertTrue(np.allclose(X['log_intensity'], np.log10(df_train['intensity'])))
+
+        config = {
+            'random_forest_args': {'n_estimators': 5, 'random_state': 1},
+            'random_forest_features': ['log_intensity = log10(intensity)', 'sin_az_tel = sin(az_tel)'],
+        }
+        clf = train_rf(df_train, config)
+
+        self.assertListEqual(list(clf.feature_names_in_), ['log_intensity', 'sin_az_tel'])
+        self.assertDictEqual(
+            clf.feature_expressions_,
+            {'log_intensity': 'log10(intensity)', 'sin_az_tel': 'sin(az_tel)'}
+        )
+
+        result = apply_rf(df_train.drop(columns=['psf_class']), clf)
+        self.assertTrue(np.array_equal(result['reco_psf_class'], df_train['psf_class']))
+        self.assertNotIn('log_intensity', result)
+
+
+class TestShardedTraining(unittest.TestCase):
+    """Class for testing the sharded forest training.
+    """
+
+    def test_shard_config(self):
+        """Testing the split of the trees between the shards.
+        """
+        config = {
+            'random_forest_args': {'n_estimators': 10, 'random_state': 1},
+            'random_forest_features': ['feature1'],
+        }
+
+        configs = [shard_config(config, shard, 3) for shard in range(3)]
+        args = [cfg['random_forest_args'] for cfg in configs]
+
+        self.assertListEqual([arg['n_estimators'] for arg in args], [4, 3, 3])
+        self.assertEqual(len(set(arg['random_state'] for arg in args)), 3)
+        self.assertEqual(shard_config(config, 1, 3), configs[1])
+        self.assertEqual(config['random_forest_args']['n_estimators'], 10)
+
+        config['pointing_binning'] = {'bins': {}, 'random_forest_args': {'n_estimators': 4}}
+        args = shard_config(config, 0, 3)['pointing_binning']['random_forest_args']
+        self.assertEqual(args['n_estimators'], 2)
+
+        with self.assertRaises(ValueError):
+            shard_config(config, 3, 3)
+
+    def test_sharded_training(self):
+        """Testing the training of the shards and their merging.
+        """
+        rng = np.random.default_rng(0)
+        nevents = 1000
+
+        df_train = pd.DataFrame({
+            'feature1': rng.uniform(0, 1, nevents),
+            'feature2': rng.uniform(0, 1, nevents),
+            'alt_tel': rng.choice([0.7, 1.3], nevents),
+        })
+        df_train['psf_class'] = np.where(df_train['feature1'] > 0.5, 1, 2)
+
+        config = {
+            'random_forest_args': {'n_estimators': 5, 'max_depth': 3, 'random_state': 1},
+            'random_forest_features': ['feature1', 'feature2'],
+        }
+        binned_config = dict(config, pointing_binning={'bins': {'alt_tel': [0.5, 1.0, 1.5]}})
+
+        X = df_train.drop(columns=['psf_class'])
+        forests = []
+
+        for cfg in (config, binned_config):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                # The shards are trained in separate processes, as in the distributed training
+                with ProcessPoolExecutor(max_workers=2) as pool:
+                    file_names = list(pool.map(
+                        train_rf_shard, [df_train] * 2, [cfg] * 2, range(2), [2] * 2, [tmpdir] * 2
+                    ))
+                self.assertTrue(all(os.path.exists(file_name) for file_name in file_names))
+
+                clf = merge_shards(tmpdir, 2)
+
+                with self.assertRaises(FileNotFoundError):
+                    merge_shards(tmpdir, 3)
+
+            # Equal to the forest merged from the shards trained in this process
+            shards = [train_rf(df_train, shard_config(cfg, shard, 2)) for shard in range(2)]
+            merged = merge_forests(shards)
+            self.assertTrue(np.array_equal(clf.predict_proba(X[clf.feature_names_in_]),
+                                           merged.predict_proba(X[merged.feature_names_in_])))
+
+            result = apply_rf(X.copy(), clf)
+            self.assertTrue(np.array_equal(result['reco_psf_class'], df_train['psf_class']))
+            forests.append(clf)
+
+        forest, binned_forest = forests
+        self.assertEqual(forest.n_estimators, 5)
+        self.assertEqual(len(forest.estimators_), 5)
+        self.assertEqual(len(feature_importance(['feature1', 'feature2'], forest)), 2)
+        self.assertListEqual([model.n_estimators for model in binned_forest.models_], [5, 5])
+        self.assertListEqual([model.n_estimators for model in shards[0].models_], [3, 3])
+
+        with self.assertRaises(ValueError):
+            merge_forests([forest, binned_forest])
+
+
+class TestEarlyStopping(unittest.TestCase):
+    """Class for testing the early-terminating tree voting.
+    """
+
+    def test_predict_early(self):
+        """Testing that the early stopping keeps the forest predictions.
+        """
+        rng = np.random.default_rng(0)
+        nevents = 3000
+
+        X = pd.DataFrame({
+            'x': rng.normal(size=nevents),
+            'y': rng.normal(size=nevents),
+        })
+        # Overlapping classes, so that some events need all the trees
+        y = 1 + np.digitize(X['x'] + rng.normal(0, 0.5, nevents), [-1, 0, 1])
+
+        rf = RandomForestClassifier(n_estimators=50, max_depth=6, random_state=0)
+        rf.fit(X, y)
+        expected = rf.predict(X)
+
+        for block_size in (1, 7, 50):
+            prediction, n_trees = predict_early(rf, X, block_size)
+
+            self.assertTrue(np.array_equal(prediction, expected))
+            self.assertEqual(n_trees.max(), 50)
+            self.assertGreaterEqual(n_trees.min(), block_size)
+            if block_size < 50:
+                self.assertLess(n_trees.mean(), 50)
+
+            # The trees evaluated in parallel give the identical result
+            rf.set_params(n_jobs=3)
+            parallel_prediction, parallel_n_trees = predict_early(rf, X, block_size)
+            rf.set_params(n_jobs=1)
+            self.assertTrue(np.array_equal(parallel_prediction, prediction))
+            self.assertTrue(np.array_equal(parallel_n_trees, n_trees))
+
+        result = apply_rf(X.copy(), rf, block_size=10)
+        self.assertTrue(np.array_equal(result['reco_psf_class'].values, expected))
+
+        with self.assertRaises(ValueError):
+            apply_rf(X.copy(), rf, block_size=10, proba_dtype='uint8')
+
+
+class TestStoredProbabilities(unittest.TestCase):
+    """Class for testing the storage of the class probabilities.
+    """
+
+    def test_apply_rf_proba(self):
+        """Testing that the stored probabilities come along with the usual prediction.
+        """
+        rng = np.random.default_rng(0)
+        X = pd.DataFrame({'x': rng.normal(size=500), 'y': rng.normal(size=500)})
+        y = 1 + np.digitize(X['x'] + rng.normal(0, 0.5, 500), [-1, 0, 1])
+
+        rf = RandomForestClassifier(n_estimators=20, max_depth=5, random_state=0)
+        rf.fit(X, y)
+
+        for dtype, step in (('uint8', 1 / 255), ('float16', 1e-3)):
+            result = apply_rf(X.copy(), rf, proba_dtype=dtype)
+
+            self.assertTrue(np.array_equal(result['reco_psf_class'].values, rf.predict(X)))
+            columns = [f'reco_psf_proba_{value}' for value in rf.classes_]
+            self.assertTrue((result[columns].dtypes == dtype).all())
+
+            proba = result[columns].values.astype(float)
+            if dtype == 'uint8':
+                proba /= 255
+            self.assertTrue(np.allclose(proba, rf.predict_proba(X), atol=step))
+
+    def test_pointing_binned_proba(self):
+        """Testing the probabilities of the forests lacking some of the classes.
+        """
+        X = pd.DataFrame({'feature1': [0.0, 1.0, 0.0, 1.0], 'alt_tel': [0.1, 0.2, 1.1, 1.2]})
+        clf = PointingBinnedForest({'alt_tel': [0, 1.0, 1.5]}, ['feature1'])
+        clf.fit(X, [1, 2, 3, 3])
+
+        proba = clf.predict_proba(X)
+
+        self.assertTrue(np.allclose(proba.sum(axis=1), 1))
+        self.assertTrue(np.allclose(proba[2:], [[0, 0, 1], [0, 0, 1]]))
+        self.assertTrue(np.array_equal(clf.classes_.take(np.argmax(proba, axis=1)), clf.predict(X)))
+
+
+class TestPointingBinnedForest(unittest.TestCase):
+    """Class for testing the pointing-binned forest ensemble.
+    """
+
+    def test_pointing_binned_forest(self):
+        """Testing the training and application of the forests
+        in the pointing bins.
+        """
+        rng = np.random.default_rng(0)
+        nevents = 2000
+
+        # The class depends on the feature differently in each bin
+        df_train = pd.DataFrame({
+            'feature1': rng.uniform(0, 1, nevents),
+            'alt_tel': rng.choice([0.7, 1.3], nevents),
+            'sin_az_tel': rng.uniform(-1, 1, nevents),
+        })
+        df_train['psf_class'] = np.where(
+            (df_train['feature1'] > 0.5) ^ (df_train['alt_tel'] > 1),
+            1,
+            2
+        )
+
+        config = {
+            'random_forest_args': {'n_estimators': 10, 'random_state': 1, 'n_jobs': 2},
+            'random_forest_features': ['feature1'],
+            'pointing_binning': {
+                'bins': {'alt_tel': [0.5, 1.0, 1.5], 'sin_az_tel': [-1, 0, 1]},
+                'random_forest_args': {'max_depth': 3},
+            },
+        }
+
+        clf = train_rf(df_train, config)
+
+        self.assertIsInstance(clf, PointingBinnedForest)
+        self.assertEqual(len(clf.models_), 4)
+        self.assertListEqual(list(clf.feature_names_in_), ['feature1', 'alt_tel', 'sin_az_tel'])
+        self.assertEqual(clf.models_[0].max_depth, 3)
+        self.assertEqual(clf.models_[0].n_jobs, 2)
+        self.assertTrue(np.allclose(clf.feature_importances_, [1]))
+
+        result = apply_rf(df_train.drop(columns=['psf_class']), clf)
+
+        prediction, n_trees = clf.predict_early(result[clf.feature_names_in_], block_size=3)
+        self.assertTrue(np.array_equal(prediction, result['reco_psf_class'].values))
+        self.assertLessEqual(n_trees.max(), 10)
+
+        self.assertGreater(
+            np.mean(result['reco_psf_class'] == df_train['psf_class']),
+            0.95
+        )
+
+        # Events outside the binning use the outermost bins
+        outside = result.assign(alt_tel=result['alt_tel'] + 1)
+        self.assertListEqual(
+            list(clf.predict(outside)),
+            list(clf.predict(result.assign(alt_tel=1.3)))
+        )
+
+    def test_untrained_bins(self):
+        """Testing the fallback to the nearest trained bin.
+        """
+        X = pd.DataFrame({'feature1': [0.0, 1.0], 'alt_tel': [0.1, 0.2]})
+        clf = PointingBinnedForest({'alt_tel': [0, 0.5, 1.0, 1.5]}, ['feature1'])
+        clf.fit(X, [1, 2])
+
+        self.assertListEqual(list(clf.bin_models_), [0, 0, 0])
+        self.assertListEqual(
+            list(clf.predict(pd.DataFrame({'feature1': [0.0, 1.0], 'alt_tel': [1.4, 0.7]}))),
+            list(clf.models_[0].predict(pd.DataFrame({'feature1': [0.0, 1.0]})))
+        )
@@ -0,0 +1,95 @@
+"""Start-up time tests of the command line tools.
+"""
+
+import subprocess
+import sys
+import unittest
+
+SCRIPTS = (
+    'iclass.scripts.applyrf',
+    'iclass.scripts.iccatalog',
+    'iclass.scripts.icmkmarkup',
+    'iclass.scripts.icrelabel',
+    'iclass.scripts.ictrainrf',
+    'iclass.scripts.icvalidate',
+    'iclass.scripts.mcsplit',
+)
+
+HEAVY_MODULES = ('numpy', 'pandas', 'tables', 'astropy', 'joblib', 'sklearn')
+
+# Maximal time to import a script module (with its dependencies), seconds
+IMPORT_TIME_TARGET = 0.1
+
+
+def get_import_times(module: str) -> dict:
+    """
+    Imports the module in a separate interpreter with "-X importtime".
+
+    Parameters
+    ----------
+    module: str
+        name of the module to import
+
+    Returns
+    -------
+    dict:
+        cumulative import time in seconds per imported module
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True
+    )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative) * 1e-6
+
+    return times
+
+
+class ScriptStartupTest(unittest.TestCase):
+    def test_import_time(self):
+        for script in SCRIPTS:
+            with self.subTest(script=script):
+                times = get_import_times(script)
+
+                heavy = [
+                    name for name in times
+                    if name.split('.')[0] in HEAVY_MODULES
+                ]
+                self.assertListEqual(heavy, [])
+                self.assertLess(times[script], IMPORT_TIME_TARGET)
+
+    def test_help(self):
+        for script in SCRIPTS:
+            with self.subTest(script=script):
+                result = subprocess.run(
+                    [sys.executable, '-m', script, '--help'],
+                    capture_output=True,
+                    text=True
+                )
+                self.assertEqual(result.returncode, 0)
+                self.assertIn('usage', result.stdout)
+
+    def test_missing_input(self):
+        # ictrainrf takes the inputs from its configuration
+        for script in set(SCRIPTS) - {'iclass.scripts.ictrainrf'}:
+            with self.subTest(script=script):
+                result = subprocess.run(
+                    [sys.executable, '-X', 'importtime', '-m', script, '-i', '/nonexistent/*.h5'],
+                    capture_output=True,
+                    text=True
+                )
+                self.assertEqual(result.returncode, 2)
+
+                heavy = [
+                    line for line in result.stderr.splitlines()
+                    if line.startswith('import time:')
+                    and line.split('|')[-1].strip().split('.')[0] in HEAVY_MODULES
+                ]
+                self.assertListEqual(heavy, [])
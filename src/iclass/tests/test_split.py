@@ -1,10 +1,14 @@
+import os
+import tempfile
 import unittest
 import numpy as np
 import pandas as pd
 from unittest.mock import Mock, patch
 
 
-from iclass.split import evtsplit, cfgsplit
+from iclass.io import read_simulation_config, write_simulation_config
+from iclass.partition import read_index
+from iclass.split import evtsplit, cfgsplit, batch_mcsplit
 
 
 def get_event_df(n_showers: int = 100, n_obs: int = 5) -> pd.DataFrame:
@@ -115,3 +119,121 @@ class SplitTest(unittest.TestCase):
                 fractions = (0.5, 0.6),
             )
 
+    def test_batch_mcsplit(self):
+        n_showers = 100
+        n_obs = 2
+        fractions = (0.7, 0.3)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_fnames = []
+            for run in range(3):
+                fname = os.path.join(tmpdir, f'run{run}.h5')
+                events = get_event_df(n_showers, n_obs)
+                events['obs_id'] += run * n_obs
+                cfg = get_config_df(n_showers, n_obs)
+                cfg['obs_id'] += run * n_obs
+                cfg.attrs = {'run': run}
+
+                events.to_hdf(fname, key='/dl2/events')
+                write_simulation_config(cfg, fname, '/simulation/run_config')
+                input_fnames.append(fname)
+
+            prefix = os.path.join(tmpdir, 'out_')
+
+            outputs = batch_mcsplit(
+                input_fnames, prefix, '/dl2/events', '/simulation/run_config', fractions, n_jobs=2
+            )
+            self.assertEqual(len(outputs), len(input_fnames) * len(fractions))
+            self.assertIn(f'{prefix}run1_part0.h5', outputs)
+
+            outputs = batch_mcsplit(
+                input_fnames, prefix, '/dl2/events', '/simulation/run_config', fractions, n_jobs=2, merge=True
+            )
+            self.assertListEqual(outputs, [f'{prefix}part0.h5', f'{prefix}part1.h5'])
+
+            for output, frac in zip(outputs, fractions):
+                events = pd.read_hdf(output, key='/dl2/events')
+                cfg = read_simulation_config(output, key='/simulation/run_config')
+
+                self.assertAlmostEqual(len(events), frac * 3 * n_obs * n_showers)
+                self.assertListEqual(
+                    sorted(events.obs_id.unique()), list(range(3 * n_obs))
+                )
+                self.assertListEqual(cfg.obs_id.to_list(), list(range(3 * n_obs)))
+                self.assertEqual(cfg.n_showers.sum(), len(events))
+                self.assertEqual(cfg.attrs['run'], 0)
+
+            self.assertFalse(os.path.exists(f'{prefix}run0_part0.h5'))
+
+            outputs = batch_mcsplit(
+                input_fnames, prefix, '/dl2/events', '/simulation/run_config', fractions, n_jobs=2, partition=True
+            )
+            self.assertListEqual(outputs, [f'{prefix}part0', f'{prefix}part1'])
+
+            for output, frac in zip(outputs, fractions):
+                index = read_index(output)
+                self.assertListEqual(
+                    [entry['path'] for entry in index['partitions']],
+                    [f'obs_id={obs_id}' for obs_id in range(3 * n_obs)]
+                )
+
+                for entry in index['partitions']:
+                    file_entry, = entry['files']
+                    events = pd.read_hdf(os.path.join(output, file_entry['path']), key='/dl2/events')
+                    self.assertEqual(len(events), entry['nrows'])
+                    self.assertListEqual(events.obs_id.unique().tolist(), [entry['obs_id']])
+                    self.assertListEqual(
+                        file_entry['run_config'],
+                        [dict(obs_id=entry['obs_id'], n_showers=int(frac * n_showers))]
+                    )
+
+    def test_batch_mcsplit_seeds(self):
+        fractions = (0.5, 0.5)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_fnames = []
+            for run in range(2):
+                fname = os.path.join(tmpdir, f'run{run}.h5')
+                # Identical inputs are still shuffled differently
+                get_event_df().to_hdf(fname, key='/dl2/events')
+                write_simulation_config(get_config_df(), fname, '/simulation/run_config')
+                input_fnames.append(fname)
+
+            orders = []
+            for _ in range(2):
+                outputs = batch_mcsplit(
+                    input_fnames, os.path.join(tmpdir, 'out_'), '/dl2/events', '/simulation/run_config',
+                    fractions, n_jobs=2, seed=1
+                )
+                orders.append([pd.read_hdf(output, key='/dl2/events').event_id.to_list() for output in outputs])
+
+        self.assertListEqual(orders[0], orders[1])
+        self.assertNotEqual(orders[0][0], orders[0][2])
+
+    def test_batch_mcsplit_merge_types(self):
+        fractions = (0.5, 0.5)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_fnames = []
+            for run, (source, dtype) in enumerate([('Crab', np.int32), ('Markarian 421', np.int64)]):
+                fname = os.path.join(tmpdir, f'run{run}.h5')
+                events = get_event_df()
+                events['obs_id'] = (events['obs_id'] + run * 5).astype(dtype)
+                events['source'] = source
+                cfg = get_config_df()
+                cfg['obs_id'] += run * 5
+
+                events.to_hdf(fname, key='/dl2/events')
+                write_simulation_config(cfg, fname, '/simulation/run_config')
+                input_fnames.append(fname)
+
+            outputs = batch_mcsplit(
+                input_fnames, os.path.join(tmpdir, 'out_'), '/dl2/events', '/simulation/run_config',
+                fractions, n_jobs=2, merge=True
+            )
+
+            for output in outputs:
+                events = pd.read_hdf(output, key='/dl2/events')
+                self.assertEqual(events['obs_id'].dtype, np.int64)
+                self.assertSetEqual(set(events['source']), {'Crab', 'Markarian 421'})
+                self.assertEqual(len(events), 500)
@@ -0,0 +1,132 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from iclass.io import append_table
+from iclass.validation import (
+    accumulate,
+    containment,
+    empty_accumulator,
+    merge_accumulators,
+    summary_tables,
+    unbounded_containment,
+    validate,
+)
+
+
+def get_classified_df(nevents: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    psf_class = rng.integers(1, 5, nevents)
+
+    data = dict(
+        mc_energy=10**rng.uniform(-1, 1, nevents),
+        reco_offset=np.abs(rng.normal(0, 0.1 * psf_class)),
+        psf_class=psf_class,
+        reco_psf_class=np.where(rng.uniform(size=nevents) < 0.8, psf_class, 1),
+    )
+
+    return pd.DataFrame(data)
+
+
+class ValidationTest(unittest.TestCase):
+    energy_edges = np.logspace(-1, 1, 3)
+    offset_edges = np.append(np.linspace(0, 2, 4001), np.inf)
+
+    def test_accumulate(self):
+        data = get_classified_df(10000)
+
+        whole = accumulate(
+            empty_accumulator(self.energy_edges, self.offset_edges, 4),
+            data,
+            self.energy_edges,
+            self.offset_edges
+        )
+        chunks = [
+            accumulate(
+                empty_accumulator(self.energy_edges, self.offset_edges, 4),
+                data.iloc[start:start + 3000],
+                self.energy_edges,
+                self.offset_edges
+            )
+            for start in range(0, len(data), 3000)
+        ]
+        merged = merge_accumulators(chunks)
+
+        for name in whole:
+            self.assertTrue(np.array_equal(whole[name], merged[name]))
+
+        self.assertEqual(whole['offset'].sum(), len(data))
+        for energy_id in range(2):
+            selection = (
+                (data['mc_energy'] >= self.energy_edges[energy_id])
+                & (data['mc_energy'] < self.energy_edges[energy_id + 1])
+            )
+            self.assertTrue(
+                np.array_equal(
+                    whole['confusion'][energy_id],
+                    pd.crosstab(data.loc[selection, 'psf_class'], data.loc[selection, 'reco_psf_class']).values
+                )
+            )
+
+        psf, confusion = summary_tables(whole, self.energy_edges, self.offset_edges)
+        self.assertEqual(len(psf), 2 * 4)
+        self.assertEqual(psf['n_events'].sum(), len(data))
+        self.assertFalse(psf['containment_unbounded'].any())
+        self.assertEqual(len(confusion), 2 * 4)
+        self.assertListEqual(confusion.xs(1.0, level='energy_min').index.get_level_values('psf_class').to_list(), [1, 2, 3, 4])
+        self.assertEqual(confusion.values.sum(), len(data))
+
+        # Histogram containment reproduces the percentiles within the bin width
+        selection = (data['mc_energy'] >= 1) & (data['reco_psf_class'] == 3)
+        expected = np.percentile(data.loc[selection, 'reco_offset'], 68)
+        row = psf.query('energy_min == 1 & reco_psf_class == 3')
+        self.assertAlmostEqual(row['containment'].iloc[0], expected, delta=1e-3)
+
+    def test_containment(self):
+        counts = np.array([[0, 0, 0], [1, 1, 0], [0, 0, 2]])
+        edges = np.array([0, 1, 2, 3])
+
+        radius = containment(counts, edges, fraction=0.5)
+
+        self.assertTrue(np.isnan(radius[0]))
+        self.assertTrue(np.allclose(radius[1:], [1, 2.5]))
+
+    def test_overflow_containment(self):
+        counts = np.array([[1, 1, 0], [1, 0, 3], [0, 0, 2]])
+        edges = np.array([0, 1, 2, np.inf])
+
+        radius = containment(counts, edges, fraction=0.5)
+        unbounded = unbounded_containment(counts, edges, fraction=0.5)
+
+        # The radii in the overflow bin are clipped to the last finite edge
+        self.assertTrue(np.all(np.isfinite(radius)))
+        self.assertTrue(np.allclose(radius, [1, 2, 2]))
+        self.assertListEqual(unbounded.tolist(), [False, True, True])
+
+    def test_validate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            input_fnames = []
+            for seed in range(2):
+                fname = os.path.join(tmpdir, f'test{seed}.h5')
+                append_table(get_classified_df(1000, seed), fname, '/events')
+                input_fnames.append(fname)
+
+            accumulator = validate(
+                input_fnames,
+                '/events',
+                self.energy_edges,
+                self.offset_edges,
+                nclasses=4,
+                cuts='mc_energy > 1',
+                chunk_size=300,
+                n_jobs=2
+            )
+
+        nexpected = sum(
+            np.sum(get_classified_df(1000, seed)['mc_energy'] > 1)
+            for seed in range(2)
+        )
+        self.assertEqual(accumulator['confusion'].sum(), nexpected)
+        self.assertEqual(accumulator['offset'][0].sum(), 0)
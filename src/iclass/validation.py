@@ -0,0 +1,369 @@
+"""Validation of the reconstructed event classes: per-class PSF containment
+and the true vs reconstructed class confusion matrices per energy bin.
+
+The statistics are accumulated in mergeable histograms, so that
+the MC files can be processed chunk by chunk and in parallel.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from iclass.io import iter_chunks
+from iclass.markup import reco_offset
+
+logger = logging.getLogger(__name__)
+
+
+def empty_accumulator(energy_edges: np.ndarray, offset_edges: np.ndarray, nclasses: int) -> dict:
+    """
+    Creates empty validation histograms.
+
+    Parameters
+    ----------
+    energy_edges: np.ndarray
+        true energy bin edges
+    offset_edges: np.ndarray
+        reconstructed offset bin edges, degrees
+    nclasses: int
+        number of PSF classes (numbered from 1)
+
+    Returns
+    -------
+    accumulator: dict
+        "offset" - event counts of shape (n_energy_bins, nclasses, n_offset_bins);
+        "confusion" - event counts of shape (n_energy_bins, nclasses, nclasses),
+        true class along the second axis
+    """
+    accumulator = dict(
+        offset=np.zeros((len(energy_edges) - 1, nclasses, len(offset_edges) - 1), dtype=np.int64),
+        confusion=np.zeros((len(energy_edges) - 1, nclasses, nclasses), dtype=np.int64),
+    )
+
+    return accumulator
+
+
+def accumulate(
+    accumulator: dict,
+    data: pd.DataFrame,
+    energy_edges: np.ndarray,
+    offset_edges: np.ndarray
+) -> dict:
+    """
+    Adds the events to the validation histograms.
+
+    Events outside of the energy or offset binning and with
+    the classes outside of the [1; nclasses] range are skipped.
+
+    Parameters
+    ----------
+    accumulator: dict
+        histograms as returned by empty_accumulator(); updated in place
+    data: pd.DataFrame
+        classified MC events with the "mc_energy", "reco_psf_class"
+        and "psf_class" (for the confusion matrix) columns. The
+        "reco_offset" is calculated from the true and reconstructed
+        directions if missing.
+    energy_edges: np.ndarray
+        true energy bin edges
+    offset_edges: np.ndarray
+        reconstructed offset bin edges, degrees
+
+    Returns
+    -------
+    accumulator: dict
+        updated histograms
+    """
+    nebins, nclasses, noffbins = accumulator['offset'].shape
+
+    if 'reco_offset' in data:
+        offset = data['reco_offset'].values
+    else:
+        offset = reco_offset(data)
+
+    energy_ids = np.digitize(data['mc_energy'].values, energy_edges) - 1
+    offset_ids = np.digitize(offset, offset_edges) - 1
+    class_ids = data['reco_psf_class'].values.astype(int) - 1
+
+    valid = (
+        (energy_ids >= 0) & (energy_ids < nebins)
+        & (offset_ids >= 0) & (offset_ids < noffbins)
+        & (class_ids >= 0) & (class_ids < nclasses)
+    )
+    flat_ids = np.ravel_multi_index(
+        (energy_ids[valid], class_ids[valid], offset_ids[valid]),
+        accumulator['offset'].shape
+    )
+    accumulator['offset'] += np.bincount(
+        flat_ids, minlength=accumulator['offset'].size
+    ).reshape(accumulator['offset'].shape)
+
+    if 'psf_class' in data:
+        true_ids = data['psf_class'].values.astype(int) - 1
+        valid = (
+            (energy_ids >= 0) & (energy_ids < nebins)
+            & (true_ids >= 0) & (true_ids < nclasses)
+            & (class_ids >= 0) & (class_ids < nclasses)
+        )
+        flat_ids = np.ravel_multi_index(
+            (energy_ids[valid], true_ids[valid], class_ids[valid]),
+            accumulator['confusion'].shape
+        )
+        accumulator['confusion'] += np.bincount(
+            flat_ids, minlength=accumulator['confusion'].size
+        ).reshape(accumulator['confusion'].shape)
+
+    return accumulator
+
+
+def merge_accumulators(accumulators: list) -> dict:
+    """
+    Merges the validation histograms.
+
+    Parameters
+    ----------
+    accumulators: list
+        histograms as returned by empty_accumulator()
+
+    Returns
+    -------
+    accumulator: dict
+        summed histograms
+    """
+    merged = {
+        name: sum(accumulator[name] for accumulator in accumulators)
+        for name in accumulators[0]
+    }
+
+    return merged
+
+
+def validate_file(
+    input_fname: str,
+    key: str,
+    energy_edges: np.ndarray,
+    offset_edges: np.ndarray,
+    nclasses: int,
+    cuts: str = '',
+    chunk_size: int = 1_000_000
+) -> dict:
+    """
+    Accumulates the validation histograms of a classified MC file,
+    reading it chunk by chunk.
+
+    Parameters
+    ----------
+    input_fname: str
+        classified Monte Carlo file name
+    key: str
+        input HDF5 file key to read from
+    energy_edges: np.ndarray
+        true energy bin edges
+    offset_edges: np.ndarray
+        reconstructed offset bin edges, degrees
+    nclasses: int
+        number of PSF classes (numbered from 1)
+    cuts: str
+        event cuts to apply
+    chunk_size: int
+        number of events to read at a time
+
+    Returns
+    -------
+    accumulator: dict
+        histograms as returned by empty_accumulator()
+    """
+    accumulator = empty_accumulator(energy_edges, offset_edges, nclasses)
+
+    for chunk in iter_chunks(input_fname, key, chunk_size, cuts):
+        accumulate(accumulator, chunk, energy_edges, offset_edges)
+
+    return accumulator
+
+
+def validate(
+    input_fnames: list,
+    key: str,
+    energy_edges: np.ndarray,
+    offset_edges: np.ndarray,
+    nclasses: int,
+    cuts: str = '',
+    chunk_size: int = 1_000_000,
+    n_jobs: int = None
+) -> dict:
+    """
+    Accumulates the validation histograms of several
+    classified MC files in a process pool.
+
+    Parameters
+    ----------
+    input_fnames: list
+        classified Monte Carlo file names
+    key: str
+        input HDF5 file key to read from
+    energy_edges: np.ndarray
+        true energy bin edges
+    offset_edges: np.ndarray
+        reconstructed offset bin edges, degrees
+    nclasses: int
+        number of PSF classes (numbered from 1)
+    cuts: str
+        event cuts to apply
+    chunk_size: int
+        number of events to read at a time
+    n_jobs: int
+        number of worker processes; defaults to the number of CPUs
+
+    Returns
+    -------
+    accumulator: dict
+        merged histograms as returned by empty_accumulator()
+    """
+    worker = partial(
+        validate_file,
+        key=key,
+        energy_edges=energy_edges,
+        offset_edges=offset_edges,
+        nclasses=nclasses,
+        cuts=cuts,
+        chunk_size=chunk_size
+    )
+
+    total = empty_accumulator(energy_edges, offset_edges, nclasses)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        for fname, accumulator in zip(input_fnames, pool.map(worker, input_fnames)):
+            logger.info("validated %s", fname)
+            total = merge_accumulators([total, accumulator])
+
+    return total
+
+
+def containment(counts: np.ndarray, offset_edges: np.ndarray, fraction: float = 0.68) -> np.ndarray:
+    """
+    Computes the containment radius from the offset histograms,
+    interpolating linearly within the offset bins.
+
+    If the containment falls into an overflow bin with an infinite
+    upper edge, the radius is clipped to the last finite edge;
+    see unbounded_containment() to flag such histograms.
+
+    Parameters
+    ----------
+    counts: np.ndarray
+        offset histograms with the offset bins along the last axis
+    offset_edges: np.ndarray
+        offset bin edges
+    fraction: float
+        containment fraction
+
+    Returns
+    -------
+    radius: np.ndarray
+        containment radii; NaN for the empty histograms
+    """
+    cumulative = np.cumsum(counts, axis=-1)
+    total = cumulative[..., -1:]
+    target = fraction * total
+
+    ids = np.sum(cumulative < target, axis=-1, keepdims=True)
+    ids = np.minimum(ids, counts.shape[-1] - 1)
+
+    below = np.take_along_axis(cumulative, ids, axis=-1) - np.take_along_axis(counts, ids, axis=-1)
+    in_bin = np.take_along_axis(counts, ids, axis=-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(in_bin > 0, (target - below) / in_bin, 0)
+        max_offset = offset_edges[np.isfinite(offset_edges)].max()
+        lower = np.minimum(offset_edges[ids], max_offset)
+        upper = np.minimum(offset_edges[ids + 1], max_offset)
+        radius = lower + share * (upper - lower)
+
+    radius = np.where(total > 0, radius, np.nan)
+
+    return radius[..., 0]
+
+
+def unbounded_containment(counts: np.ndarray, offset_edges: np.ndarray, fraction: float = 0.68) -> np.ndarray:
+    """
+    Flags the offset histograms, whose containment radius lies
+    beyond the last finite offset edge, i.e. in the overflow bin.
+
+    Parameters
+    ----------
+    counts: np.ndarray
+        offset histograms with the offset bins along the last axis
+    offset_edges: np.ndarray
+        offset bin edges
+    fraction: float
+        containment fraction
+
+    Returns
+    -------
+    unbounded: np.ndarray
+        True for the histograms with the unbounded containment radius
+    """
+    total = counts.sum(axis=-1)
+    bounded = counts[..., np.isfinite(offset_edges[1:])].sum(axis=-1)
+
+    return (total > 0) & (bounded < fraction * total)
+
+
+def summary_tables(
+    accumulator: dict,
+    energy_edges: np.ndarray,
+    offset_edges: np.ndarray,
+    fraction: float = 0.68
+) -> tuple:
+    """
+    Summarizes the validation histograms.
+
+    Parameters
+    ----------
+    accumulator: dict
+        histograms as returned by empty_accumulator()
+    energy_edges: np.ndarray
+        true energy bin edges
+    offset_edges: np.ndarray
+        reconstructed offset bin edges, degrees
+    fraction: float
+        containment fraction
+
+    Returns
+    -------
+    psf: pd.DataFrame
+        event counts and containment radii per energy bin and reconstructed class;
+        "containment_unbounded" flags the radii clipped to the maximal offset
+    confusion: pd.DataFrame
+        true (rows) vs reconstructed (columns) class event counts
+        per energy bin
+    """
+    counts = accumulator['offset']
+    nebins, nclasses, _ = counts.shape
+    energy_ids, class_ids = np.meshgrid(np.arange(nebins), np.arange(nclasses), indexing='ij')
+
+    psf = pd.DataFrame(dict(
+        energy_min=energy_edges[:-1][energy_ids.ravel()],
+        energy_max=energy_edges[1:][energy_ids.ravel()],
+        reco_psf_class=class_ids.ravel() + 1,
+        n_events=counts.sum(axis=-1).ravel(),
+        containment=containment(counts, offset_edges, fraction).ravel(),
+        containment_unbounded=unbounded_containment(counts, offset_edges, fraction).ravel(),
+    ))
+
+    confusion = pd.DataFrame(
+        accumulator['confusion'].reshape(nebins * nclasses, nclasses),
+        index=pd.MultiIndex.from_arrays(
+            [
+                energy_edges[:-1][energy_ids.ravel()],
+                energy_edges[1:][energy_ids.ravel()],
+                class_ids.ravel() + 1,
+            ],
+            names=['energy_min', 'energy_max', 'psf_class']
+        ),
+        columns=pd.Index(np.arange(1, nclasses + 1), name='reco_psf_class'),
+    )
+
+    return psf, confusion